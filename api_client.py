@@ -1,26 +1,210 @@
 # api_client.py
 
-import os
+import time
+import httpx
 from openai import OpenAI
-from typing import List, Dict, Any
-import re
-import json
+from typing import List, Dict, Any, Optional
 
-from config import BASE_URL, OPENAI_API_KEY, MODEL_ID
+from config import (API_ENDPOINTS, HEDGE_ENABLED, MAX_PROMPT_TOKENS, STAGE_MODELS,
+                    ANALYSIS_JSON_MODE, ANALYSIS_REASK_MISSING, API_TIMEOUT_SECONDS)
+from endpoint_pool import Endpoint, EndpointPool, ModelMetrics
+from hedging import HedgingPolicy
+from cassette import Cassette
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from deadline import Deadline, DeadlineExceeded, current_deadline
+from template_analyzer import EnglishTemplateAnalyzer
+from prompt_generator import extract_analysis_paragraph
+from metrics import API_IN_FLIGHT, API_SECONDS, API_ERRORS, record_usage
+from token_budget import enforce_prompt_budget
+from structured_output import parse_json_tolerant, validate_analysis, merge_analysis
 
 
 class OpenAIClient:
-    """使用 OpenAI 库调用 OpenAI API"""
+    """使用 OpenAI 库调用 OpenAI API，支持多端点按健康状况路由"""
 
-    def __init__(self):
-        self.client = OpenAI(
-            api_key=OPENAI_API_KEY,
-            base_url=BASE_URL
+    def __init__(self, endpoints: Optional[List[Dict[str, Any]]] = None, hedging: Optional[bool] = None,
+                 stage_models: Optional[Dict[str, Dict[str, Any]]] = None, cassette: Optional[Cassette] = None):
+        endpoint_configs = endpoints or API_ENDPOINTS
+        # 录制 / 回放磁带；回放时不访问网络
+        self.cassette = cassette
+        offline = cassette is not None and cassette.replaying
+        self.pool = EndpointPool([
+            Endpoint(
+                name=config.get('name', f"endpoint{i}"),
+                base_url=config['base_url'],
+                api_key=config.get('api_key'),
+                model=config['model'],
+                weight=config.get('weight', 1.0),
+                max_concurrency=config.get('max_concurrency', 8),
+                client=self._build_client(config, offline)
+            )
+            for i, config in enumerate(endpoint_configs)
+        ])
+
+        # 保留单端点时代的属性，指向第一个端点
+        primary = self.pool.endpoints[0]
+        self.client = primary.client
+        self.model_id = primary.model
+
+        self.hedging = HedgingPolicy(enabled=HEDGE_ENABLED if hedging is None else hedging)
+
+        # 各阶段的模型、温度和输出上限，以及按模型记录的延迟和成功率
+        self.stage_models = stage_models or STAGE_MODELS
+        self.model_metrics = ModelMetrics()
+
+        # 上游持续失败时熔断：分析退化为本地分析器，生成由调用方推迟重试
+        self.breaker = CircuitBreaker()
+        self.local_analyzer = EnglishTemplateAnalyzer()
+        self.degraded_analyses = 0
+
+        self.json_mode = ANALYSIS_JSON_MODE
+        self.parse_stats = {'parsed': 0, 'repaired': 0, 'failed': 0, 'reasked': 0, 'reask_recovered': 0}
+
+    @staticmethod
+    def _build_client(config: Dict[str, Any], offline: bool = False) -> OpenAI:
+        """为端点创建带长连接池的客户端；离线回放时允许没有 API key。单次调用的超时默认为 API_TIMEOUT_SECONDS
+
+        关闭 SDK 自带的重试：SDK 会在同一端点上按原超时重试，使一次调用的耗时超出截止时间；
+        重试交给 EndpointPool 换端点进行，每次尝试都按剩余时间重新计算超时。
+        """
+        max_concurrency = int(config.get('max_concurrency', 8))
+        http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
         )
-        self.model_id = MODEL_ID
+        return OpenAI(
+            api_key=config.get('api_key') or ("offline-replay" if offline else None),
+            base_url=config['base_url'],
+            timeout=API_TIMEOUT_SECONDS,
+            max_retries=0,
+            http_client=http_client
+        )
+
+    def _stage_config(self, stage: str) -> Dict[str, Any]:
+        """获取阶段的模型配置；打包、补问和未单独配置的高权重阶段沿用对应基础阶段的配置"""
+        base = stage.replace('_packed', '').replace('_repair', '').replace('_high_weight', '')
+        for name in (stage, base):
+            if name in self.stage_models:
+                return self.stage_models[name]
+        return {}
+
+    def _stage_params(self, stage: str, max_tokens: Optional[int] = None, tasks: int = 1) -> Dict[str, Any]:
+        """按阶段配置生成请求参数：调用方给出的 max_tokens 不超过阶段上限，打包调用的上限按任务数放大"""
+        config = self._stage_config(stage)
+        params: Dict[str, Any] = {'temperature': config.get('temperature', 0.7)}
+        limit = config.get('max_tokens')
+        if limit:
+            limit *= tasks
+            max_tokens = min(max_tokens, limit) if max_tokens else limit
+        if max_tokens:
+            params['max_tokens'] = max_tokens
+        if config.get('model'):
+            params['model'] = config['model']
+        return params
+
+    def _create_completion(self, stage: str = "default", **kwargs):
+        """通过端点池发起 chat completion 请求，未指定 model 时使用端点自己的模型
+
+        stage 用于按阶段统计延迟，启用对冲时据此决定何时发出副本；每次调用按（阶段, 模型）记录结果。
+        当前上下文设置了截止时间（deadline_scope）时，每次请求的超时不超过剩余时间，用完时抛出 DeadlineExceeded。
+        配置了磁带时按逻辑调用录制或回放：对冲副本和端点重试不单独录制，上游失败也会录制并在回放时重新抛出。
+        """
+        # 在调用线程中取出截止时间，对冲副本在线程池中执行时沿用同一截止时间
+        deadline = current_deadline()
+        if deadline is not None:
+            deadline.check(f"{stage} 调用")
+
+        def call(endpoint: Endpoint):
+            params = dict(kwargs)
+            params.setdefault('model', endpoint.model)
+            return self._send(stage, endpoint, params, deadline)
+
+        if not self.breaker.allow():
+            raise CircuitOpenError("熔断器打开，跳过上游调用")
+        recording = self.cassette is not None and not self.cassette.replaying
+        start = time.perf_counter()
+        try:
+            if self.cassette is not None and self.cassette.replaying:
+                response = self._replay(stage, kwargs)
+            else:
+                response = self.hedging.run(stage, lambda: self.pool.call(call))
+        except DeadlineExceeded:
+            self.breaker.release_probe()
+            raise
+        except Exception as e:
+            self.breaker.record_failure()
+            if recording:
+                self.cassette.record_error(stage, kwargs, e, time.perf_counter() - start)
+            raise
+        self.breaker.record_success()
+        if recording:
+            self.cassette.record(stage, kwargs, response, time.perf_counter() - start)
+        return response
+
+    def _replay(self, stage: str, params: Dict[str, Any]):
+        """从磁带回放一次逻辑调用，并像真实请求一样记录统计"""
+        model = params.get('model') or self.pool.endpoints[0].model
+        start = time.perf_counter()
+        try:
+            response = self.cassette.play(params)
+        except Exception:
+            self.model_metrics.record(stage, model, time.perf_counter() - start, False)
+            API_ERRORS.inc(stage=stage)
+            raise
+        latency = time.perf_counter() - start
+        self.model_metrics.record(stage, model, latency, True, getattr(response, 'usage', None))
+        API_SECONDS.observe(latency, stage=stage)
+        record_usage(stage, response)
+        return response
+
+    def _send(self, stage: str, endpoint: Endpoint, params: Dict[str, Any], deadline: Optional[Deadline] = None):
+        """在端点上发出请求并按（阶段, 模型）记录结果
 
-    def analyze_template(self, prompt: str) -> Dict:
-        """分析模板结构"""
+        传入 deadline 时请求超时取剩余时间，预算用完导致的失败以 DeadlineExceeded 抛出。
+        """
+        timeout = deadline.call_timeout(API_TIMEOUT_SECONDS, f"{stage} 调用") if deadline is not None else None
+        API_IN_FLIGHT.inc()
+        start = time.perf_counter()
+        try:
+            if timeout is not None:
+                response = endpoint.client.chat.completions.create(timeout=timeout, **params)
+            else:
+                response = endpoint.client.chat.completions.create(**params)
+        except Exception as e:
+            self.model_metrics.record(stage, params['model'], time.perf_counter() - start, False)
+            API_ERRORS.inc(stage=stage)
+            if deadline is not None and deadline.expired():
+                raise DeadlineExceeded(f"{deadline.limited_by} 时间预算已用完，{stage} 调用中止") from e
+            raise
+        finally:
+            API_IN_FLIGHT.dec()
+        latency = time.perf_counter() - start
+        self.model_metrics.record(stage, params['model'], latency, True, getattr(response, 'usage', None))
+        API_SECONDS.observe(latency, stage=stage)
+        record_usage(stage, response)
+        return response
+
+    def get_endpoint_stats(self) -> List[Dict[str, Any]]:
+        """获取各端点的路由统计"""
+        return self.pool.stats()
+
+    def get_hedging_stats(self) -> Dict[str, Any]:
+        """获取对冲请求统计"""
+        return self.hedging.stats()
+
+    def get_cassette_stats(self) -> Optional[Dict[str, Any]]:
+        """获取磁带录制 / 回放统计，未使用磁带时返回 None"""
+        return self.cassette.stats() if self.cassette is not None else None
+
+    def get_breaker_stats(self) -> Dict[str, Any]:
+        """获取熔断器状态和退化次数"""
+        return {**self.breaker.stats(), 'degraded_analyses': self.degraded_analyses}
+
+    def get_model_stats(self) -> List[Dict[str, Any]]:
+        """获取按阶段和模型统计的延迟与成功率"""
+        return self.model_metrics.stats()
+
+    def analyze_template(self, prompt: str, max_tokens: Optional[int] = None) -> Dict:
+        """分析模板结构；max_tokens 未指定时使用 analysis 阶段的上限，时间预算用完时抛出 DeadlineExceeded"""
         try:
             full_prompt = (
                 "你是一个专业的文本分析助手，请按照以下格式分析英文段落：\n"
@@ -32,61 +216,215 @@ class OpenAIClient:
                 "```"
                 + "\n" + prompt
             )
+            full_prompt = enforce_prompt_budget(full_prompt)
 
-            response = self.client.chat.completions.create(
-                model=self.model_id,
-                messages=[
-                    {"role": "user", "content": full_prompt}
-                ],
-                temperature=0.3,
-                max_tokens=1000,
-                n=1
-            )
-            return self._parse_api_result(response)
+            response = self._request_analysis(full_prompt, max_tokens)
+            result = self._parse_api_result(response)
+            if not isinstance(result, dict) or 'raw_response' in result:
+                return result
+
+            analysis, missing = validate_analysis(result)
+            if not missing:
+                return analysis
+            if not analysis or not ANALYSIS_REASK_MISSING:
+                # 两个结构都缺失时补问等同于重跑，交给调用方处理
+                return result
+            return self._reask_missing_fields(prompt, analysis, missing)
+        except DeadlineExceeded:
+            raise
         except Exception as e:
+            if isinstance(e, CircuitOpenError) or self.breaker.is_open():
+                return self._degraded_analysis(prompt)
             print(f"API调用错误: {e}")
             return {}
 
-    def generate_paragraph(self, prompt: str) -> str:
-        """生成仿写段落"""
+    def _degraded_analysis(self, prompt: str) -> Dict:
+        """熔断期间用本地分析器代替上游，结果带 degraded 标记，便于之后重跑"""
+        self.degraded_analyses += 1
+        text = extract_analysis_paragraph(prompt)
+        return {
+            'discourse_structure': self.local_analyzer.analyze_discourse_structure(text),
+            'content_structure': self.local_analyzer.analyze_content_structure(text),
+            'degraded': 'local_analyzer'
+        }
+
+    def _request_analysis(self, full_prompt: str, max_tokens: Optional[int], stage: str = "analysis"):
+        """发起分析请求；端点不支持 JSON 模式时自动退回普通模式"""
+        params = dict(
+            stage=stage,
+            messages=[
+                {"role": "user", "content": full_prompt}
+            ],
+            n=1,
+            **self._stage_params(stage, max_tokens)
+        )
+        if self.json_mode:
+            try:
+                return self._create_completion(response_format={"type": "json_object"}, **params)
+            except Exception as e:
+                if 'response_format' not in str(e):
+                    raise
+                print(f"端点不支持 JSON 模式，改用普通模式: {e}")
+                self.json_mode = False
+        return self._create_completion(**params)
+
+    def _reask_missing_fields(self, prompt: str, analysis: Dict, missing: List[str]) -> Dict:
+        """只针对缺失字段补问，并合并进已有分析结果"""
+        print(f"分析结果缺少字段 {missing}，补问缺失字段")
+        self.parse_stats['reasked'] += 1
+        try:
+            # 静态说明在前，待补充的字段列表放在最后，保持与分析请求相同的提示前缀
+            reask_prompt = (
+                "你是一个专业的文本分析助手。之前对下面段落的分析缺少部分字段，"
+                "请只补充末尾列出的字段，按 {\"discourse_structure\": {...}, \"content_structure\": {...}} "
+                "的嵌套结构返回 JSON，不要返回其他字段。\n"
+                + prompt
+                + "\n\n需要补充的字段：\n"
+                + "\n".join(f"- {field}" for field in missing)
+            )
+            reask_prompt = enforce_prompt_budget(reask_prompt)
+            response = self._request_analysis(reask_prompt, 80 + 60 * len(missing),
+                                              stage="analysis_repair")
+            merged = merge_analysis(analysis, self._parse_api_result(response), missing)
+        except Exception as e:
+            print(f"补问缺失字段失败: {e}")
+            return analysis
+
+        _, still_missing = validate_analysis(merged)
+        if not still_missing:
+            self.parse_stats['reask_recovered'] += 1
+        return merged
+
+    def get_parse_stats(self) -> Dict[str, int]:
+        """获取分析结果解析统计"""
+        return dict(self.parse_stats)
+
+    def generate_paragraph(self, prompt: str, max_tokens: Optional[int] = None, high_weight: bool = False) -> str:
+        """生成仿写段落；高权重模板走 generation_high_weight 阶段的模型，max_tokens 未指定时使用阶段上限
+
+        熔断器打开时抛出 CircuitOpenError，由调用方把任务放入重试队列；时间预算用完时抛出 DeadlineExceeded。
+        """
         try:
             full_prompt = (
                     "你是一个专业的英文段落生成助手，请根据给定的结构和主题生成一个连贯的英文段落。"
                     + "\n" + prompt
             )
+            full_prompt = enforce_prompt_budget(full_prompt)
 
-            response = self.client.chat.completions.create(
-                model=self.model_id,
+            stage = "generation_high_weight" if high_weight else "generation"
+            response = self._create_completion(
+                stage=stage,
                 messages=[
                     {"role": "user", "content": full_prompt}
                 ],
-                temperature=0.7,
-                max_tokens=300,
-                n=1
+                n=1,
+                **self._stage_params(stage, max_tokens)
             )
             return response.choices[0].message.content.strip()
+        except (CircuitOpenError, DeadlineExceeded):
+            raise
         except Exception as e:
             print(f"API调用错误: {e}")
+            if self.breaker.is_open():
+                raise CircuitOpenError("熔断器已打开") from e
             return ""
 
+    def analyze_templates_packed(self, prompts: List[str]) -> List[Dict]:
+        """将多个分析任务打包成一次 API 调用，解析失败时逐个调用"""
+        if len(prompts) <= 1:
+            return [self.analyze_template(p) for p in prompts]
+
+        try:
+            full_prompt = (
+                "你是一个专业的文本分析助手。下面有若干个相互独立的分析任务，请逐个完成，"
+                "并只返回一个 JSON 数组，元素个数和顺序与任务一致，"
+                "每个对象格式如下：\n"
+                "```json\n"
+                "[\n"
+                "  {\"discourse_structure\": {...}, \"content_structure\": {...}}\n"
+                "]\n"
+                "```"
+                + self._pack_tasks(prompts)
+            )
+            full_prompt = enforce_prompt_budget(full_prompt, MAX_PROMPT_TOKENS * len(prompts))
+
+            response = self._create_completion(
+                stage="analysis_packed",
+                messages=[
+                    {"role": "user", "content": full_prompt}
+                ],
+                n=1,
+                **self._stage_params("analysis_packed", tasks=len(prompts))
+            )
+            results = self._parse_api_result(response)
+            if isinstance(results, list) and len(results) == len(prompts):
+                analyses = []
+                for prompt, result in zip(prompts, results):
+                    analysis, missing = validate_analysis(result)
+                    # 打包结果中不完整的条目单独重新分析
+                    analyses.append(analysis if not missing else self.analyze_template(prompt))
+                return analyses
+            print("打包分析结果数量不匹配，改为逐个调用")
+        except Exception as e:
+            print(f"打包API调用错误: {e}")
+
+        return [self.analyze_template(p) for p in prompts]
+
+    def generate_paragraphs_packed(self, prompts: List[str]) -> List[str]:
+        """将多个生成任务打包成一次 API 调用，解析失败时逐个调用"""
+        if len(prompts) <= 1:
+            return [self.generate_paragraph(p) for p in prompts]
+
+        try:
+            full_prompt = (
+                "你是一个专业的英文段落生成助手。下面有若干个相互独立的写作任务，"
+                "请根据每个任务给定的结构和主题各生成一个连贯的英文段落，"
+                "并只返回一个字符串 JSON 数组，元素个数和顺序与任务一致。"
+                + self._pack_tasks(prompts)
+            )
+            full_prompt = enforce_prompt_budget(full_prompt, MAX_PROMPT_TOKENS * len(prompts))
+
+            response = self._create_completion(
+                stage="generation_packed",
+                messages=[
+                    {"role": "user", "content": full_prompt}
+                ],
+                n=1,
+                **self._stage_params("generation_packed", tasks=len(prompts))
+            )
+            results = self._parse_api_result(response)
+            if isinstance(results, list) and len(results) == len(prompts):
+                return [str(r).strip() for r in results]
+            print("打包生成结果数量不匹配，改为逐个调用")
+        except Exception as e:
+            print(f"打包API调用错误: {e}")
+
+        return [self.generate_paragraph(p) for p in prompts]
+
+    @staticmethod
+    def _pack_tasks(prompts: List[str]) -> str:
+        """把多个提示拼接为带编号的任务列表，任务数放在最后，不影响静态前缀"""
+        tasks = "".join(f"\n\n### 任务 {i}\n{prompt.strip()}" for i, prompt in enumerate(prompts, 1))
+        return tasks + f"\n\n（共 {len(prompts)} 个任务）"
+
     def _parse_api_result(self, result) -> Dict:
-        """解析 OpenAI API 返回的结果"""
+        """解析 OpenAI API 返回的结果，容忍截断和尾随逗号等常见问题"""
         content = result.choices[0].message.content.strip()
 
-        # 尝试从返回内容中提取 JSON 格式的数据
         try:
-            # 提取代码块中的 JSON 内容
-            match = re.search(r'```json\s*\n(.*?)\n```', content, re.DOTALL)
-            if match:
-                json_content = match.group(1)
-                return json.loads(json_content)
-
-            # 如果没有找到代码块，尝试直接解析整个内容
-            return json.loads(content)
-        except (json.JSONDecodeError, TypeError) as e:
+            data, repaired = parse_json_tolerant(content)
+        except ValueError as e:
             print(f"无法解析 API 返回的 JSON 数据: {e}")
+            self.parse_stats['failed'] += 1
             return {"raw_response": content}
 
+        if repaired:
+            print("API 返回的 JSON 不完整，已自动修复")
+            self.parse_stats['repaired'] += 1
+        else:
+            self.parse_stats['parsed'] += 1
+        return data
+
     def batch_process(self, prompts: List[str], process_type: str) -> List[Any]:
         """批量处理多个提示"""
         results = []
@@ -99,19 +437,26 @@ class OpenAIClient:
         return results
 
     def test_connection(self) -> bool:
-        """测试 API 连接是否正常"""
-        try:
-            response = self.client.chat.completions.create(
-                model=self.model_id,
-                messages=[
+        """测试 API 连接是否正常：用 probe 阶段的模型逐个探测端点，任一端点可用即视为成功"""
+        params = self._stage_params("probe")
+
+        def probe(endpoint: Endpoint):
+            self._send("probe", endpoint, {
+                'model': endpoint.model,
+                **params,
+                'messages': [
                     {"role": "user", "content": "Hello, this is a test message."}
-                ],
-                max_tokens=10
-            )
-            return True
-        except Exception as e:
-            print(f"连接测试失败: {e}")
-            return False
+                ]
+            })
+
+        connected = False
+        for endpoint in self.pool.endpoints:
+            try:
+                self.pool.call_endpoint(endpoint, probe)
+                connected = True
+            except Exception as e:
+                print(f"连接测试失败 ({endpoint.name}): {e}")
+        return connected
 
     def get_available_models(self) -> List[str]:
         """获取可用的模型列表"""
@@ -0,0 +1,142 @@
+# cassette.py
+
+import os
+import json
+import time
+import hashlib
+import threading
+from types import SimpleNamespace
+from collections import defaultdict, deque
+from typing import Dict, Any
+
+
+class CassetteMissError(RuntimeError):
+    """回放时磁带中没有对应的请求"""
+
+
+class RecordedCallError(RuntimeError):
+    """回放录制时失败的调用"""
+
+
+def _to_plain(value: Any) -> Any:
+    """把 SDK 响应对象转换为可 JSON 序列化的结构"""
+    if hasattr(value, 'model_dump'):
+        return value.model_dump()
+    if isinstance(value, SimpleNamespace):
+        value = vars(value)
+    if isinstance(value, dict):
+        return {k: _to_plain(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_plain(v) for v in value]
+    return value
+
+
+def _to_namespace(value: Any) -> Any:
+    """把录制的响应还原为可按属性访问的对象（与 SDK 响应的用法一致）"""
+    if isinstance(value, dict):
+        return SimpleNamespace(**{k: _to_namespace(v) for k, v in value.items()})
+    if isinstance(value, list):
+        return [_to_namespace(v) for v in value]
+    return value
+
+
+class Cassette:
+    """录制 / 回放 chat completion 请求
+
+    录制模式下把每次逻辑调用的参数、响应（或失败）和耗时追加写入 JSONL 磁带；回放模式下按请求内容
+    （消息和 response_format）查找响应，相同请求按录制顺序依次返回，用完后重复最后一个。
+    录制的失败回放时以 RecordedCallError 抛出（原异常类型写在消息中），可以复现重试、熔断等错误路径。
+    耗时是整次逻辑调用的耗时（含端点重试和对冲），对冲副本和重试不单独录制。
+    latency_scale 为 0 时立即返回，为 1 时按录制的耗时等待，可用于离线复现生产负载。
+    """
+
+    RECORD = "record"
+    REPLAY = "replay"
+
+    def __init__(self, path: str, mode: str, latency_scale: float = 0.0):
+        if mode not in (self.RECORD, self.REPLAY):
+            raise ValueError(f"未知的磁带模式: {mode}")
+        self.path = path
+        self.mode = mode
+        self.latency_scale = latency_scale
+        self.recorded = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[str, deque] = defaultdict(deque)
+        self._last: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+        if mode == self.REPLAY:
+            self._load()
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == self.REPLAY
+
+    @staticmethod
+    def request_key(params: Dict[str, Any]) -> str:
+        """请求指纹：只取消息和 response_format，不受模型路由和 max_tokens 调整影响"""
+        material = json.dumps({'messages': params.get('messages'), 'response_format': params.get('response_format')},
+                              sort_keys=True, ensure_ascii=False)
+        return hashlib.sha1(material.encode('utf-8')).hexdigest()
+
+    def _load(self) -> None:
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                self._entries[entry['key']].append(entry)
+
+    def record(self, stage: str, params: Dict[str, Any], response: Any, latency: float) -> None:
+        """追加一条请求 / 响应记录"""
+        self._append(stage, params, latency, response=_to_plain(response))
+
+    def record_error(self, stage: str, params: Dict[str, Any], error: BaseException, latency: float) -> None:
+        """追加一条失败调用的记录"""
+        self._append(stage, params, latency, error={'type': type(error).__name__, 'message': str(error)})
+
+    def _append(self, stage: str, params: Dict[str, Any], latency: float, **outcome: Any) -> None:
+        entry = {
+            'key': self.request_key(params),
+            'stage': stage,
+            'request': _to_plain(params),
+            **outcome,
+            'latency': round(latency, 4),
+            'recorded_at': time.time()
+        }
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+            self.recorded += 1
+
+    def play(self, params: Dict[str, Any]) -> Any:
+        """返回录制的响应；录制的是失败时抛出 RecordedCallError，找不到时抛出 CassetteMissError"""
+        key = self.request_key(params)
+        with self._lock:
+            queue = self._entries.get(key)
+            if queue:
+                entry = queue.popleft()
+                self._last[key] = entry
+            else:
+                entry = self._last.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        if entry is None:
+            raise CassetteMissError(f"磁带中没有该请求 (key={key[:12]})")
+        if self.latency_scale > 0:
+            time.sleep(entry['latency'] * self.latency_scale)
+        if 'error' in entry:
+            raise RecordedCallError(f"{entry['error']['type']}: {entry['error']['message']}")
+        return _to_namespace(entry['response'])
+
+    def stats(self) -> Dict[str, Any]:
+        return {'mode': self.mode, 'path': self.path, 'recorded': self.recorded,
+                'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,88 @@
+# circuit_breaker.py
+
+import time
+import threading
+from typing import Dict, Any
+
+from config import BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS, BREAKER_HALF_OPEN_PROBES
+
+
+class CircuitOpenError(RuntimeError):
+    """熔断器打开期间拒绝调用上游"""
+
+
+class CircuitBreaker:
+    """熔断器：连续失败 failure_threshold 次后打开，期间直接拒绝请求；
+    reset_seconds 后进入半开状态，放行至多 half_open_probes 个探测请求，成功则关闭，失败则重新打开
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: float = BREAKER_RESET_SECONDS, half_open_probes: int = BREAKER_HALF_OPEN_PROBES):
+        self.failure_threshold = max(int(failure_threshold), 1)
+        self.reset_seconds = reset_seconds
+        self.half_open_probes = max(int(half_open_probes), 1)
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self.trips = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """是否放行一个请求；半开状态下占用一个探测名额"""
+        with self._lock:
+            if self.state == self.OPEN and time.time() - self.opened_at >= self.reset_seconds:
+                self.state = self.HALF_OPEN
+                self.probes_in_flight = 0
+                print("熔断器进入半开状态，发送探测请求")
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.HALF_OPEN and self.probes_in_flight < self.half_open_probes:
+                self.probes_in_flight += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def is_open(self) -> bool:
+        """是否处于打开状态（到期后的首次 allow 会把它转为半开）"""
+        with self._lock:
+            return self.state == self.OPEN and time.time() - self.opened_at < self.reset_seconds
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                print("探测请求成功，熔断器关闭")
+            self.state = self.CLOSED
+            self.consecutive_failures = 0
+            self.probes_in_flight = 0
+
+    def release_probe(self) -> None:
+        """放行的请求因调用方的时间预算用完而中止，不计成败，只归还半开探测名额"""
+        with self._lock:
+            if self.state == self.HALF_OPEN and self.probes_in_flight > 0:
+                self.probes_in_flight -= 1
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                    print(f"上游连续失败 {self.consecutive_failures} 次，熔断器打开 {self.reset_seconds} 秒")
+                self.state = self.OPEN
+                self.opened_at = time.time()
+                self.probes_in_flight = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'trips': self.trips,
+                'rejected': self.rejected
+            }
@@ -1,4 +1,5 @@
 import os
+import json
 
 # 获取环境变量
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
@@ -6,7 +7,121 @@ OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 BASE_URL = "https://api.openai.com/v1"
 MODEL_ID = "gpt-4"
 
+# 多端点配置：每项包含 base_url、api_key、model、weight、max_concurrency
+# 可通过环境变量 OPENAI_ENDPOINTS（JSON 数组）覆盖，缺省字段沿用上面的单端点配置
+API_ENDPOINTS = [
+    {"base_url": BASE_URL, "api_key": OPENAI_API_KEY, "model": MODEL_ID, "weight": 1.0, "max_concurrency": 8}
+]
+if os.environ.get("OPENAI_ENDPOINTS"):
+    API_ENDPOINTS = [
+        {"base_url": BASE_URL, "api_key": OPENAI_API_KEY, "model": MODEL_ID, "weight": 1.0, "max_concurrency": 8,
+         **endpoint}
+        for endpoint in json.loads(os.environ["OPENAI_ENDPOINTS"])
+    ]
+
+# 连续失败多少次后剔除端点，以及剔除时长（秒）
+ENDPOINT_EJECT_AFTER_FAILURES = 3
+ENDPOINT_EJECT_SECONDS = 30
+
 # 项目路径配置
 PROJECT_ROOT = os.path.dirname(os.path.abspath(__file__))
 SOURCE_DIR = os.path.join(PROJECT_ROOT, "source")
 
+# 模板库配置
+TEMPLATE_LIBRARY_DIR = os.path.join(PROJECT_ROOT, "template_library")
+TEMPLATE_LIBRARY_TOP_K = 4
+# 检索时最多使用的查询词数（按 查询权重 × IDF 取最高的若干个）
+TEMPLATE_LIBRARY_MAX_QUERY_TERMS = 16
+
+# 近重复模板去重配置
+DEDUP_ENABLED = True
+DEDUP_THRESHOLD = 0.8
+MINHASH_NUM_PERM = 64
+
+# 常驻服务配置
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+SERVICE_BATCH_WINDOW_MS = 20
+SERVICE_MAX_BATCH_SIZE = 8
+SERVICE_CACHE_SIZE = 1024
+SERVICE_WORKERS = 8
+
+# 对冲请求配置：请求超过该阶段近期延迟的 HEDGE_PERCENTILE 分位数仍未返回时发出副本
+HEDGE_ENABLED = False
+HEDGE_PERCENTILE = 0.95
+HEDGE_BUDGET_RATIO = 0.1
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MAX_WORKERS = 16
+
+# Token 预算配置
+MAX_PROMPT_TOKENS = 3000
+CONTEXT_TOKEN_BUDGET = 600
+ANALYSIS_MIN_TOKENS = 300
+ANALYSIS_MAX_TOKENS = 1000
+GENERATION_MIN_TOKENS = 80
+GENERATION_MAX_TOKENS = 300
+
+# 按阶段路由模型：model 为 None 时使用端点自己的模型；max_tokens 为该阶段的输出上限
+# 默认各阶段都使用端点配置的模型；设置环境变量后该阶段改用指定模型（如分析交给更便宜、更快的模型）
+STAGE_MODELS = {
+    "analysis": {"model": os.environ.get("ANALYSIS_MODEL_ID"), "temperature": 0.3,
+                 "max_tokens": ANALYSIS_MAX_TOKENS},
+    "generation": {"model": os.environ.get("GENERATION_MODEL_ID"), "temperature": 0.7,
+                   "max_tokens": GENERATION_MAX_TOKENS},
+    "generation_high_weight": {"model": os.environ.get("HIGH_WEIGHT_MODEL_ID"), "temperature": 0.6,
+                               "max_tokens": GENERATION_MAX_TOKENS},
+    "probe": {"model": os.environ.get("PROBE_MODEL_ID"), "temperature": 0.0, "max_tokens": 10}
+}
+
+# 结构化输出配置：分析请求使用 JSON 模式，结果缺少字段时只补问缺失字段
+ANALYSIS_JSON_MODE = True
+ANALYSIS_REASK_MISSING = True
+
+# 近似生成缓存（默认关闭，仅用于可接受复用的批量草稿生成）
+GENERATION_CACHE_ENABLED = False
+GENERATION_CACHE_TOLERANCE = 0.2
+GENERATION_CACHE_PATH = os.path.join(PROJECT_ROOT, "cache", "generation_cache.jsonl")
+
+# 性能剖析配置
+PROFILE_DIR = os.path.join(PROJECT_ROOT, "profiles")
+PROFILE_TOP_N = 30
+
+# 分布式任务队列：队列数据库放在共享文件系统上，多台机器的 worker 以租约领取案例
+JOB_QUEUE_PATH = os.path.join(PROJECT_ROOT, "queue", "jobs.sqlite3")
+JOB_LEASE_SECONDS = 300
+JOB_MAX_ATTEMPTS = 3
+JOB_POLL_SECONDS = 5
+
+# 运行指标：--metrics 启用后在本地端口暴露 Prometheus 文本格式，并定期把快照写入文件
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9464
+METRICS_SNAPSHOT_PATH = os.path.join(PROJECT_ROOT, "metrics", "metrics.json")
+METRICS_SNAPSHOT_SECONDS = 30
+
+# 熔断器：上游连续失败 BREAKER_FAILURE_THRESHOLD 次后打开，BREAKER_RESET_SECONDS 秒后半开探测
+# 打开期间分析退化为本地分析器，生成任务写入重试队列，之后用 retry_queue.py 补跑
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 60
+BREAKER_HALF_OPEN_PROBES = 1
+RETRY_QUEUE_PATH = os.path.join(PROJECT_ROOT, "queue", "retry.jsonl")
+
+# 推测生成：上游分析进行中时先用本地分析构造仿写提示并开始生成，分析返回后结构槽位一致则采用推测段落
+# 句子数相差不超过 SPECULATIVE_SENTENCE_TOLERANCE、连接词 Jaccard 不低于 SPECULATIVE_CONNECTIVE_OVERLAP，流向和论证方向须一致
+SPECULATIVE_GENERATION = False
+SPECULATIVE_MAX_WORKERS = 4
+SPECULATIVE_SENTENCE_TOLERANCE = 1
+SPECULATIVE_CONNECTIVE_OVERLAP = 0.5
+
+# 时间预算：每个案例的预算（秒），以及整次运行的预算（None 为不限时），可用 --case-deadline / --run-deadline 覆盖
+# 预算传递到每次 API 调用的超时，单次调用不超过 API_TIMEOUT_SECONDS；超时的案例写出部分结果并标记 timed_out
+CASE_DEADLINE_SECONDS = 600
+RUN_DEADLINE_SECONDS = None
+API_TIMEOUT_SECONDS = 120
+
+# 分片压缩结果存储：--result-store 启用后结果写入存储目录，不再为每个案例写 results.json
+RESULT_STORE_DIR = os.path.join(PROJECT_ROOT, "results_store")
+RESULT_STORE_SHARD_BYTES = 64 * 1024 * 1024
+RESULT_STORE_COMPRESSION_LEVEL = 6
+
+# 语料级统计报告目录
+CORPUS_REPORT_DIR = os.path.join(PROJECT_ROOT, "reports")
@@ -0,0 +1,277 @@
+# corpus_stats.py
+
+import os
+import sys
+import json
+import math
+import argparse
+from typing import Dict, Any, Optional
+
+from utils import read_json_file, write_json_file, get_case_dirs
+
+
+class RunningStats:
+    """Welford 在线均值/方差，支持并行合并（Chan 等人的合并公式）"""
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, value: float) -> None:
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "RunningStats") -> None:
+        if other.count == 0:
+            return
+        if self.count == 0:
+            self.count, self.mean, self.m2, self.min, self.max = other.count, other.mean, other.m2, other.min, other.max
+            return
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / total
+        self.m2 += other.m2 + delta * delta * self.count * other.count / total
+        self.count = total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def variance(self) -> float:
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'count': self.count, 'mean': self.mean, 'm2': self.m2,
+                'min': self.min if self.count else None, 'max': self.max if self.count else None}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "RunningStats":
+        stats = cls()
+        stats.count = data.get('count', 0)
+        stats.mean = data.get('mean', 0.0)
+        stats.m2 = data.get('m2', 0.0)
+        stats.min = data['min'] if data.get('min') is not None else math.inf
+        stats.max = data['max'] if data.get('max') is not None else -math.inf
+        return stats
+
+
+class HistogramSketch:
+    """定宽直方图分位数草图：值域固定（相似度为 [0, 1]），内存上限为桶数，可精确合并
+
+    相似度分数保留三位小数，默认 1000 个桶时分位数误差不超过一个桶宽。
+    """
+
+    def __init__(self, low: float = 0.0, high: float = 1.0, bins: int = 1000):
+        self.low = low
+        self.high = high
+        self.bins = bins
+        self.counts: Dict[int, int] = {}
+        self.total = 0
+
+    def _bin(self, value: float) -> int:
+        ratio = (value - self.low) / (self.high - self.low)
+        return max(0, min(self.bins - 1, int(ratio * self.bins)))
+
+    def update(self, value: float) -> None:
+        index = self._bin(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total += 1
+
+    def merge(self, other: "HistogramSketch") -> None:
+        if (other.low, other.high, other.bins) != (self.low, self.high, self.bins):
+            raise ValueError("只能合并相同配置的直方图草图")
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.total += other.total
+
+    def quantile(self, q: float) -> Optional[float]:
+        """返回 q 分位数（取所在桶的中点）"""
+        if self.total == 0:
+            return None
+        target = q * (self.total - 1)
+        seen = 0
+        width = (self.high - self.low) / self.bins
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen > target:
+                return round(self.low + (index + 0.5) * width, 4)
+        return self.high
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {'low': self.low, 'high': self.high, 'bins': self.bins, 'total': self.total,
+                'counts': {str(k): v for k, v in self.counts.items()}}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "HistogramSketch":
+        sketch = cls(data.get('low', 0.0), data.get('high', 1.0), data.get('bins', 1000))
+        sketch.counts = {int(k): v for k, v in data.get('counts', {}).items()}
+        sketch.total = data.get('total', sum(sketch.counts.values()))
+        return sketch
+
+
+class CorpusAggregator:
+    """语料级统计：每个案例完成时在线更新，内存与案例数无关，多个 worker 的部分结果可合并"""
+
+    GROUPS = ('all', 'high_weight', 'normal')
+    METRICS = ('overall', 'discourse', 'content')
+
+    def __init__(self):
+        self.cases = 0
+        self.templates = 0
+        self.failed_analyses = 0
+        self.empty_generations = 0
+        self.analyses_saved_by_dedup = 0
+        self.cached_generations = 0
+        self.stats = {group: {metric: RunningStats() for metric in self.METRICS} for group in self.GROUPS}
+        self.sketches = {group: {metric: HistogramSketch() for metric in self.METRICS} for group in self.GROUPS}
+
+    def update(self, result_data: Dict[str, Any]) -> None:
+        """加入一个案例的结果（format_result_json 的输出）"""
+        if not isinstance(result_data, dict):
+            return
+        self.cases += 1
+        dedup = result_data.get('deduplication') or {}
+        self.analyses_saved_by_dedup += dedup.get('analyses_saved', 0)
+
+        for template in result_data.get('templates', []):
+            self.templates += 1
+            if not template.get('analysis'):
+                self.failed_analyses += 1
+            if not template.get('generated_text'):
+                self.empty_generations += 1
+            if (template.get('generation_provenance') or {}).get('source') == 'approximate_cache':
+                self.cached_generations += 1
+
+            group = 'high_weight' if template.get('is_high_weight') else 'normal'
+            scores = template.get('similarity_score') or {}
+            for metric in self.METRICS:
+                value = scores.get(metric)
+                if not isinstance(value, (int, float)):
+                    continue
+                for target in ('all', group):
+                    self.stats[target][metric].update(float(value))
+                    self.sketches[target][metric].update(float(value))
+
+    def merge(self, other: "CorpusAggregator") -> None:
+        """合并另一个 worker 的部分统计"""
+        self.cases += other.cases
+        self.templates += other.templates
+        self.failed_analyses += other.failed_analyses
+        self.empty_generations += other.empty_generations
+        self.analyses_saved_by_dedup += other.analyses_saved_by_dedup
+        self.cached_generations += other.cached_generations
+        for group in self.GROUPS:
+            for metric in self.METRICS:
+                self.stats[group][metric].merge(other.stats[group][metric])
+                self.sketches[group][metric].merge(other.sketches[group][metric])
+
+    def to_dict(self) -> Dict[str, Any]:
+        """序列化部分统计，供跨进程合并"""
+        return {
+            'cases': self.cases,
+            'templates': self.templates,
+            'failed_analyses': self.failed_analyses,
+            'empty_generations': self.empty_generations,
+            'analyses_saved_by_dedup': self.analyses_saved_by_dedup,
+            'cached_generations': self.cached_generations,
+            'stats': {g: {m: s.to_dict() for m, s in metrics.items()} for g, metrics in self.stats.items()},
+            'sketches': {g: {m: s.to_dict() for m, s in metrics.items()} for g, metrics in self.sketches.items()}
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "CorpusAggregator":
+        aggregator = cls()
+        for key in ('cases', 'templates', 'failed_analyses', 'empty_generations',
+                    'analyses_saved_by_dedup', 'cached_generations'):
+            setattr(aggregator, key, data.get(key, 0))
+        for group in cls.GROUPS:
+            for metric in cls.METRICS:
+                stats = data.get('stats', {}).get(group, {}).get(metric)
+                sketch = data.get('sketches', {}).get(group, {}).get(metric)
+                if stats:
+                    aggregator.stats[group][metric] = RunningStats.from_dict(stats)
+                if sketch:
+                    aggregator.sketches[group][metric] = HistogramSketch.from_dict(sketch)
+        return aggregator
+
+    def report(self) -> Dict[str, Any]:
+        """生成运行级报告"""
+        similarity = {}
+        for group in self.GROUPS:
+            similarity[group] = {}
+            for metric in self.METRICS:
+                stats = self.stats[group][metric]
+                sketch = self.sketches[group][metric]
+                similarity[group][metric] = {
+                    'count': stats.count,
+                    'mean': round(stats.mean, 4) if stats.count else None,
+                    'std': round(math.sqrt(stats.variance), 4) if stats.count else None,
+                    'min': round(stats.min, 4) if stats.count else None,
+                    'max': round(stats.max, 4) if stats.count else None,
+                    'p50': sketch.quantile(0.50),
+                    'p90': sketch.quantile(0.90),
+                    'p99': sketch.quantile(0.99)
+                }
+
+        return {
+            'cases': self.cases,
+            'templates': self.templates,
+            'failed_analyses': self.failed_analyses,
+            'empty_generations': self.empty_generations,
+            'analyses_saved_by_dedup': self.analyses_saved_by_dedup,
+            'cached_generations': self.cached_generations,
+            'similarity': similarity
+        }
+
+
+def main() -> None:
+    """命令行入口：合并多个 worker 的部分统计，或从已有 results.json 回填报告"""
+    parser = argparse.ArgumentParser(description="语料级统计")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    merge_parser = subparsers.add_parser("merge", help="合并部分统计文件")
+    merge_parser.add_argument("partials", nargs="+", help="CorpusAggregator.to_dict() 输出的 JSON 文件")
+    merge_parser.add_argument("-o", "--output", help="报告输出路径（默认打印）")
+
+    scan_parser = subparsers.add_parser("scan", help="扫描案例目录中已有的 results.json")
+    scan_parser.add_argument("source_dir", nargs="?", help="案例源目录")
+    scan_parser.add_argument("--store", help="改为顺序扫描分片结果存储（result_store.py）")
+    scan_parser.add_argument("-o", "--output", help="报告输出路径（默认打印）")
+
+    args = parser.parse_args()
+    aggregator = CorpusAggregator()
+    if args.command == "merge":
+        for path in args.partials:
+            aggregator.merge(CorpusAggregator.from_dict(read_json_file(path)))
+    elif args.store:
+        from result_store import ResultStore
+        with ResultStore(args.store) as store:
+            # 统计只用到相似度和来源字段，不必解压模板正文和分析结果
+            for _, result_data in store.scan(resolve_blobs=False):
+                aggregator.update(result_data)
+    elif args.source_dir:
+        for case_dir in get_case_dirs(args.source_dir):
+            result_file = os.path.join(case_dir, "results.json")
+            if os.path.exists(result_file):
+                aggregator.update(read_json_file(result_file))
+    else:
+        parser.error("scan 需要指定 source_dir 或 --store")
+
+    report = aggregator.report()
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        write_json_file(report, args.output)
+        print(f"报告已写入: {args.output}")
+    else:
+        json.dump(report, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# deadline.py
+
+import math
+import time
+import contextvars
+from contextlib import contextmanager
+from typing import Optional, Iterator
+
+
+class DeadlineExceeded(TimeoutError):
+    """案例或整次运行的时间预算已用完"""
+
+
+class Deadline:
+    """截止时间：seconds 为 None 表示不限时；子截止时间不会晚于父截止时间（整次运行的预算）
+
+    API 调用的超时取剩余时间与单次调用上限中的较小者，预算用完时正在进行的请求随超时中止。
+    """
+
+    def __init__(self, seconds: Optional[float], parent: Optional["Deadline"] = None, name: str = "case"):
+        self.seconds = seconds
+        self.name = name
+        self.started = time.monotonic()
+        own = self.started + seconds if seconds is not None else math.inf
+        self.parent = parent if parent is not None and parent.expires_at < own else None
+        self.expires_at = self.parent.expires_at if self.parent is not None else own
+
+    def child(self, seconds: Optional[float], name: str = "case") -> "Deadline":
+        return Deadline(seconds, parent=self, name=name)
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    @property
+    def limited_by(self) -> str:
+        """实际起作用的预算：本身的预算或父截止时间的预算"""
+        return self.parent.limited_by if self.parent is not None else self.name
+
+    def check(self, what: str = "") -> None:
+        """预算已用完时抛出 DeadlineExceeded"""
+        if self.expired():
+            raise DeadlineExceeded(f"{self.limited_by} 时间预算已用完" + (f"，跳过 {what}" if what else ""))
+
+    def call_timeout(self, cap: Optional[float], what: str = "") -> Optional[float]:
+        """单次调用的超时：剩余时间与 cap 中的较小者；预算已用完时抛出 DeadlineExceeded"""
+        self.check(what)
+        remaining = self.remaining()
+        if math.isinf(remaining):
+            return cap
+        return min(cap, remaining) if cap else remaining
+
+
+_current: contextvars.ContextVar[Optional[Deadline]] = contextvars.ContextVar("deadline", default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    """当前上下文中生效的截止时间，未设置时返回 None"""
+    return _current.get()
+
+
+@contextmanager
+def deadline_scope(deadline: Optional[Deadline]) -> Iterator[Optional[Deadline]]:
+    """在 with 块内让 API 调用使用该截止时间；deadline 为 None 时不做限制"""
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
@@ -0,0 +1,217 @@
+# endpoint_pool.py
+
+import time
+import random
+import threading
+from typing import List, Dict, Any, Optional, Callable, TypeVar
+
+from config import ENDPOINT_EJECT_AFTER_FAILURES, ENDPOINT_EJECT_SECONDS
+from metrics import API_RETRIES, usage_tokens
+from deadline import DeadlineExceeded
+
+
+T = TypeVar('T')
+
+
+class Endpoint:
+    """单个 API 端点：自己的客户端、并发上限以及观测到的延迟和错误率"""
+
+    # 指数滑动平均的平滑系数
+    EWMA_ALPHA = 0.3
+    # 尚无观测数据时假定的延迟（秒）
+    DEFAULT_LATENCY = 1.0
+
+    def __init__(self, name: str, base_url: str, api_key: Optional[str], model: str,
+                 weight: float = 1.0, max_concurrency: int = 8, client: Any = None):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.weight = max(float(weight), 0.0)
+        self.max_concurrency = max(int(max_concurrency), 1)
+        self.client = client
+
+        self.semaphore = threading.BoundedSemaphore(self.max_concurrency)
+        self.in_flight = 0
+        self.ewma_latency: Optional[float] = None
+        self.ewma_error = 0.0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.total_requests = 0
+        self.total_failures = 0
+
+    def is_available(self, now: float) -> bool:
+        """未被剔除（或剔除已到期）"""
+        return now >= self.ejected_until
+
+    def score(self, default_latency: float = DEFAULT_LATENCY) -> float:
+        """路由得分：权重越高、延迟越低、错误率越低、越空闲，得分越高"""
+        latency = self.ewma_latency if self.ewma_latency is not None else default_latency
+        load = 1.0 + self.in_flight / self.max_concurrency
+        return self.weight / (max(latency, 1e-3) * (1.0 + 4.0 * self.ewma_error) * load)
+
+    def record(self, latency: float, success: bool) -> None:
+        """记录一次调用结果"""
+        self.total_requests += 1
+        # 快速失败的耗时不代表端点的真实延迟，只用成功请求更新延迟
+        if success:
+            if self.ewma_latency is None:
+                self.ewma_latency = latency
+            else:
+                self.ewma_latency += self.EWMA_ALPHA * (latency - self.ewma_latency)
+        self.ewma_error += self.EWMA_ALPHA * ((0.0 if success else 1.0) - self.ewma_error)
+
+        if success:
+            self.consecutive_failures = 0
+        else:
+            self.total_failures += 1
+            self.consecutive_failures += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'base_url': self.base_url,
+            'model': self.model,
+            'weight': self.weight,
+            'in_flight': self.in_flight,
+            'ewma_latency_ms': round(self.ewma_latency * 1000, 1) if self.ewma_latency is not None else None,
+            'error_rate': round(self.ewma_error, 3),
+            'requests': self.total_requests,
+            'failures': self.total_failures,
+            'ejected': time.time() < self.ejected_until
+        }
+
+
+class EndpointPool:
+    """端点池：按观测延迟和错误率路由请求，连续失败的端点会被暂时剔除"""
+
+    def __init__(self, endpoints: List[Endpoint], eject_after: int = ENDPOINT_EJECT_AFTER_FAILURES,
+                 eject_seconds: float = ENDPOINT_EJECT_SECONDS):
+        if not endpoints:
+            raise ValueError("端点池至少需要一个端点")
+        self.endpoints = endpoints
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+
+    def _choose(self, exclude: List[Endpoint]) -> Endpoint:
+        """选择端点：优先有空闲并发的健康端点，按得分加权随机"""
+        now = time.time()
+        candidates = [e for e in self.endpoints if e not in exclude and e.weight > 0] or \
+            [e for e in self.endpoints if e not in exclude] or list(self.endpoints)
+        healthy = [e for e in candidates if e.is_available(now)]
+        if not healthy:
+            # 全部被剔除时不让请求饿死，选最早恢复的端点试探
+            return min(candidates, key=lambda e: e.ejected_until)
+
+        # 尚无观测的端点按已观测的最低延迟乐观估计，保证新端点能分到流量
+        observed = [e.ewma_latency for e in healthy if e.ewma_latency is not None]
+        default_latency = min(observed) if observed else Endpoint.DEFAULT_LATENCY
+
+        idle = [e for e in healthy if e.in_flight < e.max_concurrency]
+        if not idle:
+            return max(healthy, key=lambda e: e.score(default_latency))
+        return random.choices(idle, weights=[e.score(default_latency) for e in idle], k=1)[0]
+
+    def _release(self, endpoint: Endpoint, latency: float, success: bool) -> None:
+        with self._lock:
+            endpoint.in_flight -= 1
+            endpoint.record(latency, success)
+            if not success and endpoint.consecutive_failures >= self.eject_after:
+                endpoint.ejected_until = time.time() + self.eject_seconds
+                endpoint.consecutive_failures = 0
+                print(f"端点 {endpoint.name} 连续失败 {self.eject_after} 次，剔除 {self.eject_seconds} 秒")
+
+    def call_endpoint(self, endpoint: Endpoint, fn: Callable[[Endpoint], T]) -> T:
+        """在指定端点上执行 fn 并记录结果"""
+        with self._lock:
+            endpoint.in_flight += 1
+
+        endpoint.semaphore.acquire()
+        start = time.perf_counter()
+        try:
+            result = fn(endpoint)
+        except DeadlineExceeded:
+            # 调用方的时间预算用完而中止的请求不反映端点健康状况，不计入统计
+            endpoint.semaphore.release()
+            with self._lock:
+                endpoint.in_flight -= 1
+            raise
+        except Exception:
+            endpoint.semaphore.release()
+            self._release(endpoint, time.perf_counter() - start, False)
+            raise
+
+        endpoint.semaphore.release()
+        self._release(endpoint, time.perf_counter() - start, True)
+        return result
+
+    def call(self, fn: Callable[[Endpoint], T], max_attempts: Optional[int] = None) -> T:
+        """在选中的端点上执行 fn，失败后换一个端点重试，全部失败时抛出最后一个异常；时间预算用完时不再重试"""
+        attempts = max_attempts or len(self.endpoints)
+        tried: List[Endpoint] = []
+        last_error: Optional[Exception] = None
+
+        for _ in range(attempts):
+            with self._lock:
+                endpoint = self._choose(tried)
+            if tried:
+                API_RETRIES.inc()
+            tried.append(endpoint)
+            try:
+                return self.call_endpoint(endpoint, fn)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                last_error = e
+                print(f"端点 {endpoint.name} 调用失败: {e}")
+
+        raise last_error if last_error else RuntimeError("没有可用的端点")
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [e.snapshot() for e in self.endpoints]
+
+
+class ModelMetrics:
+    """按（阶段, 模型）记录请求数、失败数、延迟和 token 用量（含提示缓存命中），用于比较不同模型在各阶段的表现"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records: Dict[tuple, Dict[str, Any]] = {}
+
+    def record(self, stage: str, model: str, latency: float, success: bool, usage: Any = None) -> None:
+        tokens = usage_tokens(usage) if usage is not None else {}
+        with self._lock:
+            record = self._records.setdefault((stage, model), {
+                'requests': 0, 'failures': 0, 'total_latency': 0.0, 'max_latency': 0.0,
+                'prompt': 0, 'completion': 0, 'cached': 0
+            })
+            record['requests'] += 1
+            for kind, value in tokens.items():
+                record[kind] += value
+            if success:
+                record['total_latency'] += latency
+                record['max_latency'] = max(record['max_latency'], latency)
+            else:
+                record['failures'] += 1
+
+    def stats(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            items = sorted(self._records.items())
+        result = []
+        for (stage, model), record in items:
+            successes = record['requests'] - record['failures']
+            result.append({
+                'stage': stage,
+                'model': model,
+                'requests': record['requests'],
+                'failures': record['failures'],
+                'success_rate': round(successes / record['requests'], 3) if record['requests'] else 0.0,
+                'avg_latency_ms': round(record['total_latency'] / successes * 1000, 1) if successes else None,
+                'max_latency_ms': round(record['max_latency'] * 1000, 1) if successes else None,
+                'prompt_tokens': record['prompt'],
+                'completion_tokens': record['completion'],
+                'cached_tokens': record['cached'],
+                'cached_ratio': round(record['cached'] / record['prompt'], 3) if record['prompt'] else 0.0
+            })
+        return result
@@ -0,0 +1,199 @@
+# generation_cache.py
+
+import os
+import re
+import json
+import time
+import hashlib
+from collections import defaultdict
+from typing import List, Dict, Any, Optional, Tuple
+
+from config import GENERATION_CACHE_TOLERANCE, GENERATION_CACHE_PATH
+from template_library import tokenize
+from metrics import CACHE_LOOKUPS
+
+
+def _terms(text: str) -> set:
+    """提取词集合，并做简单的单复数归一"""
+    terms = set()
+    for word in tokenize(text):
+        if word.endswith('ies') and len(word) > 4:
+            word = word[:-3] + 'y'
+        elif word.endswith('s') and not word.endswith('ss') and len(word) > 3:
+            word = word[:-1]
+        terms.add(word)
+    return terms
+
+
+def _jaccard(a: set, b: set) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def _slot_list(match: Optional[re.Match]) -> List[str]:
+    """把逗号分隔的槽位值整理成有序的小写列表"""
+    if not match:
+        return []
+    return sorted(item.strip().lower() for item in match.group(1).split(',') if item.strip())
+
+
+class ApproximateGenerationCache:
+    """近似生成缓存：把仿写 prompt 归一化为结构槽位，槽位在容差内匹配时复用已生成的段落
+
+    槽位包括主题、上下文、句子数、句子类型、连接词、核心概念、逻辑流向、论证方向以及是否高权重。
+    逻辑流向、论证方向、句子类型和高权重标记必须完全一致；主题、上下文、连接词和核心概念按词集合的
+    Jaccard 相似度比较，句子数允许相差 tolerance 比例。同一案例生成的段落不会复用到该案例的其他模板上。
+    只适合可以接受复用的批量草稿生成。
+    """
+
+    def __init__(self, tolerance: float = GENERATION_CACHE_TOLERANCE, path: Optional[str] = GENERATION_CACHE_PATH,
+                 max_entries_per_bucket: int = 200):
+        self.tolerance = tolerance
+        self.path = path
+        self.max_entries_per_bucket = max_entries_per_bucket
+        # (logical_flow, argument_direction, sentence_types, high_weight) -> [entry, ...]
+        self.buckets: Dict[Tuple[str, str, Tuple[str, ...], bool], List[Dict[str, Any]]] = defaultdict(list)
+        self.hits = 0
+        self.misses = 0
+
+        if path and os.path.exists(path):
+            self._load()
+
+    @staticmethod
+    def extract_slots(prompt: str) -> Dict[str, Any]:
+        """从 PromptGenerator 生成的仿写 prompt 中提取结构槽位"""
+        topic = re.search(r'^Topic: (.+)$', prompt, re.MULTILINE)
+        context = re.search(r'^Context: (.*)\Z', prompt, re.MULTILINE | re.DOTALL)
+        count = re.search(r'approximately (\d+) sentences', prompt)
+        count_range = re.search(r'Write (\d+)-(\d+) sentences', prompt)
+        sentence_types = re.search(r'Include sentence types: (.*)', prompt)
+        connectives = re.search(r'connective words like: (.*)', prompt)
+        core_concepts = re.search(r'Focus on these core concepts: (.*)', prompt)
+        flow = re.search(r'Follow (\S+) logical flow', prompt)
+        direction = re.search(r'Maintain (\S+) argument direction', prompt)
+
+        if count:
+            sentence_count = int(count.group(1))
+        elif count_range:
+            sentence_count = (int(count_range.group(1)) + int(count_range.group(2))) // 2
+        else:
+            sentence_count = 0
+
+        return {
+            'topic': topic.group(1).strip() if topic else '',
+            'context': context.group(1).strip() if context else '',
+            'sentence_count': sentence_count,
+            'sentence_types': _slot_list(sentence_types),
+            'connectives': _slot_list(connectives),
+            'core_concepts': _slot_list(core_concepts),
+            'logical_flow': flow.group(1) if flow else '',
+            'argument_direction': direction.group(1) if direction else '',
+            'high_weight': 'High Priority Template' in prompt
+        }
+
+    @staticmethod
+    def _bucket_key(slots: Dict[str, Any]) -> Tuple[str, str, Tuple[str, ...], bool]:
+        return (slots['logical_flow'], slots['argument_direction'], tuple(slots['sentence_types']),
+                slots['high_weight'])
+
+    def _similarity(self, slots: Dict[str, Any], topic_terms: set, context_terms: set,
+                    entry: Dict[str, Any]) -> Optional[float]:
+        """在容差内时返回槽位平均相似度，否则返回 None"""
+        cached = entry['slots']
+        a, b = slots['sentence_count'], cached['sentence_count']
+        if abs(a - b) > round(self.tolerance * max(a, b)):
+            return None
+
+        threshold = 1.0 - self.tolerance
+        scores = [
+            _jaccard(entry['topic_terms'], topic_terms),
+            _jaccard(entry['context_terms'], context_terms),
+            _jaccard(set(cached['connectives']), set(slots['connectives'])),
+            _jaccard(_terms(' '.join(cached['core_concepts'])), _terms(' '.join(slots['core_concepts'])))
+        ]
+        if min(scores) < threshold:
+            return None
+        return sum(scores) / len(scores)
+
+    def lookup(self, prompt: str, exclude_origin: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """查找可复用的段落，返回 {'paragraph', 'provenance'}，未命中返回 None；
+        来源为 exclude_origin 的条目（通常是当前案例）不参与匹配"""
+        slots = self.extract_slots(prompt)
+        prompt_hash = hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:16]
+        topic_terms, context_terms = _terms(slots['topic']), _terms(slots['context'])
+
+        best, best_score = None, -1.0
+        for entry in self.buckets.get(self._bucket_key(slots), []):
+            if exclude_origin and entry.get('origin') == exclude_origin:
+                continue
+            if entry['id'] == prompt_hash:
+                best, best_score = entry, 1.0
+                break
+            score = self._similarity(slots, topic_terms, context_terms, entry)
+            if score is not None and score > best_score:
+                best, best_score = entry, score
+
+        if best is None:
+            self.misses += 1
+            CACHE_LOOKUPS.inc(cache="generation", result="miss")
+            return None
+
+        self.hits += 1
+        CACHE_LOOKUPS.inc(cache="generation", result="hit")
+        return {
+            'paragraph': best['paragraph'],
+            'provenance': {
+                'source': 'approximate_cache',
+                'cache_entry': best['id'],
+                'origin': best.get('origin', ''),
+                'similarity': round(best_score, 3),
+                'tolerance': self.tolerance
+            }
+        }
+
+    def store(self, prompt: str, paragraph: str, origin: str = "") -> None:
+        """保存新生成的段落"""
+        if not paragraph:
+            return
+        slots = self.extract_slots(prompt)
+        record = {
+            'id': hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:16],
+            'slots': slots,
+            'paragraph': paragraph,
+            'origin': origin,
+            'created_at': time.time()
+        }
+        self._add(record)
+
+        if self.path:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def _add(self, record: Dict[str, Any]) -> None:
+        entry = dict(record)
+        entry['topic_terms'] = _terms(record['slots']['topic'])
+        entry['context_terms'] = _terms(record['slots']['context'])
+        bucket = self.buckets[self._bucket_key(record['slots'])]
+        bucket.append(entry)
+        if len(bucket) > self.max_entries_per_bucket:
+            bucket.pop(0)
+
+    def _load(self) -> None:
+        # 缺少槽位的旧条目（KeyError）直接跳过
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    self._add(json.loads(line))
+                except (json.JSONDecodeError, KeyError):
+                    continue
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            'entries': sum(len(bucket) for bucket in self.buckets.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0
+        }
@@ -0,0 +1,131 @@
+# hedging.py
+
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Dict, Any, Optional, Callable, TypeVar
+
+from config import HEDGE_ENABLED, HEDGE_PERCENTILE, HEDGE_BUDGET_RATIO, HEDGE_MIN_SAMPLES, HEDGE_MAX_WORKERS
+
+
+T = TypeVar('T')
+
+
+class StageLatencyTracker:
+    """按阶段（analysis / generation）记录最近的请求延迟"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self.samples: Dict[str, deque] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.samples.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+
+    def percentile(self, stage: str, q: float, min_samples: int = 1) -> Optional[float]:
+        """返回阶段延迟的 q 分位数，样本不足时返回 None"""
+        with self._lock:
+            values = sorted(self.samples.get(stage, []))
+        if len(values) < max(min_samples, 1):
+            return None
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class HedgingPolicy:
+    """对冲请求：请求超过该阶段近期延迟的指定分位数仍未返回时，再发一个副本，先返回者胜出
+
+    对冲总数不超过主请求数的 budget_ratio 倍。落败的请求若尚未开始则直接取消，
+    已在执行的同步 HTTP 请求无法中途打断，其结果会被丢弃。
+    """
+
+    def __init__(self, enabled: bool = HEDGE_ENABLED, percentile: float = HEDGE_PERCENTILE,
+                 budget_ratio: float = HEDGE_BUDGET_RATIO, min_samples: int = HEDGE_MIN_SAMPLES,
+                 max_workers: int = HEDGE_MAX_WORKERS):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.budget_ratio = budget_ratio
+        self.min_samples = min_samples
+        self.latency = StageLatencyTracker()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hedge") if enabled else None
+        self._lock = threading.Lock()
+
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+        self.cancelled = 0
+
+    def hedge_delay(self, stage: str) -> Optional[float]:
+        """该阶段的对冲触发延迟，样本不足时不对冲"""
+        return self.latency.percentile(stage, self.percentile, self.min_samples)
+
+    def _acquire_budget(self) -> bool:
+        with self._lock:
+            if self.hedges + 1 > self.budget_ratio * self.requests:
+                self.budget_denied += 1
+                return False
+            self.hedges += 1
+            return True
+
+    def run(self, stage: str, fn: Callable[[], T]) -> T:
+        """执行 fn，必要时发出对冲副本"""
+        with self._lock:
+            self.requests += 1
+        start = time.perf_counter()
+
+        delay = self.hedge_delay(stage) if self.enabled else None
+        if delay is None:
+            result = fn()
+            self.latency.record(stage, time.perf_counter() - start)
+            return result
+
+        primary = self._executor.submit(fn)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._acquire_budget():
+            result = primary.result()
+            self.latency.record(stage, time.perf_counter() - start)
+            return result
+
+        hedge = self._executor.submit(fn)
+        pending = {primary, hedge}
+        last_error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if error is not None:
+                    last_error = error
+                    continue
+                self._finish(future, hedge, pending)
+                self.latency.record(stage, time.perf_counter() - start)
+                return future.result()
+
+        raise last_error
+
+    def _finish(self, winner: Future, hedge: Future, pending: set) -> None:
+        """记录胜者并取消落败请求"""
+        with self._lock:
+            if winner is hedge:
+                self.hedge_wins += 1
+            for future in pending:
+                if future.cancel():
+                    self.cancelled += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            'requests': self.requests,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'hedge_rate': round(self.hedges / self.requests, 3) if self.requests else 0.0,
+            'win_rate': round(self.hedge_wins / self.hedges, 3) if self.hedges else 0.0,
+            'budget_denied': self.budget_denied,
+            'cancelled_before_start': self.cancelled,
+            'hedge_delay_ms': {
+                stage: round(delay * 1000, 1)
+                for stage in list(self.latency.samples)
+                for delay in [self.hedge_delay(stage)] if delay is not None
+            }
+        }
@@ -0,0 +1,261 @@
+# job_queue.py
+
+import os
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Iterator
+
+from config import JOB_QUEUE_PATH, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_POLL_SECONDS, SOURCE_DIR
+from utils import get_case_dirs
+
+
+def default_worker_id() -> str:
+    """主机名加进程号，保证多机多进程下唯一"""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class JobQueue:
+    """基于 SQLite 的持久化案例队列：案例只入队一次，任意多个 worker 以限时租约领取
+
+    worker 需要在租约到期前续约（heartbeat），worker 崩溃后租约过期，案例会被其他 worker 重新领取。
+    失败的案例最多尝试 max_attempts 次。放在共享文件系统上即可多机共用；
+    SQLite 依赖文件锁，NFS 等网络文件系统需要支持 POSIX 锁。
+    """
+
+    PENDING = "pending"
+    LEASED = "leased"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, path: str = JOB_QUEUE_PATH, lease_seconds: float = JOB_LEASE_SECONDS,
+                 max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " case_dir TEXT PRIMARY KEY,"
+                " status TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " worker TEXT,"
+                " lease_expires REAL,"
+                " enqueued_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " error TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_expires)")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        # isolation_level=None：由代码显式控制事务，领取时用 BEGIN IMMEDIATE 抢写锁
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def enqueue(self, case_dirs: List[str]) -> int:
+        """入队案例，已存在的案例忽略；返回新入队数量"""
+        now = time.time()
+        with self._connect() as conn:
+            before = conn.total_changes
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT OR IGNORE INTO jobs (case_dir, status, enqueued_at, updated_at) VALUES (?, ?, ?, ?)",
+                [(os.path.abspath(d), self.PENDING, now, now) for d in case_dirs]
+            )
+            conn.execute("COMMIT")
+            return conn.total_changes - before
+
+    def claim(self, worker_id: str) -> Optional[str]:
+        """领取一个待处理或租约已过期的案例，没有可领取的案例时返回 None"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 租约过期且已用完尝试次数的案例直接标记为失败
+                conn.execute(
+                    "UPDATE jobs SET status = ?, error = ?, worker = NULL, updated_at = ?"
+                    " WHERE status = ? AND lease_expires < ? AND attempts >= ?",
+                    (self.FAILED, "租约过期且已达到最大尝试次数", now, self.LEASED, now, self.max_attempts)
+                )
+                row = conn.execute(
+                    "SELECT case_dir FROM jobs WHERE status = ? OR (status = ? AND lease_expires < ?)"
+                    " ORDER BY attempts, rowid LIMIT 1",
+                    (self.PENDING, self.LEASED, now)
+                ).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                conn.execute(
+                    "UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, attempts = attempts + 1,"
+                    " updated_at = ? WHERE case_dir = ?",
+                    (self.LEASED, worker_id, now + self.lease_seconds, now, row['case_dir'])
+                )
+                conn.execute("COMMIT")
+                return row['case_dir']
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _update_owned(self, case_dir: str, worker_id: str, sql: str, params: tuple) -> bool:
+        """只在租约仍归该 worker 所有时更新，返回是否更新成功"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"UPDATE jobs SET {sql}, updated_at = ? WHERE case_dir = ? AND worker = ? AND status = ?",
+                params + (time.time(), case_dir, worker_id, self.LEASED)
+            )
+            return cursor.rowcount == 1
+
+    def heartbeat(self, case_dir: str, worker_id: str) -> bool:
+        """续约；租约已被他人接管时返回 False"""
+        return self._update_owned(case_dir, worker_id, "lease_expires = ?", (time.time() + self.lease_seconds,))
+
+    def complete(self, case_dir: str, worker_id: str) -> bool:
+        """标记案例完成"""
+        return self._update_owned(case_dir, worker_id, "status = ?, worker = NULL, lease_expires = NULL, error = NULL",
+                                  (self.DONE,))
+
+    def fail(self, case_dir: str, worker_id: str, error: str = "") -> bool:
+        """标记案例失败：未达到最大尝试次数时放回队列"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT attempts FROM jobs WHERE case_dir = ?", (case_dir,)).fetchone()
+        status = self.FAILED if row is None or row['attempts'] >= self.max_attempts else self.PENDING
+        return self._update_owned(case_dir, worker_id, "status = ?, worker = NULL, lease_expires = NULL, error = ?",
+                                  (status, error[:500]))
+
+    def requeue(self, include_failed: bool = False) -> int:
+        """把租约已过期的案例（以及可选的失败案例）放回队列，返回数量"""
+        now = time.time()
+        statuses = [self.LEASED, self.FAILED] if include_failed else [self.LEASED]
+        with self._connect() as conn:
+            cursor = conn.execute(
+                f"UPDATE jobs SET status = ?, worker = NULL, lease_expires = NULL, attempts = 0, updated_at = ?"
+                f" WHERE status IN ({','.join('?' * len(statuses))}) AND (lease_expires IS NULL OR lease_expires < ?)",
+                (self.PENDING, now, *statuses, now)
+            )
+            return cursor.rowcount
+
+    def status(self) -> Dict[str, Any]:
+        """队列状态：各状态的案例数、当前租约和失败案例"""
+        now = time.time()
+        with self._connect() as conn:
+            counts = {self.PENDING: 0, self.LEASED: 0, self.DONE: 0, self.FAILED: 0}
+            for row in conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status"):
+                counts[row['status']] = row['n']
+            leases = [
+                {'case_dir': row['case_dir'], 'worker': row['worker'], 'attempts': row['attempts'],
+                 'expires_in': round(row['lease_expires'] - now, 1)}
+                for row in conn.execute("SELECT * FROM jobs WHERE status = ? ORDER BY lease_expires", (self.LEASED,))
+            ]
+            failed = [
+                {'case_dir': row['case_dir'], 'attempts': row['attempts'], 'error': row['error']}
+                for row in conn.execute("SELECT * FROM jobs WHERE status = ?", (self.FAILED,))
+            ]
+        counts['expired_leases'] = sum(1 for lease in leases if lease['expires_in'] < 0)
+        return {'counts': counts, 'total': sum(counts[s] for s in (self.PENDING, self.LEASED, self.DONE, self.FAILED)),
+                'leases': leases, 'failed': failed}
+
+    def jobs(self, worker_id: str, drain: bool = False, poll_seconds: float = JOB_POLL_SECONDS) -> Iterator[str]:
+        """持续领取案例
+
+        drain=True 时队列中既没有待处理也没有处理中的案例就退出；否则一直轮询等待新入队的案例。
+        其他 worker 的租约尚未过期时会等待，以便接管崩溃 worker 的案例。
+        """
+        while True:
+            case_dir = self.claim(worker_id)
+            if case_dir is not None:
+                yield case_dir
+                continue
+            counts = self.status()['counts']
+            if drain and counts[self.PENDING] == 0 and counts[self.LEASED] == 0:
+                return
+            time.sleep(poll_seconds)
+
+
+class LeaseKeeper:
+    """后台线程定期续约，处理案例期间保持租约有效"""
+
+    def __init__(self, queue: JobQueue, case_dir: str, worker_id: str):
+        self.queue = queue
+        self.case_dir = case_dir
+        self.worker_id = worker_id
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="lease-heartbeat", daemon=True)
+
+    def _run(self) -> None:
+        interval = max(self.queue.lease_seconds / 3, 1.0)
+        while not self._stop.wait(interval):
+            try:
+                if not self.queue.heartbeat(self.case_dir, self.worker_id):
+                    print(f"  警告: 案例 {self.case_dir} 的租约已被接管")
+                    self.lost = True
+                    return
+            except sqlite3.Error as e:
+                print(f"  续约失败，稍后重试: {e}")
+
+    def held(self) -> bool:
+        """立即续约一次，确认租约仍归本 worker 所有；数据库暂时不可用时以心跳线程的结论为准"""
+        if not self.lost:
+            try:
+                if not self.queue.heartbeat(self.case_dir, self.worker_id):
+                    print(f"  警告: 案例 {self.case_dir} 的租约已被接管")
+                    self.lost = True
+            except sqlite3.Error as e:
+                print(f"  确认租约失败: {e}")
+        return not self.lost
+
+    def __enter__(self) -> "LeaseKeeper":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def main() -> None:
+    """命令行入口：入队、查看状态、重新入队；worker 通过 python main.py --queue 启动"""
+    parser = argparse.ArgumentParser(description="案例任务队列")
+    parser.add_argument("--queue", default=JOB_QUEUE_PATH, help="队列数据库路径（放在共享文件系统上供多机使用）")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="扫描源目录并入队所有案例")
+    enqueue_parser.add_argument("source_dir", nargs="?", default=SOURCE_DIR, help="案例源目录")
+
+    subparsers.add_parser("status", help="查看队列状态")
+
+    requeue_parser = subparsers.add_parser("requeue", help="把租约过期的案例放回队列")
+    requeue_parser.add_argument("--failed", action="store_true", help="同时放回失败的案例")
+
+    args = parser.parse_args()
+    queue = JobQueue(args.queue)
+
+    if args.command == "enqueue":
+        case_dirs = get_case_dirs(args.source_dir)
+        print(f"新入队 {queue.enqueue(case_dirs)}/{len(case_dirs)} 个案例")
+    elif args.command == "requeue":
+        print(f"已放回队列 {queue.requeue(include_failed=args.failed)} 个案例")
+    else:
+        status = queue.status()
+        counts = status['counts']
+        print(f"共 {status['total']} 个案例：待处理 {counts['pending']}，处理中 {counts['leased']}"
+              f"（租约过期 {counts['expired_leases']}），完成 {counts['done']}，失败 {counts['failed']}")
+        for lease in status['leases']:
+            print(f"  [处理中] {lease['case_dir']} worker={lease['worker']} 第 {lease['attempts']} 次，"
+                  f"租约剩余 {lease['expires_in']} 秒")
+        for job in status['failed']:
+            print(f"  [失败] {job['case_dir']} 尝试 {job['attempts']} 次: {job['error']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+# local_upstream.py
+
+import re
+import time
+import hashlib
+from typing import List, Dict, Any, Optional
+
+from template_analyzer import EnglishTemplateAnalyzer
+from prompt_generator import extract_analysis_paragraph
+
+
+class LocalUpstreamClient:
+    """本地替身上游：接口与 OpenAIClient 一致，不访问网络
+
+    分析请求由 EnglishTemplateAnalyzer 在本地完成，生成请求返回确定性的占位段落，
+    可通过 latency_ms / per_item_ms 模拟上游的固定延迟和按任务计的延迟。
+    """
+
+    def __init__(self, latency_ms: float = 0.0, per_item_ms: float = 0.0):
+        self.analyzer = EnglishTemplateAnalyzer()
+        self.model_id = "local-stand-in"
+        self.latency_ms = latency_ms
+        self.per_item_ms = per_item_ms
+        self.call_count = 0
+
+    def _simulate_latency(self, items: int) -> None:
+        """模拟一次上游调用的耗时"""
+        self.call_count += 1
+        delay = (self.latency_ms + self.per_item_ms * items) / 1000.0
+        if delay > 0:
+            time.sleep(delay)
+
+    def _analyze(self, prompt: str) -> Dict:
+        text = extract_analysis_paragraph(prompt)
+        return {
+            'discourse_structure': self.analyzer.analyze_discourse_structure(text),
+            'content_structure': self.analyzer.analyze_content_structure(text)
+        }
+
+    def _generate(self, prompt: str) -> str:
+        topic_match = re.search(r'^Topic: (.+)$', prompt, re.MULTILINE)
+        topic = topic_match.group(1).strip() if topic_match else "the topic"
+        count_match = re.search(r'approximately (\d+) sentences', prompt)
+        sentence_count = max(1, min(int(count_match.group(1)), 8)) if count_match else 3
+
+        openings = [
+            f"{topic} has become a central concern for modern organizations.",
+            "However, progress depends on balancing innovation with stability.",
+            "For example, teams that adopt new tools gradually tend to report fewer disruptions.",
+            "Moreover, clear strategy helps leaders turn challenges into opportunities.",
+            "Therefore, a deliberate plan is essential for long-term success.",
+            "In addition, continuous learning keeps the approach relevant.",
+            "Nevertheless, every organization must adapt the plan to its own context.",
+            "In conclusion, thoughtful execution determines the final outcome."
+        ]
+        # 以提示的哈希作为偏移，使不同提示得到不同但可复现的结果
+        offset = int(hashlib.md5(prompt.encode('utf-8')).hexdigest(), 16) % 3
+        sentences = [openings[0]] + openings[1 + offset:][:sentence_count - 1]
+        return ' '.join(sentences[:sentence_count])
+
+    def analyze_template(self, prompt: str, max_tokens: Optional[int] = None) -> Dict:
+        """分析模板结构"""
+        self._simulate_latency(1)
+        return self._analyze(prompt)
+
+    def generate_paragraph(self, prompt: str, max_tokens: Optional[int] = None, high_weight: bool = False) -> str:
+        """生成仿写段落"""
+        self._simulate_latency(1)
+        return self._generate(prompt)
+
+    def analyze_templates_packed(self, prompts: List[str]) -> List[Dict]:
+        """打包分析：一次模拟调用完成多个任务"""
+        self._simulate_latency(len(prompts))
+        return [self._analyze(p) for p in prompts]
+
+    def generate_paragraphs_packed(self, prompts: List[str]) -> List[str]:
+        """打包生成：一次模拟调用完成多个任务"""
+        self._simulate_latency(len(prompts))
+        return [self._generate(p) for p in prompts]
+
+    def batch_process(self, prompts: List[str], process_type: str) -> List[Any]:
+        """批量处理多个提示"""
+        if process_type == "analysis":
+            return self.analyze_templates_packed(prompts)
+        return self.generate_paragraphs_packed(prompts)
+
+    def test_connection(self) -> bool:
+        """本地替身始终可用"""
+        return True
+
+    def get_available_models(self) -> List[str]:
+        """获取可用的模型列表"""
+        return [self.model_id]
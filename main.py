@@ -1,26 +1,62 @@
 # main.py
 
 import os
+import copy
 import json
-from typing import List, Dict, Any
-from config import SOURCE_DIR
-from utils import read_text_file, write_json_file, get_case_dirs
+import time
+import argparse
+from typing import List, Dict, Any, Optional
+from config import (SOURCE_DIR, TEMPLATE_LIBRARY_DIR, TEMPLATE_LIBRARY_TOP_K, DEDUP_ENABLED,
+                    GENERATION_CACHE_ENABLED, PROFILE_DIR, CORPUS_REPORT_DIR,
+                    METRICS_PORT, METRICS_SNAPSHOT_PATH, CASE_DEADLINE_SECONDS, RUN_DEADLINE_SECONDS,
+                    SPECULATIVE_GENERATION, RESULT_STORE_DIR)
+from utils import read_text_file, write_json_file, get_case_dirs, extract_template_text
 from template_analyzer import EnglishTemplateAnalyzer
 from prompt_generator import PromptGenerator
 from result_processor import ResultProcessor
 from api_client import OpenAIClient  # 导入 OpenAIClient
-
-
-def process_case(case_dir: str, client: OpenAIClient) -> None:
-    """处理单个案例"""
+from template_library import TemplateLibrary
+from template_dedup import TemplateDeduplicator, SharedAnalysisPool
+from token_budget import count_tokens, analysis_max_tokens, generation_max_tokens
+from generation_cache import ApproximateGenerationCache
+from profiling import RunProfiler, NULL_PROFILER
+from corpus_stats import CorpusAggregator
+from job_queue import JobQueue, LeaseKeeper, default_worker_id
+from cassette import Cassette
+from metrics import MetricsExporter, CASES, CASE_SECONDS
+from circuit_breaker import CircuitOpenError
+from retry_queue import RetryQueue
+from deadline import Deadline, DeadlineExceeded, current_deadline, deadline_scope
+from speculative import SpeculativeGenerator
+from result_store import ResultStore
+
+
+def process_case(case_dir: str, client: OpenAIClient, library: Optional[TemplateLibrary] = None,
+                 generation_cache: Optional[ApproximateGenerationCache] = None,
+                 profiler=NULL_PROFILER, retry_queue: Optional[RetryQueue] = None,
+                 speculator: Optional[SpeculativeGenerator] = None,
+                 result_store: Optional[ResultStore] = None,
+                 analysis_pool: Optional[SharedAnalysisPool] = None,
+                 lease: Optional[LeaseKeeper] = None) -> Optional[Dict[str, Any]]:
+    """处理单个案例并返回结果数据（失败时返回 None）；案例目录中没有 template*.json 时从模板库检索模板，
+    传入 generation_cache 时优先复用近似匹配的已生成段落，传入 profiler 时按步骤分阶段剖析。
+    熔断期间的本地分析和被推迟的生成会在结果的 degraded 字段中标记，并记入 retry_queue。
+    在 deadline_scope 中调用时按其截止时间限制 API 调用，预算用完时跳过剩余调用，写出部分结果并标记 status=timed_out。
+    传入 speculator 时在上游分析的同时用本地分析推测生成，分析返回后结构一致的推测段落直接采用；
+    传入 result_store 时结果写入分片存储（以案例目录名为键），不再写 results.json；
+    传入 analysis_pool 时近重复模板跨案例共享分析结果（同簇已有分析时不再调用 API），否则只在案例内去重；
+    传入 lease 时保存前确认租约仍归本 worker 所有，已被接管时不写出结果并返回 None"""
     case_name = os.path.basename(case_dir)
     print(f"\n{'=' * 50}")
     print(f"开始处理案例: {case_name}")
     print(f"案例路径: {case_dir}")
     print(f"{'=' * 50}")
 
+    # 已开始但尚未采用的推测生成；案例以任何方式结束时都要丢弃剩余的
+    speculations = {}
     try:
         # 读取输入数据
+        profiler.switch("read_input")
         print("\n[步骤1] 读取输入数据...")
 
         print("  读取 context.txt...")
@@ -59,35 +95,51 @@ def process_case(case_dir: str, client: OpenAIClient) -> None:
             return
 
         # 读取模板
+        profiler.switch("read_templates")
         print("\n[步骤2] 读取模板文件...")
         templates = []
-        for i in range(1, 5):
-            template_file = os.path.join(case_dir, f"template{i}.json")
-            print(f"  读取 template{i}.json...")
-            print(f"    文件路径: {template_file}")
-
-            if not os.path.exists(template_file):
-                print(f"    错误: template{i}.json 不存在")
-                return
-
-            try:
-                template_content = read_text_file(template_file)
-                print(f"    成功读取，长度: {len(template_content)} 字符")
-
-                # 验证是否为有效 JSON
-                json.loads(template_content)
-                templates.append(template_content)
-                print(f"    JSON 格式验证通过")
-            except json.JSONDecodeError as e:
-                print(f"    错误: template{i}.json 不是有效的 JSON 格式: {e}")
-                return
-            except Exception as e:
-                print(f"    错误: 读取 template{i}.json 失败: {e}")
+        use_library = library is not None and not os.path.exists(os.path.join(case_dir, "template1.json"))
+        if use_library:
+            print(f"  案例中没有模板文件，从模板库检索 (共 {len(library)} 个模板)...")
+            retrieve_start = time.perf_counter()
+            records = library.retrieve_for_case(topic, context, k=TEMPLATE_LIBRARY_TOP_K)
+            elapsed_ms = (time.perf_counter() - retrieve_start) * 1000
+            print(f"  检索到 {len(records)} 个模板，耗时 {elapsed_ms:.2f} ms")
+            for record in records:
+                print(f"    {record['id']} (得分: {record['score']}) {record['text'][:60]}...")
+                templates.append(record['content'])
+            if not templates:
+                print("    错误: 模板库中没有相关模板")
                 return
+        else:
+            for i in range(1, 5):
+                template_file = os.path.join(case_dir, f"template{i}.json")
+                print(f"  读取 template{i}.json...")
+                print(f"    文件路径: {template_file}")
+
+                if not os.path.exists(template_file):
+                    print(f"    错误: template{i}.json 不存在")
+                    return
+
+                try:
+                    template_content = read_text_file(template_file)
+                    print(f"    成功读取，长度: {len(template_content)} 字符")
+
+                    # 验证是否为有效 JSON
+                    json.loads(template_content)
+                    templates.append(template_content)
+                    print(f"    JSON 格式验证通过")
+                except json.JSONDecodeError as e:
+                    print(f"    错误: template{i}.json 不是有效的 JSON 格式: {e}")
+                    return
+                except Exception as e:
+                    print(f"    错误: 读取 template{i}.json 失败: {e}")
+                    return
 
         print(f"  成功读取 {len(templates)} 个模板文件")
 
         # 初始化组件
+        profiler.switch("init_components")
         print("\n[步骤3] 初始化组件...")
         try:
             analyzer = EnglishTemplateAnalyzer()
@@ -100,6 +152,7 @@ def process_case(case_dir: str, client: OpenAIClient) -> None:
             return
 
         # 1. 分析模板
+        profiler.switch("analysis")
         print("\n[步骤4] 分析模板...")
         analyzed_templates = []
 
@@ -110,14 +163,57 @@ def process_case(case_dir: str, client: OpenAIClient) -> None:
             print(f"  错误: 生成分析提示失败: {e}")
             return
 
+        # 时间预算用完时所在的步骤
+        timed_out_stage = None
+
+        # 近重复模板只分析代表模板，其余复用代表的分析结果
+        template_texts = [extract_template_text(t) for t in templates]
+        rep_of = list(range(len(templates)))
+        dedup_report = None
+        shared_from_pool = []
+        if DEDUP_ENABLED and analysis_pool is None and len(templates) > 1:
+            try:
+                rep_of, dedup_report = TemplateDeduplicator().representative_map(template_texts)
+                print(f"  近重复聚类: {dedup_report['clusters']} 个簇，"
+                      f"节省 {dedup_report['analyses_saved']} 次分析")
+            except Exception as e:
+                print(f"  警告: 近重复聚类失败，逐个分析: {e}")
+                rep_of = list(range(len(templates)))
+
+        # 推测生成：本地分析几乎不耗时，先据此开始生成，与下面的上游分析并行
+        if speculator is not None:
+            try:
+                speculations = speculator.start_case(template_texts, context, topic, high_weight_index)
+                print(f"  已开始 {len(speculations)} 个推测生成")
+            except Exception as e:
+                print(f"  警告: 推测生成启动失败: {e}")
+
         for i, prompt in enumerate(analysis_prompts, 1):
+            rep = rep_of[i - 1]
+            if rep != i - 1:
+                analyzed_templates.append(copy.deepcopy(analyzed_templates[rep]))
+                print(f"\n  模板 {i} 与模板 {rep + 1} 近重复，复用其分析结果")
+                continue
+            if analysis_pool is not None:
+                shared = analysis_pool.get(template_texts[i - 1])
+                if shared is not None:
+                    analyzed_templates.append(shared)
+                    shared_from_pool.append(i - 1)
+                    print(f"\n  模板 {i} 与模板池中已分析的模板近重复，复用其分析结果")
+                    continue
+            if timed_out_stage is not None:
+                analyzed_templates.append({})
+                continue
+
             print(f"\n  分析模板 {i}/{len(analysis_prompts)}...")
             print(f"    提示长度: {len(prompt)} 字符")
             print(f"    提示预览: {prompt[:200]}...")
 
             try:
                 print("    调用 API 分析模板...")
-                analysis_result = client.analyze_template(prompt)
+                max_tokens = analysis_max_tokens(template_texts[i - 1])
+                print(f"    提示约 {count_tokens(prompt)} tokens，max_tokens={max_tokens}")
+                analysis_result = client.analyze_template(prompt, max_tokens=max_tokens)
                 print(f"    API 调用成功，返回类型: {type(analysis_result)}")
 
                 if isinstance(analysis_result, dict):
@@ -126,6 +222,8 @@ def process_case(case_dir: str, client: OpenAIClient) -> None:
                     if 'discourse_structure' in analysis_result and 'content_structure' in analysis_result:
                         analyzed_templates.append(analysis_result)
                         print("    ✓ 分析结果包含必要的结构字段")
+                        if analysis_pool is not None:
+                            analysis_pool.put(template_texts[i - 1], analysis_result)
                         # 打印更详细的结构信息
                         discourse = analysis_result.get('discourse_structure', {})
                         content = analysis_result.get('content_structure', {})
@@ -142,6 +240,10 @@ def process_case(case_dir: str, client: OpenAIClient) -> None:
                     print(f"    实际返回内容: {analysis_result}")
                     analyzed_templates.append({})
 
+            except DeadlineExceeded as e:
+                print(f"    ⏱ {e}，剩余模板不再分析")
+                timed_out_stage = "analysis"
+                analyzed_templates.append({})
             except Exception as e:
                 print(f"    ✗ API 调用错误: {e}")
                 print(f"    错误类型: {type(e).__name__}")
@@ -150,6 +252,16 @@ def process_case(case_dir: str, client: OpenAIClient) -> None:
                 analyzed_templates.append({})
 
         print(f"  模板分析完成，成功分析 {sum(1 for t in analyzed_templates if t)} 个模板")
+        if analysis_pool is not None:
+            dedup_report = {
+                'scope': 'pool',
+                'total_templates': len(templates),
+                'analyses_saved': len(shared_from_pool),
+                'saving_ratio': round(len(shared_from_pool) / len(templates), 4) if templates else 0.0,
+                'threshold': analysis_pool.dedup.threshold,
+                'shared_templates': shared_from_pool
+            }
+            print(f"  从模板池复用 {len(shared_from_pool)} 个分析结果")
         print(f"  analyzed_templates 长度: {len(analyzed_templates)}")
 
         # 打印每个分析结果的概要
@@ -160,6 +272,7 @@ def process_case(case_dir: str, client: OpenAIClient) -> None:
                 print(f"    模板 {i}: 无效或空")
 
         # 2. 生成仿写 prompt
+        profiler.switch("paraphrase_prompts")
         print("\n[步骤5] 生成仿写提示...")
         print(f"  输入参数:")
         print(f"    analyzed_templates 长度: {len(analyzed_templates)}")
@@ -185,37 +298,113 @@ def process_case(case_dir: str, client: OpenAIClient) -> None:
             return
 
         # 3. 生成仿写段落
+        profiler.switch("generation")
         print("\n[步骤6] 生成仿写段落...")
         generated_paragraphs = []
+        generation_provenance = []
+        deferred_generation = []
 
         for i, prompt in enumerate(paraphrase_prompts, 1):
             print(f"\n  生成段落 {i}/{len(paraphrase_prompts)}...")
             print(f"    提示长度: {len(prompt)} 字符")
             print(f"    提示预览: {prompt[:200]}...")
 
+            speculation = speculations.pop(i - 1, None)
+            if timed_out_stage is not None:
+                if speculation is not None:
+                    speculator.discard(speculation)
+                generated_paragraphs.append("")
+                generation_provenance.append({'source': 'timed_out'})
+                continue
+
+            if speculation is not None:
+                paragraph = speculator.resolve(speculation, prompt)
+                if paragraph:
+                    print("    推测段落的结构与上游分析一致，直接采用")
+                    generated_paragraphs.append(paragraph)
+                    generation_provenance.append({'source': 'speculative'})
+                    if generation_cache is not None:
+                        generation_cache.store(prompt, paragraph, origin=case_name)
+                    continue
+                print("    推测段落未采用（结构与上游分析不一致或推测失败），重新生成")
+
+            if generation_cache is not None:
+                cached = generation_cache.lookup(prompt, exclude_origin=case_name)
+                if cached is not None:
+                    provenance = cached['provenance']
+                    print(f"    命中近似缓存 (条目 {provenance['cache_entry']}，来源 {provenance['origin']}，"
+                          f"相似度 {provenance['similarity']})，跳过 API 调用")
+                    generated_paragraphs.append(cached['paragraph'])
+                    generation_provenance.append(provenance)
+                    continue
+
+            max_tokens = generation_max_tokens(analyzed_templates[i - 1])
             try:
                 print("    调用 API 生成段落...")
-                generated_paragraph = client.generate_paragraph(prompt)
+                print(f"    提示约 {count_tokens(prompt)} tokens，max_tokens={max_tokens}")
+                generated_paragraph = client.generate_paragraph(prompt, max_tokens=max_tokens,
+                                                                high_weight=(i - 1 == high_weight_index))
                 print(f"    API 调用成功，返回类型: {type(generated_paragraph)}")
                 print(f"    生成段落长度: {len(generated_paragraph)} 字符")
                 print(f"    段落预览: {generated_paragraph[:100]}...")
                 generated_paragraphs.append(generated_paragraph)
+                generation_provenance.append({'source': 'api'})
+                if generation_cache is not None:
+                    generation_cache.store(prompt, generated_paragraph, origin=case_name)
+            except CircuitOpenError:
+                print("    熔断器打开，推迟生成，放入重试队列")
+                generated_paragraphs.append("")
+                generation_provenance.append({'source': 'deferred', 'reason': 'circuit_open'})
+                deferred_generation.append({'template_index': i - 1, 'prompt': prompt, 'max_tokens': max_tokens,
+                                            'high_weight': i - 1 == high_weight_index})
+            except DeadlineExceeded as e:
+                print(f"    ⏱ {e}，剩余段落不再生成")
+                timed_out_stage = "generation"
+                generated_paragraphs.append("")
+                generation_provenance.append({'source': 'timed_out'})
             except Exception as e:
                 print(f"    ✗ API 调用错误: {e}")
                 print(f"    错误类型: {type(e).__name__}")
                 generated_paragraphs.append("")
+                generation_provenance.append({'source': 'api', 'error': str(e)})
 
         print(f"  段落生成完成，成功生成 {sum(1 for p in generated_paragraphs if p)} 个段落")
 
         # 4. 处理结果
+        profiler.switch("result_processing")
         print("\n[步骤7] 处理结果...")
         try:
             processor = ResultProcessor(
-                templates, analyzed_templates, generated_paragraphs, high_weight_index
+                templates, analyzed_templates, generated_paragraphs, high_weight_index,
+                generation_provenance=generation_provenance
+                if generation_cache is not None or speculator is not None or deferred_generation or timed_out_stage
+                else None
             )
             print("  ResultProcessor 初始化成功")
 
             result_data = processor.format_result_json()
+            if dedup_report is not None:
+                result_data['deduplication'] = dedup_report
+            local_analysis = [i for i, a in enumerate(analyzed_templates) if isinstance(a, dict) and a.get('degraded')]
+            if local_analysis or deferred_generation:
+                result_data['degraded'] = {
+                    'local_analysis': local_analysis,
+                    'deferred_generation': [task['template_index'] for task in deferred_generation]
+                }
+                print(f"  ⚠ 熔断期间的退化结果: 本地分析 {local_analysis}，"
+                      f"推迟生成 {result_data['degraded']['deferred_generation']}")
+            if timed_out_stage is not None:
+                deadline = current_deadline()
+                result_data['status'] = 'timed_out'
+                result_data['deadline'] = {
+                    'stage': timed_out_stage,
+                    'limited_by': deadline.limited_by,
+                    'budget_seconds': deadline.seconds,
+                    'elapsed_seconds': round(deadline.elapsed(), 3),
+                    'analyzed': sum(1 for a in analyzed_templates if a),
+                    'generated': sum(1 for p in generated_paragraphs if p)
+                }
+                print(f"  ⏱ 时间预算在 {timed_out_stage} 步骤用完，写出部分结果 (status=timed_out)")
             print(f"  结果格式化完成，数据类型: {type(result_data)}")
             print(f"  结果键: {list(result_data.keys()) if isinstance(result_data, dict) else 'N/A'}")
         except Exception as e:
@@ -223,42 +412,109 @@ def process_case(case_dir: str, client: OpenAIClient) -> None:
             return
 
         # 5. 保存结果
+        profiler.switch("save")
         print("\n[步骤8] 保存结果...")
-        result_file = os.path.join(case_dir, "results.json")
-        print(f"  保存路径: {result_file}")
-
+        if lease is not None and not lease.held():
+            print(f"  ✗ 案例 {case_name} 已由其他 worker 接管，放弃写出结果")
+            return
         try:
-            write_json_file(result_data, result_file)
+            if result_store is not None:
+                print(f"  保存到结果存储: {result_store.root} (案例 {case_name})")
+                result_store.put(case_name, result_data)
+            else:
+                result_file = os.path.join(case_dir, "results.json")
+                print(f"  保存路径: {result_file}")
+                write_json_file(result_data, result_file)
             print("  ✓ 结果保存成功")
         except Exception as e:
             print(f"  ✗ 保存结果失败: {e}")
             return
 
-        print(f"\n✓ 案例 {case_name} 处理完成")
+        if 'degraded' in result_data and retry_queue is not None:
+            retry_queue.add(case_dir, result_data['degraded']['local_analysis'], deferred_generation)
+
+        if timed_out_stage is not None:
+            print(f"\n⏱ 案例 {case_name} 超时，已保存部分结果")
+        else:
+            print(f"\n✓ 案例 {case_name} 处理完成")
+        return result_data
 
     except Exception as e:
         print(f"\n✗ 处理案例 {case_name} 时发生未预期的错误: {e}")
         print(f"错误类型: {type(e).__name__}")
         import traceback
         print(f"错误堆栈:\n{traceback.format_exc()}")
-
-
-def main() -> None:
+    finally:
+        for speculation in speculations.values():
+            speculator.discard(speculation)
+
+
+def write_corpus_report(corpus_stats: CorpusAggregator, report_dir: str = CORPUS_REPORT_DIR) -> str:
+    """写出运行级语料报告，同时保存可合并的部分统计（供 corpus_stats.py merge 跨 worker 汇总）"""
+    run_dir = os.path.join(report_dir, time.strftime("run-%Y%m%d-%H%M%S"))
+    os.makedirs(run_dir, exist_ok=True)
+    write_json_file(corpus_stats.report(), os.path.join(run_dir, "corpus_report.json"))
+    write_json_file(corpus_stats.to_dict(), os.path.join(run_dir, "corpus_partial.json"))
+    return os.path.join(run_dir, "corpus_report.json")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """解析命令行参数"""
+    parser = argparse.ArgumentParser(description="TemplateCraft-AI 批量处理")
+    parser.add_argument("--profile", action="store_true",
+                        help="用 cProfile 分阶段剖析 process_case，并在案例前后做 tracemalloc 快照")
+    parser.add_argument("--profile-sample", type=int, default=1, metavar="N",
+                        help="每 N 个案例剖析 1 个（默认每个案例都剖析）")
+    parser.add_argument("--profile-dir", default=PROFILE_DIR, help="剖析报告输出目录")
+    parser.add_argument("--queue", metavar="PATH",
+                        help="作为 worker 从任务队列领取案例（先用 job_queue.py enqueue 入队），不再扫描本地源目录")
+    parser.add_argument("--drain", action="store_true", help="队列中没有待处理和处理中的案例时退出，否则持续等待新案例")
+    parser.add_argument("--worker-id", default=None, help="worker 标识（默认 主机名-进程号）")
+    cassette_group = parser.add_mutually_exclusive_group()
+    cassette_group.add_argument("--record", metavar="CASSETTE", help="把每次 API 请求和响应（含耗时）录制到磁带文件")
+    cassette_group.add_argument("--replay", metavar="CASSETTE", help="从磁带文件回放 API 响应，不访问网络")
+    parser.add_argument("--metrics", action="store_true",
+                        help="启用运行指标：本地 HTTP 端口暴露 Prometheus 格式，并定期写入快照文件")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="指标 HTTP 端口")
+    parser.add_argument("--metrics-file", default=METRICS_SNAPSHOT_PATH, help="指标快照文件路径")
+    parser.add_argument("--case-deadline", type=float, default=CASE_DEADLINE_SECONDS, metavar="SECONDS",
+                        help="每个案例的时间预算（秒），用完时中止进行中的 API 调用并写出部分结果；0 为不限时")
+    parser.add_argument("--run-deadline", type=float, default=RUN_DEADLINE_SECONDS, metavar="SECONDS",
+                        help="整次运行的时间预算（秒），用完后不再开始新案例，进行中的案例按剩余时间截止")
+    parser.add_argument("--speculative", action="store_true", default=SPECULATIVE_GENERATION,
+                        help="上游分析进行中时先用本地分析推测生成，分析返回后结构一致则采用")
+    parser.add_argument("--result-store", nargs="?", const=RESULT_STORE_DIR, default=None, metavar="DIR",
+                        help=f"把结果写入分片压缩存储（默认 {RESULT_STORE_DIR}），不再为每个案例写 results.json")
+    parser.add_argument("--replay-latency", type=float, default=0.0, metavar="SCALE",
+                        help="回放时按录制耗时的倍数等待（0 为立即返回，1 为按原耗时）")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
     """主函数：处理所有案例"""
+    args = parse_args(argv)
     print("程序启动...")
-    print(f"源目录: {SOURCE_DIR}")
+    if not args.queue:
+        print(f"源目录: {SOURCE_DIR}")
 
-    # 检查源目录是否存在
-    if not os.path.exists(SOURCE_DIR):
-        print(f"错误: 源目录不存在: {SOURCE_DIR}")
-        return
+        # 检查源目录是否存在
+        if not os.path.exists(SOURCE_DIR):
+            print(f"错误: 源目录不存在: {SOURCE_DIR}")
+            return
 
-    print("源目录存在，继续执行...")
+        print("源目录存在，继续执行...")
 
     # 初始化 OpenAI 客户端
     print("\n初始化 OpenAI 客户端...")
     try:
-        client = OpenAIClient()
+        cassette = None
+        if args.record:
+            cassette = Cassette(args.record, Cassette.RECORD)
+            print(f"录制模式: API 请求将写入 {args.record}")
+        elif args.replay:
+            cassette = Cassette(args.replay, Cassette.REPLAY, latency_scale=args.replay_latency)
+            print(f"回放模式: 从 {args.replay} 回放 API 响应 (耗时倍数 {args.replay_latency})")
+        client = OpenAIClient(cassette=cassette)
         print("OpenAI 客户端初始化成功")
 
         # 测试连接
@@ -272,39 +528,220 @@ def main() -> None:
         print(f"✗ OpenAI 客户端初始化失败: {e}")
         return
 
-    # 获取案例目录
-    print("\n获取案例目录...")
-    try:
-        case_dirs = get_case_dirs(SOURCE_DIR)
-        print(f"找到 {len(case_dirs)} 个案例目录")
+    # 获取案例目录：队列模式下由队列按租约分发案例
+    job_queue = None
+    worker_id = args.worker_id or default_worker_id()
+    if args.queue:
+        job_queue = JobQueue(args.queue)
+        counts = job_queue.status()['counts']
+        print(f"\n以 worker {worker_id} 身份从队列 {args.queue} 领取案例 "
+              f"(待处理 {counts['pending']}，处理中 {counts['leased']}，完成 {counts['done']})")
+        case_dirs = job_queue.jobs(worker_id, drain=args.drain)
+        total = "?"
+    else:
+        print("\n获取案例目录...")
+        try:
+            case_dirs = get_case_dirs(SOURCE_DIR)
+            print(f"找到 {len(case_dirs)} 个案例目录")
+
+            if not case_dirs:
+                print("错误: 在源目录中未找到案例目录")
+                return
 
-        if not case_dirs:
-            print("错误: 在源目录中未找到案例目录")
+            for i, case_dir in enumerate(case_dirs, 1):
+                print(f"  {i}. {os.path.basename(case_dir)}")
+
+        except Exception as e:
+            print(f"获取案例目录失败: {e}")
             return
+        total = len(case_dirs)
 
-        for i, case_dir in enumerate(case_dirs, 1):
-            print(f"  {i}. {os.path.basename(case_dir)}")
+    # 加载模板库（可选）
+    library = None
+    if os.path.exists(os.path.join(TEMPLATE_LIBRARY_DIR, TemplateLibrary.INDEX_FILE)):
+        try:
+            library = TemplateLibrary(TEMPLATE_LIBRARY_DIR)
+            print(f"\n已加载模板库: {TEMPLATE_LIBRARY_DIR} (共 {len(library)} 个模板)")
+        except Exception as e:
+            print(f"\n加载模板库失败，仅使用案例目录中的模板: {e}")
+
+    # 近重复模板跨案例共享分析：先对整个模板池聚类，每个簇只分析一次
+    analysis_pool = None
+    if DEDUP_ENABLED:
+        analysis_pool = SharedAnalysisPool()
+        if job_queue is None:
+            pool_texts = []
+            for case_dir in case_dirs:
+                for i in range(1, 5):
+                    template_file = os.path.join(case_dir, f"template{i}.json")
+                    if os.path.exists(template_file):
+                        pool_texts.append(extract_template_text(read_text_file(template_file)))
+            try:
+                pool_report = analysis_pool.build(pool_texts)
+                print(f"\n模板池近重复聚类: {pool_report['total_templates']} 个模板，{pool_report['clusters']} 个簇，"
+                      f"最多节省 {pool_report['analyses_saved']} 次分析")
+            except Exception as e:
+                print(f"\n模板池聚类失败，处理时逐个归簇: {e}")
+
+    # 近似生成缓存（可选）
+    generation_cache = None
+    if GENERATION_CACHE_ENABLED:
+        generation_cache = ApproximateGenerationCache()
+        print(f"\n已启用近似生成缓存 (容差 {generation_cache.tolerance}，"
+              f"已有 {generation_cache.stats()['entries']} 条)")
+
+    # 性能剖析（可选）
+    run_profiler = None
+    if args.profile:
+        run_profiler = RunProfiler(args.profile_dir, sample_every=args.profile_sample)
+        print(f"\n已启用性能剖析，每 {run_profiler.sample_every} 个案例剖析 1 个，报告目录: {run_profiler.run_dir}")
+
+    # 推测生成（可选）
+    speculator = None
+    if args.speculative:
+        speculator = SpeculativeGenerator(client)
+        print(f"\n已启用推测生成 (句子数容差 {speculator.sentence_tolerance}，"
+              f"连接词重合度 ≥ {speculator.connective_overlap})")
+
+    # 分片压缩结果存储（可选）
+    result_store = None
+    if args.result_store:
+        try:
+            result_store = ResultStore(args.result_store, writable=True)
+            print(f"\n结果写入分片存储: {args.result_store} (已有 {len(result_store)} 个案例)")
+        except (OSError, RuntimeError, ValueError) as e:
+            print(f"\n打开结果存储失败: {e}")
+            return
 
-    except Exception as e:
-        print(f"获取案例目录失败: {e}")
-        return
+    # 运行指标（可选）
+    exporter = None
+    if args.metrics:
+        exporter = MetricsExporter(port=args.metrics_port, snapshot_path=args.metrics_file)
+        try:
+            exporter.start()
+            print(f"\n运行指标: http://{exporter.host}:{exporter.port}/metrics，快照文件: {exporter.snapshot_path}")
+        except OSError as e:
+            print(f"\n启动指标端口失败，只写快照文件: {e}")
+            exporter = MetricsExporter(port=None, snapshot_path=args.metrics_file)
+            exporter.start()
 
     # 处理所有案例
-    print(f"\n开始处理 {len(case_dirs)} 个案例...")
+    print(f"\n开始处理 {total} 个案例...")
 
+    corpus_stats = CorpusAggregator()
+    retry_queue = RetryQueue()
+    run_deadline = Deadline(args.run_deadline or None, name="run")
     success_count = 0
+    timed_out_count = 0
+    processed = 0
     for i, case_dir in enumerate(case_dirs, 1):
-        print(f"\n处理进度: {i}/{len(case_dirs)}")
+        processed = i
+        print(f"\n处理进度: {i}/{total}")
+        profiler = run_profiler.for_case(i, os.path.basename(case_dir)) if run_profiler else NULL_PROFILER
+        lease = LeaseKeeper(job_queue, case_dir, worker_id) if job_queue is not None else None
+        profiler.start()
+        case_start = time.perf_counter()
+        result_data = None
+        status = "failed"
         try:
-            process_case(case_dir, client)
-            success_count += 1
+            with deadline_scope(run_deadline.child(args.case_deadline or None)):
+                if lease is not None:
+                    with lease:
+                        result_data = process_case(case_dir, client, library, generation_cache, profiler,
+                                                   retry_queue, speculator, result_store, analysis_pool, lease)
+                else:
+                    result_data = process_case(case_dir, client, library, generation_cache, profiler,
+                                               retry_queue, speculator, result_store, analysis_pool)
+            if result_data is not None:
+                corpus_stats.update(result_data)
+                status = result_data.get('status', 'ok')
+                if status == 'timed_out':
+                    timed_out_count += 1
+                success_count += 1
         except Exception as e:
             print(f"处理案例失败: {e}")
-            continue
+        finally:
+            summary = profiler.stop()
+            if run_profiler is not None:
+                run_profiler.record(summary)
+            if lease is not None and lease.lost:
+                status = "lease_lost"
+            CASES.inc(status=status)
+            CASE_SECONDS.observe(time.perf_counter() - case_start)
+            if job_queue is not None:
+                if lease.lost:
+                    # 案例已由其他 worker 接管，队列状态交给新的持有者更新
+                    print(f"  租约已丢失，不更新案例 {os.path.basename(case_dir)} 的队列状态")
+                elif result_data is not None:
+                    job_queue.complete(case_dir, worker_id)
+                else:
+                    job_queue.fail(case_dir, worker_id, "process_case 未返回结果")
+
+        if run_deadline.expired():
+            print(f"\n⏱ 整次运行的时间预算 ({args.run_deadline} 秒) 已用完，不再处理新案例")
+            break
+
+    if exporter is not None:
+        exporter.stop()
+    if speculator is not None:
+        speculator.shutdown()
+    if result_store is not None:
+        store_stats = result_store.stats()
+        result_store.close()
 
     print(f"\n{'=' * 50}")
     print(f"所有案例处理完成")
-    print(f"成功处理: {success_count}/{len(case_dirs)} 个案例")
+    print(f"成功处理: {success_count}/{processed} 个案例")
+    if processed - success_count:
+        print(f"  处理失败: {processed - success_count} 个案例")
+    if timed_out_count:
+        print(f"  其中超时写出部分结果: {timed_out_count} 个案例")
+    for stats in client.get_endpoint_stats():
+        print(f"  端点 {stats['name']} ({stats['model']}): 请求 {stats['requests']}，失败 {stats['failures']}，"
+              f"平均延迟 {stats['ewma_latency_ms']} ms")
+    if analysis_pool is not None:
+        pool_stats = analysis_pool.stats()
+        print(f"  模板分析共享: {pool_stats['templates']} 个模板 / {pool_stats['clusters']} 个簇，"
+              f"复用分析 {pool_stats['analyses_reused']} 次")
+    if generation_cache is not None:
+        cache_stats = generation_cache.stats()
+        print(f"  近似生成缓存: 命中 {cache_stats['hits']}，未命中 {cache_stats['misses']}，"
+              f"命中率 {cache_stats['hit_ratio']:.1%}")
+    report_path = write_corpus_report(corpus_stats)
+    overall = corpus_stats.report()['similarity']['all']['overall']
+    if overall['count']:
+        print(f"  语料相似度: 均值 {overall['mean']}，P50 {overall['p50']}，P90 {overall['p90']}")
+    print(f"  语料统计报告: {report_path}")
+    if run_profiler is not None:
+        print(f"  剖析报告: {run_profiler.write_summary()}")
+    if result_store is not None:
+        print(f"  结果存储: 写入 {store_stats['written']} 个案例，{store_stats['raw_bytes']} → "
+              f"{store_stats['stored_bytes']} 字节 (压缩比 {store_stats['compression_ratio']})，"
+              f"去重 {store_stats['blob_hits']} 个内容块")
+    parse_stats = client.get_parse_stats()
+    print(f"  分析结果解析: 直接解析 {parse_stats['parsed']}，修复 {parse_stats['repaired']}，"
+          f"失败 {parse_stats['failed']}，补问 {parse_stats['reasked']} (补全 {parse_stats['reask_recovered']})")
+    for stats in client.get_model_stats():
+        print(f"  模型 {stats['model']} [{stats['stage']}]: 请求 {stats['requests']}，"
+              f"成功率 {stats['success_rate']:.1%}，平均延迟 {stats['avg_latency_ms']} ms，"
+              f"提示缓存命中 {stats['cached_tokens']}/{stats['prompt_tokens']} tokens ({stats['cached_ratio']:.1%})")
+    cassette_stats = client.get_cassette_stats()
+    if cassette_stats is not None:
+        print(f"  磁带 ({cassette_stats['mode']}): 录制 {cassette_stats['recorded']}，"
+              f"回放命中 {cassette_stats['hits']}，未命中 {cassette_stats['misses']}")
+    breaker_stats = client.get_breaker_stats()
+    if breaker_stats['trips'] or breaker_stats['degraded_analyses']:
+        print(f"  熔断器: 打开 {breaker_stats['trips']} 次，拒绝 {breaker_stats['rejected']} 次请求，"
+              f"本地退化分析 {breaker_stats['degraded_analyses']} 次；用 python retry_queue.py retry 补跑")
+    if speculator is not None:
+        spec_stats = speculator.stats()
+        print(f"  推测生成: 开始 {spec_stats['started']}，采用 {spec_stats['accepted']}，丢弃 {spec_stats['rejected']}，"
+              f"失败 {spec_stats['failed']}，采用率 {spec_stats['acceptance_rate']:.1%}，"
+              f"节省等待 {spec_stats['seconds_saved']} 秒 (每段平均 {spec_stats['avg_seconds_saved']} 秒)")
+    hedging_stats = client.get_hedging_stats()
+    if hedging_stats['enabled']:
+        print(f"  对冲请求: {hedging_stats['hedges']}/{hedging_stats['requests']}，"
+              f"对冲胜出 {hedging_stats['hedge_wins']} 次，预算拒绝 {hedging_stats['budget_denied']} 次")
     print(f"{'=' * 50}")
 
 
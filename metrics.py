@@ -0,0 +1,332 @@
+# metrics.py
+
+import os
+import json
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Dict, Any, Optional, Tuple
+
+from config import METRICS_HOST, METRICS_PORT, METRICS_SNAPSHOT_PATH, METRICS_SNAPSHOT_SECONDS
+
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _Metric:
+    """带标签的指标基类，线程安全"""
+
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = labels
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def expose(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def snapshot(self) -> Any:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, help_text, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def total(self) -> float:
+        with self._lock:
+            return sum(self._values.values())
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        if not items and not self.label_names:
+            # 无标签指标在首次更新前也导出 0，便于告警规则判断
+            items = [((), 0.0)]
+        return [f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}" for key, value in items]
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return {",".join(key) or "total": value for key, value in sorted(self._values.items())}
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # 标签 -> [各桶计数（非累积）..., +Inf 桶计数, 总和, 总数]
+        self._values: Dict[LabelValues, List[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            state = self._values.setdefault(key, [0.0] * (len(self.buckets) + 3))
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        lines = []
+        for key, state in items:
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (float('inf'),), state):
+                cumulative += count
+                le = 'le="{}"'.format("+Inf" if bound == float('inf') else _format_value(bound))
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {_format_value(cumulative)}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {_format_value(state[-1])}")
+        return lines
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        result = {}
+        for key, state in items:
+            count = state[-1]
+            result[",".join(key) or "total"] = {
+                'count': int(count),
+                'avg_seconds': round(state[-2] / count, 4) if count else None,
+                'buckets': {("+Inf" if bound == float('inf') else _format_value(bound)): int(n)
+                            for bound, n in zip(self.buckets + (float('inf'),), state)}
+            }
+        return result
+
+
+class MetricsRegistry:
+    """指标注册表：按名称登记指标，导出 Prometheus 文本格式或 JSON 快照"""
+
+    def __init__(self):
+        self.started_at = time.time()
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+        self._last_rates: Optional[Tuple[float, float, float]] = None
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def _total(self, name: str) -> float:
+        metric = self._metrics.get(name)
+        return metric.total() if isinstance(metric, Counter) else 0.0
+
+    def rates(self, advance: bool = False) -> Dict[str, float]:
+        """运行以来以及距上次定期快照以来的案例数/秒和 token 数/秒（未接 Prometheus 时也能直接看吞吐）
+
+        只有 advance=True（定期写快照）时才把当前值记为下一个窗口的起点，HTTP 抓取只读，不会重置窗口。
+        """
+        now = time.time()
+        cases, tokens = self._total("templatecraft_cases_total"), self._total("templatecraft_tokens_total")
+        elapsed = max(now - self.started_at, 1e-9)
+        result = {
+            'uptime_seconds': round(now - self.started_at, 1),
+            'cases_per_second': round(cases / elapsed, 4),
+            'tokens_per_second': round(tokens / elapsed, 2)
+        }
+        with self._lock:
+            last = self._last_rates
+            if advance:
+                self._last_rates = (now, cases, tokens)
+        if last is not None and now > last[0]:
+            window = now - last[0]
+            result['recent_cases_per_second'] = round((cases - last[1]) / window, 4)
+            result['recent_tokens_per_second'] = round((tokens - last[2]) / window, 2)
+        return result
+
+    def expose(self) -> str:
+        """Prometheus 文本格式"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines: List[str] = []
+        for metric in metrics:
+            lines.extend(metric.expose())
+        lines.append("# HELP templatecraft_uptime_seconds 进程启动以来的秒数")
+        lines.append("# TYPE templatecraft_uptime_seconds gauge")
+        lines.append(f"templatecraft_uptime_seconds {round(time.time() - self.started_at, 1)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self, advance: bool = False) -> Dict[str, Any]:
+        """JSON 快照；advance 的含义见 rates()"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lookups = next((m.snapshot() for m in metrics if m.name == "templatecraft_cache_lookups_total"), {})
+        hits = sum(v for k, v in lookups.items() if k.endswith(",hit"))
+        total = sum(lookups.values())
+        return {
+            'timestamp': time.time(),
+            'rates': self.rates(advance),
+            'cache_hit_ratio': round(hits / total, 3) if total else None,
+            'metrics': {metric.name: metric.snapshot() for metric in metrics}
+        }
+
+
+REGISTRY = MetricsRegistry()
+
+# 流水线共用的指标
+CASES = REGISTRY.counter("templatecraft_cases_total", "处理完成的案例数", ("status",))
+CASE_SECONDS = REGISTRY.histogram("templatecraft_case_seconds", "单个案例的处理耗时（秒）", (),
+                                  buckets=(1, 5, 10, 30, 60, 120, 300, 600))
+API_IN_FLIGHT = REGISTRY.gauge("templatecraft_api_in_flight", "正在进行的上游 API 调用数")
+API_SECONDS = REGISTRY.histogram("templatecraft_api_request_seconds", "上游 API 调用耗时（秒）", ("stage",))
+API_ERRORS = REGISTRY.counter("templatecraft_api_errors_total", "上游 API 调用失败次数", ("stage",))
+API_RETRIES = REGISTRY.counter("templatecraft_api_retries_total", "换端点重试的次数")
+CACHE_LOOKUPS = REGISTRY.counter("templatecraft_cache_lookups_total", "缓存查询次数", ("cache", "result"))
+TOKENS = REGISTRY.counter("templatecraft_tokens_total", "上游返回的 token 用量", ("stage", "kind"))
+SPECULATIONS = REGISTRY.counter("templatecraft_speculative_generations_total", "推测生成的结果（采用 / 丢弃 / 失败）",
+                                ("result",))
+SPECULATION_SECONDS_SAVED = REGISTRY.counter("templatecraft_speculative_seconds_saved_total", "推测生成节省的等待时间（秒）")
+
+
+def usage_tokens(usage: Any) -> Dict[str, int]:
+    """从响应的 usage 中取出提示、补全和命中提示缓存的 token 数（缺失的字段按 0 计）"""
+    details = getattr(usage, 'prompt_tokens_details', None)
+    values = {
+        'prompt': getattr(usage, 'prompt_tokens', 0),
+        'completion': getattr(usage, 'completion_tokens', 0),
+        'cached': getattr(details, 'cached_tokens', 0) if details is not None else 0
+    }
+    return {kind: value if isinstance(value, int) else 0 for kind, value in values.items()}
+
+
+def record_usage(stage: str, response: Any) -> None:
+    """从响应的 usage 中累计 token 用量（prompt / completion / cached）"""
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return
+    for kind, value in usage_tokens(usage).items():
+        if value:
+            TOKENS.inc(value, stage=stage, kind=kind)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry: MetricsRegistry = REGISTRY
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] == "/metrics":
+            body = self.registry.expose().encode('utf-8')
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        elif self.path.split('?')[0] == "/metrics.json":
+            body = json.dumps(self.registry.snapshot(), ensure_ascii=False).encode('utf-8')
+            content_type = "application/json; charset=utf-8"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # 抓取请求很频繁，不打印访问日志
+        pass
+
+
+class MetricsExporter:
+    """后台线程：HTTP 暴露 /metrics（Prometheus 文本格式）和 /metrics.json，并定期把快照写入文件"""
+
+    def __init__(self, registry: MetricsRegistry = REGISTRY, host: str = METRICS_HOST,
+                 port: Optional[int] = METRICS_PORT, snapshot_path: Optional[str] = METRICS_SNAPSHOT_PATH,
+                 snapshot_seconds: float = METRICS_SNAPSHOT_SECONDS):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.snapshot_path = snapshot_path
+        self.snapshot_seconds = snapshot_seconds
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def start(self) -> None:
+        if self.port is not None:
+            handler = type("MetricsHandler", (_MetricsHandler,), {'registry': self.registry})
+            self._server = ThreadingHTTPServer((self.host, self.port), handler)
+            self._server.daemon_threads = True
+            self.port = self._server.server_address[1]
+            self._threads.append(threading.Thread(target=self._server.serve_forever, name="metrics-http",
+                                                  daemon=True))
+        if self.snapshot_path:
+            self._threads.append(threading.Thread(target=self._snapshot_loop, name="metrics-snapshot", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def write_snapshot(self) -> None:
+        """原子地写入快照文件，读取方不会看到写了一半的内容"""
+        os.makedirs(os.path.dirname(os.path.abspath(self.snapshot_path)), exist_ok=True)
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.registry.snapshot(advance=True), f, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def _snapshot_loop(self) -> None:
+        while not self._stop.wait(self.snapshot_seconds):
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                print(f"写入指标快照失败: {e}")
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        if self.snapshot_path:
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                print(f"写入指标快照失败: {e}")
+        for thread in self._threads:
+            thread.join(timeout=5)
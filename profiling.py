@@ -0,0 +1,177 @@
+# profiling.py
+
+import os
+import io
+import sys
+import json
+import time
+import pstats
+import cProfile
+import tracemalloc
+from typing import List, Dict, Any, Optional
+
+from config import PROFILE_DIR, PROFILE_TOP_N
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块
+    resource = None
+
+
+def peak_rss_mb() -> Optional[float]:
+    """进程峰值常驻内存（MB），平台不支持时返回 None"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 单位为 KB，macOS 为字节
+    if sys.platform == "darwin":
+        return round(peak / (1024 * 1024), 1)
+    return round(peak / 1024, 1)
+
+
+class NullProfiler:
+    """不做任何事的剖析器，未抽中的案例使用"""
+
+    enabled = False
+
+    def start(self) -> None:
+        pass
+
+    def switch(self, stage: str) -> None:
+        pass
+
+    def stop(self) -> Optional[Dict[str, Any]]:
+        return None
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class CaseProfiler:
+    """单个案例的分阶段剖析：每个阶段一个 cProfile，案例前后各做一次 tracemalloc 快照"""
+
+    enabled = True
+
+    def __init__(self, case_name: str, output_dir: str, top_n: int = PROFILE_TOP_N):
+        self.case_name = case_name
+        self.output_dir = output_dir
+        self.top_n = top_n
+        self.profiles: Dict[str, cProfile.Profile] = {}
+        self.stage_seconds: Dict[str, float] = {}
+        self.current_stage: Optional[str] = None
+        self._stage_start = 0.0
+        self._case_start = 0.0
+        self._snapshot_before: Optional[tracemalloc.Snapshot] = None
+        self._started_tracemalloc = False
+
+    def start(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            self._started_tracemalloc = True
+        tracemalloc.reset_peak()
+        self._snapshot_before = tracemalloc.take_snapshot()
+        self._case_start = time.perf_counter()
+
+    def _stop_stage(self) -> None:
+        if self.current_stage is None:
+            return
+        self.profiles[self.current_stage].disable()
+        elapsed = time.perf_counter() - self._stage_start
+        self.stage_seconds[self.current_stage] = self.stage_seconds.get(self.current_stage, 0.0) + elapsed
+        self.current_stage = None
+
+    def switch(self, stage: str) -> None:
+        """结束当前阶段并开始剖析下一阶段"""
+        self._stop_stage()
+        profile = self.profiles.setdefault(stage, cProfile.Profile())
+        self.current_stage = stage
+        self._stage_start = time.perf_counter()
+        profile.enable()
+
+    def stop(self) -> Dict[str, Any]:
+        """结束剖析并写出报告，返回案例摘要"""
+        self._stop_stage()
+        total_seconds = time.perf_counter() - self._case_start
+        snapshot_after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        for stage, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(self.output_dir, f"{stage}.prof"))
+            with open(os.path.join(self.output_dir, f"{stage}.txt"), 'w', encoding='utf-8') as f:
+                f.write(self._format_stats(profile, 'cumulative'))
+                f.write("\n")
+                f.write(self._format_stats(profile, 'tottime'))
+
+        with open(os.path.join(self.output_dir, "memory.txt"), 'w', encoding='utf-8') as f:
+            f.write(f"案例: {self.case_name}\n")
+            f.write(f"tracemalloc 当前: {current / 1024:.1f} KB，峰值: {peak / 1024:.1f} KB\n")
+            f.write(f"进程峰值 RSS: {peak_rss_mb()} MB\n\n")
+            f.write(f"Top {self.top_n} 内存增长位置（案例前后快照对比）:\n")
+            for stat in snapshot_after.compare_to(self._snapshot_before, 'lineno')[:self.top_n]:
+                f.write(f"{stat}\n")
+            f.write(f"\nTop {self.top_n} 内存占用位置（案例结束时）:\n")
+            for stat in snapshot_after.statistics('lineno')[:self.top_n]:
+                f.write(f"{stat}\n")
+
+        summary = {
+            'case': self.case_name,
+            'total_seconds': round(total_seconds, 4),
+            'stage_seconds': {stage: round(seconds, 4) for stage, seconds in self.stage_seconds.items()},
+            'tracemalloc_peak_kb': round(peak / 1024, 1),
+            'peak_rss_mb': peak_rss_mb()
+        }
+        with open(os.path.join(self.output_dir, "summary.json"), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2, ensure_ascii=False)
+        return summary
+
+    def _format_stats(self, profile: cProfile.Profile, sort_key: str) -> str:
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stats.sort_stats(sort_key).print_stats(self.top_n)
+        return f"===== 按 {sort_key} 排序 Top {self.top_n} =====\n" + stream.getvalue()
+
+
+class RunProfiler:
+    """运行级剖析：决定哪些案例需要剖析（每 N 个抽 1 个），并在运行目录下汇总报告"""
+
+    def __init__(self, base_dir: str = PROFILE_DIR, sample_every: int = 1, top_n: int = PROFILE_TOP_N):
+        self.run_dir = os.path.join(base_dir, time.strftime("run-%Y%m%d-%H%M%S"))
+        self.sample_every = max(int(sample_every), 1)
+        self.top_n = top_n
+        self.summaries: List[Dict[str, Any]] = []
+
+    def for_case(self, index: int, case_name: str):
+        """返回第 index 个案例（从 1 开始）使用的剖析器"""
+        if (index - 1) % self.sample_every != 0:
+            return NULL_PROFILER
+        return CaseProfiler(case_name, os.path.join(self.run_dir, case_name), self.top_n)
+
+    def record(self, summary: Optional[Dict[str, Any]]) -> None:
+        if summary:
+            self.summaries.append(summary)
+
+    def write_summary(self) -> str:
+        """写出运行级汇总：各阶段累计耗时从高到低排序"""
+        os.makedirs(self.run_dir, exist_ok=True)
+        stage_totals: Dict[str, float] = {}
+        for summary in self.summaries:
+            for stage, seconds in summary['stage_seconds'].items():
+                stage_totals[stage] = stage_totals.get(stage, 0.0) + seconds
+
+        report = {
+            'profiled_cases': len(self.summaries),
+            'sample_every': self.sample_every,
+            'stage_totals_seconds': dict(sorted(
+                ((stage, round(seconds, 4)) for stage, seconds in stage_totals.items()),
+                key=lambda item: item[1], reverse=True
+            )),
+            'peak_rss_mb': peak_rss_mb(),
+            'cases': self.summaries
+        }
+        path = os.path.join(self.run_dir, "run_summary.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+        return path
@@ -1,31 +1,83 @@
+import re
 from typing import List, Dict, Any
 
+from config import CONTEXT_TOKEN_BUDGET
+from token_budget import compact_prompt, trim_to_tokens
+from utils import extract_template_text
+
+
+# 提示分为静态前缀和案例变量两部分：静态前缀（任务说明、输出格式、通用要求）对所有案例逐字相同，
+# 案例变量（模板正文、结构参数、主题、上下文）统一放在末尾，使上游的提示前缀缓存可以命中。
+# 注意：提供方只对不少于约 1024 token 的公共前缀启用提示缓存，而目前的静态前缀只有一百个 token 左右，
+# 单靠这种排布还不会产生缓存命中；它的作用是保证前缀逐字稳定，等共享说明（如示例、格式规范）
+# 增长到超过该下限后才会真正省下输入费用和首 token 延迟。不要为凑长度而填充无关说明
+ANALYSIS_INSTRUCTIONS = """
+Analyze the English paragraph given at the end in two aspects:
+1. Discourse Structure: Identify the function of each sentence, the rhetorical devices used, and the sentence connection patterns.
+2. Content Structure: Extract the core concepts, the direction of argumentation (positive/negative/balanced), and the logical flow.
+
+Provide your analysis in JSON format with the following keys:
+- discourse_structure: {"sentence_count", "sentence_types", "connectives", "rhetoric", "sentence_length"}
+- content_structure: {"core_concepts", "related_concepts", "argument_direction", "logical_flow"}
+"""
+
+PARAPHRASE_INSTRUCTIONS = """
+Generate a coherent paragraph about the topic and context given at the end, following the structure requirements listed there.
+
+General Requirements:
+- Ensure the paragraph flows naturally
+- Use academic writing style
+- Make the content relevant to the given context
+
+Please generate a well-structured paragraph that follows these requirements.
+"""
+
+HIGH_WEIGHT_INSTRUCTIONS = """
+Special Instructions (High Priority Template):
+- Pay extra attention to preserving the template features listed at the end
+- Follow the listed logical structure strictly
+- Ensure positive statements about the topic account for at least 60% of the paragraph
+- Use academic language style
+- Make the argument more compelling and well-supported
+"""
+
+HIGH_WEIGHT_FALLBACK_INSTRUCTIONS = """
+Special Instructions (High Priority Template):
+- Use more sophisticated language and structure
+- Provide stronger arguments and evidence
+- Maintain academic writing standards
+"""
+
+# 主题和上下文固定放在提示最后
+CASE_INPUT_MARKER = "\nTopic: "
+
+
+def extract_analysis_paragraph(prompt: str) -> str:
+    """从分析提示中取出待分析的段落（位于提示末尾），找不到时返回整个提示"""
+    match = re.search(r'Paragraph:\s*\n(.*)\Z', prompt, re.DOTALL)
+    return extract_template_text(match.group(1).strip() if match else prompt)
+
 
 class PromptGenerator:
     """Prompt生成器：基于模板分析结果创建多样化的提示词"""
 
     def generate_analysis_prompts(self, templates: List[str]) -> List[str]:
-        """生成用于分析模板的prompt"""
+        """生成用于分析模板的prompt（静态说明在前，模板正文在最后；只嵌入正文，去掉 JSON 包装和缩进空白）"""
         prompts = []
         for i, template in enumerate(templates):
-            prompt = f"""
-            Analyze the following English paragraph in two aspects:
-            1. Discourse Structure: Identify the function of each sentence, the rhetorical devices used, and the sentence connection patterns.
-            2. Content Structure: Extract the core concepts, the direction of argumentation (positive/negative/balanced), and the logical flow.
-
-            Paragraph:
-            {template}
-
-            Provide your analysis in JSON format with the following keys:
-            - discourse_structure: {{"sentence_count", "sentence_types", "connectives", "rhetoric", "sentence_length"}}
-            - content_structure: {{"core_concepts", "related_concepts", "argument_direction", "logical_flow"}}
-            """
-            prompts.append(prompt)
+            paragraph = extract_template_text(template)
+            prompt = ANALYSIS_INSTRUCTIONS + f"""
+Paragraph:
+{paragraph}
+"""
+            prompts.append(compact_prompt(prompt))
         return prompts
 
     def generate_paraphrase_prompts(self, analyzed_templates: List[Dict], context: str, topic: str,
                                     high_weight_index: int) -> List[str]:
         """生成用于仿写的prompt"""
+        # 上下文可能很长，先截断到预算内再嵌入每个 prompt
+        context = trim_to_tokens(context, CONTEXT_TOKEN_BUDGET)
         prompts = []
         for i, template in enumerate(analyzed_templates):
             try:
@@ -39,15 +91,15 @@ class PromptGenerator:
                 # 高权重模板增强
                 if i == high_weight_index:
                     enhanced_prompt = self._enhance_prompt_for_high_weight(base_prompt, template)
-                    prompts.append(enhanced_prompt)
+                    prompts.append(compact_prompt(enhanced_prompt))
                 else:
-                    prompts.append(base_prompt)
+                    prompts.append(compact_prompt(base_prompt))
 
             except Exception as e:
                 print(f"创建基础prompt时出错: {e}")
                 # 使用备用prompt
                 fallback_prompt = self._create_fallback_prompt(context, topic)
-                prompts.append(fallback_prompt)
+                prompts.append(compact_prompt(fallback_prompt))
 
         return prompts
 
@@ -104,24 +156,15 @@ class PromptGenerator:
             if not isinstance(logical_flow, str):
                 logical_flow = 'sequential'
 
-            prompt = f"""
-Generate a coherent paragraph about {topic} in the context of {context}.
-
+            prompt = PARAPHRASE_INSTRUCTIONS + f"""
 Structure Requirements:
 - Use approximately {sentence_count} sentences
 - Include sentence types: {', '.join(sentence_types)}
 - Use connective words like: {', '.join(connectives[:3])}
 - Follow {logical_flow} logical flow
 - Maintain {argument_direction} argument direction
-
-Content Requirements:
 - Focus on these core concepts: {', '.join(core_concepts[:3])}
-- Ensure the paragraph flows naturally
-- Use academic writing style
-- Make the content relevant to the given context
-
-Please generate a well-structured paragraph that follows these requirements.
-"""
+""" + self._case_input(topic, context)
             return prompt
 
         except Exception as e:
@@ -130,15 +173,28 @@ Please generate a well-structured paragraph that follows these requirements.
 
     def _create_fallback_prompt(self, context: str, topic: str) -> str:
         """创建备用的简单prompt"""
-        return f"""
-Generate a coherent paragraph about {topic} in the context of {context}.
-
-Requirements:
+        return PARAPHRASE_INSTRUCTIONS + """
+Structure Requirements:
 - Write 3-5 sentences
-- Use academic writing style
 - Ensure logical flow
-- Make content relevant to the context
-"""
+""" + self._case_input(topic, context)
+
+    @staticmethod
+    def _case_input(topic: str, context: str) -> str:
+        """案例输入段落，始终位于提示末尾"""
+        return f"{CASE_INPUT_MARKER}{topic}\nContext: {context}\n"
+
+    @staticmethod
+    def _insert_high_weight(base_prompt: str, instructions: str, details: str = "") -> str:
+        """把高权重的静态说明插到通用静态前缀之后，把模板相关的细节插到案例输入之前"""
+        head, marker, case_input = base_prompt.rpartition(CASE_INPUT_MARKER)
+        if not marker:
+            head, case_input = base_prompt, ""
+        if head.startswith(PARAPHRASE_INSTRUCTIONS):
+            head = PARAPHRASE_INSTRUCTIONS + instructions + head[len(PARAPHRASE_INSTRUCTIONS):]
+        else:
+            head = instructions + head
+        return head + details + marker + case_input
 
     def _enhance_prompt_for_high_weight(self, base_prompt: str, template: Dict) -> str:
         """为高权重模板增强prompt"""
@@ -164,27 +220,17 @@ Requirements:
 
             features_desc = ', '.join(unique_features) if unique_features else 'clear structure and flow'
 
-            # 添加高权重指令
-            enhanced_prompt = base_prompt + f"""
-
-Special Instructions (High Priority Template):
-- Pay extra attention to preserving the following features: {features_desc}
-- Follow the {logical_flow} logical structure strictly
-- Ensure positive statements about the topic account for at least 60% of the paragraph
-- Use academic language style
-- Make the argument more compelling and well-supported
-"""
+            # 添加高权重指令：静态部分进入前缀，模板特征放在案例变量中
+            enhanced_prompt = self._insert_high_weight(base_prompt, HIGH_WEIGHT_INSTRUCTIONS, f"""
+High Priority Template Features:
+- Preserve the following features: {features_desc}
+- Logical structure: {logical_flow}
+""")
             return enhanced_prompt
 
         except Exception as e:
             print(f"增强prompt时出错: {e}")
-            return base_prompt + """
-
-Special Instructions (High Priority Template):
-- Use more sophisticated language and structure
-- Provide stronger arguments and evidence
-- Maintain academic writing standards
-"""
+            return self._insert_high_weight(base_prompt, HIGH_WEIGHT_FALLBACK_INSTRUCTIONS)
 
 
 
@@ -6,11 +6,17 @@ class ResultProcessor:
     """结果处理器：格式化和展示分析与生成结果"""
 
     def __init__(self, templates: List[str], analyzed_templates: List[Dict], generated_paragraphs: List[str],
-                 high_weight_index: int):
+                 high_weight_index: int, generation_provenance: Optional[List[Dict]] = None):
         self.templates = templates or []
         self.analyzed_templates = analyzed_templates or []
         self.generated_paragraphs = generated_paragraphs or []
         self.high_weight_index = high_weight_index
+        # 每个生成段落的来源（API 或近似缓存），为 None 时不输出
+        self.generation_provenance = generation_provenance
+
+        # 本地分析器只创建一次，相同文本的分析结果复用
+        self.analyzer = EnglishTemplateAnalyzer()
+        self._local_analysis_cache: Dict[str, Dict] = {}
 
         # 数据长度一致性检查
         self._validate_input_data()
@@ -50,6 +56,8 @@ class ResultProcessor:
                     'generated_text': generated,
                     'similarity_score': similarity
                 }
+                if self.generation_provenance is not None and i < len(self.generation_provenance):
+                    template_result['generation_provenance'] = self.generation_provenance[i]
 
                 results['templates'].append(template_result)
 
@@ -79,11 +87,7 @@ class ResultProcessor:
             if not self._validate_analysis_structure(analysis):
                 return {'discourse': 0.0, 'content': 0.0, 'overall': 0.0}
 
-            analyzer = EnglishTemplateAnalyzer()
-            generated_analysis = {
-                'discourse_structure': analyzer.analyze_discourse_structure(generated),
-                'content_structure': analyzer.analyze_content_structure(generated)
-            }
+            generated_analysis = self._local_analysis(generated)
 
             # 计算篇章结构相似度
             discourse_similarity = self._compare_discourse_structures(
@@ -110,6 +114,17 @@ class ResultProcessor:
             print(f"计算相似度时出错: {e}")
             return {'discourse': 0.0, 'content': 0.0, 'overall': 0.0}
 
+    def _local_analysis(self, text: str) -> Dict:
+        """本地分析文本结构，相同文本只分析一次"""
+        cached = self._local_analysis_cache.get(text)
+        if cached is None:
+            cached = {
+                'discourse_structure': self.analyzer.analyze_discourse_structure(text),
+                'content_structure': self.analyzer.analyze_content_structure(text)
+            }
+            self._local_analysis_cache[text] = cached
+        return cached
+
     def _validate_analysis_structure(self, analysis: Dict) -> bool:
         """验证分析结构的完整性"""
         if not isinstance(analysis, dict):
@@ -0,0 +1,421 @@
+# result_store.py
+
+import os
+import json
+import mmap
+import zlib
+import struct
+import hashlib
+import argparse
+from typing import List, Dict, Any, Optional, Iterator, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows 上没有 fcntl，不做写入锁
+    fcntl = None
+
+from config import RESULT_STORE_DIR, RESULT_STORE_SHARD_BYTES, RESULT_STORE_COMPRESSION_LEVEL
+from utils import read_json_file, write_json_file, get_case_dirs
+
+
+FORMAT_VERSION = 1
+
+# 帧头：压缩后负载的字节数
+_FRAME_HEADER = struct.Struct(">I")
+# 索引条目：案例名 sha1 的前 8 字节、分片号、帧偏移、帧长度（含帧头）
+_INDEX_ENTRY = struct.Struct(">8sIQI")
+
+# zlib 预置字典：结果 JSON 中反复出现的键名和取值。单个案例的帧很小，预置字典能显著提高压缩率；
+# 读取时必须使用同一字典，修改字典需要提升 FORMAT_VERSION
+_ZDICT = (
+    b'{"source":"api"}{"source":"speculative"}{"source":"approximate_cache"}{"source":"deferred"}'
+    b'{"source":"timed_out"}"generation_provenance":'
+    b'"similarity_score":{"discourse":"content":"overall":"generated_text":'
+    b'"content_structure":{"core_concepts":["related_concepts":["argument_direction":"logical_flow":'
+    b'"discourse_structure":{"sentence_count":"sentence_types":["connectives":["rhetoric":{"sentence_length":['
+    b'"analysis":{"original_text":"is_high_weight":false,"is_high_weight":true,"template_index":'
+    b'"statistics":{"total_templates":"high_weight_template_index":"average_overall_similarity":'
+    b'"high_weight_similarity":"normal_similarity_avg":"comparison":[],"deduplication":"degraded":'
+    b'{"$blob":[{"case":"result":{"templates":[{'
+)
+
+# 每个模板中按内容去重的字段：同一分片内相同的模板正文和分析结果只存一份
+_BLOB_FIELDS = ('original_text', 'analysis')
+_BLOB_MIN_BYTES = 64
+
+
+def _case_key(case_name: str) -> bytes:
+    return hashlib.sha1(case_name.encode('utf-8')).digest()[:8]
+
+
+def _encode(value: Any, level: int) -> bytes:
+    compressor = zlib.compressobj(level, zdict=_ZDICT)
+    data = json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    payload = compressor.compress(data) + compressor.flush()
+    return _FRAME_HEADER.pack(len(payload)) + payload
+
+
+def _decode(frame: bytes) -> Any:
+    decompressor = zlib.decompressobj(zdict=_ZDICT)
+    return json.loads(decompressor.decompress(frame[_FRAME_HEADER.size:]) + decompressor.flush())
+
+
+class ResultStore:
+    """分片压缩的结果存储：代替每个案例一个 results.json
+
+    结果按写入顺序追加到大小受限的分片（shard-NNNNN.dat）中，每条记录是一个独立压缩的帧，
+    模板正文和分析结果在同一分片内按内容去重。旁路索引 index.bin 是按案例名哈希排序的定长条目，
+    通过 mmap 二分查找；写入期间的新条目先追加到 index.log，关闭写入时合并进 index.bin。
+    同一案例重复写入时以最后一次为准。同一时刻只允许一个写入者（POSIX 上用文件锁保证）。
+    """
+
+    INDEX_FILE = "index.bin"
+    JOURNAL_FILE = "index.log"
+    MANIFEST_FILE = "manifest.json"
+    LOCK_FILE = "LOCK"
+
+    def __init__(self, root: str = RESULT_STORE_DIR, writable: bool = False,
+                 shard_bytes: int = RESULT_STORE_SHARD_BYTES, level: int = RESULT_STORE_COMPRESSION_LEVEL):
+        self.root = root
+        self.writable = writable
+        self.shard_bytes = shard_bytes
+        self.level = level
+        self._index_map: Optional[mmap.mmap] = None
+        self._index_file = None
+        self._shard_maps: Dict[int, Tuple[Any, mmap.mmap]] = {}
+        # index.log 中以及本次写入的条目：案例名哈希 -> (分片号, 偏移, 长度)
+        self._recent: Dict[bytes, Tuple[int, int, int]] = {}
+
+        # 本次写入的统计
+        self.written = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.blob_hits = 0
+
+        manifest_path = os.path.join(root, self.MANIFEST_FILE)
+        if writable:
+            os.makedirs(root, exist_ok=True)
+            self._lock = open(os.path.join(root, self.LOCK_FILE), 'w')
+            if fcntl is not None:
+                try:
+                    fcntl.flock(self._lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    self._lock.close()
+                    raise RuntimeError(f"结果存储 {root} 正被另一个进程写入")
+            if not os.path.exists(manifest_path):
+                write_json_file({'version': FORMAT_VERSION, 'compression': 'zlib'}, manifest_path)
+        elif not os.path.exists(manifest_path):
+            raise FileNotFoundError(f"结果存储不存在: {root}")
+
+        manifest = read_json_file(manifest_path)
+        if manifest.get('version') != FORMAT_VERSION:
+            raise ValueError(f"不支持的结果存储版本: {manifest.get('version')}")
+
+        self._open_index()
+        self._load_journal()
+
+        if writable:
+            shards = self._shard_ids()
+            self._shard_id = shards[-1] if shards else 0
+            self._shard = open(self._shard_path(self._shard_id), 'ab')
+            self._journal = open(os.path.join(root, self.JOURNAL_FILE), 'ab')
+            # 当前分片内已写入的内容块：内容哈希 -> [偏移, 长度]；续写已有分片时从空开始
+            self._blobs: Dict[str, List[int]] = {}
+
+    # ---- 文件布局 ----
+
+    def _shard_path(self, shard_id: int) -> str:
+        return os.path.join(self.root, f"shard-{shard_id:05d}.dat")
+
+    def _shard_ids(self) -> List[int]:
+        return sorted(int(name[6:11]) for name in os.listdir(self.root)
+                      if name.startswith("shard-") and name.endswith(".dat"))
+
+    def _open_index(self) -> None:
+        path = os.path.join(self.root, self.INDEX_FILE)
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self._index_file = open(path, 'rb')
+            self._index_map = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _close_index(self) -> None:
+        if self._index_map is not None:
+            self._index_map.close()
+            self._index_file.close()
+            self._index_map = None
+            self._index_file = None
+
+    def _load_journal(self) -> None:
+        path = os.path.join(self.root, self.JOURNAL_FILE)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb') as f:
+            data = f.read()
+        # 末尾不完整的条目（写入中断）直接忽略
+        for start in range(0, len(data) - _INDEX_ENTRY.size + 1, _INDEX_ENTRY.size):
+            key, shard_id, offset, length = _INDEX_ENTRY.unpack_from(data, start)
+            self._recent[key] = (shard_id, offset, length)
+
+    # ---- 写入 ----
+
+    def put(self, case_name: str, result: Dict[str, Any]) -> None:
+        """写入一个案例的结果；模板正文和分析结果在当前分片内去重"""
+        if not self.writable:
+            raise RuntimeError("结果存储以只读方式打开")
+        if self._shard.tell() >= self.shard_bytes:
+            self._rotate()
+
+        templates = []
+        for template in result.get('templates', []):
+            template = dict(template)
+            for field in _BLOB_FIELDS:
+                if field in template:
+                    template[field] = self._put_blob(template[field])
+            templates.append(template)
+        record = {'case': case_name, 'result': {**result, 'templates': templates}}
+
+        frame = _encode(record, self.level)
+        offset = self._shard.tell()
+        self._shard.write(frame)
+        self._shard.flush()
+        entry = (self._shard_id, offset, len(frame))
+        self._journal.write(_INDEX_ENTRY.pack(_case_key(case_name), *entry))
+        self._journal.flush()
+        self._recent[_case_key(case_name)] = entry
+
+        self.written += 1
+        self.raw_bytes += len(json.dumps(result, ensure_ascii=False, indent=2).encode('utf-8'))
+        self.stored_bytes += len(frame)
+
+    def _put_blob(self, value: Any) -> Any:
+        data = json.dumps(value, ensure_ascii=False, sort_keys=True)
+        if len(data) < _BLOB_MIN_BYTES:
+            return value
+        digest = hashlib.sha1(data.encode('utf-8')).hexdigest()
+        ref = self._blobs.get(digest)
+        if ref is None:
+            frame = _encode(value, self.level)
+            ref = [self._shard.tell(), len(frame)]
+            self._shard.write(frame)
+            self.stored_bytes += len(frame)
+            self._blobs[digest] = ref
+        else:
+            self.blob_hits += 1
+        return {'$blob': ref}
+
+    def _rotate(self) -> None:
+        self._shard.close()
+        self._shard_id += 1
+        self._shard = open(self._shard_path(self._shard_id), 'ab')
+        self._blobs = {}
+
+    def compact_index(self) -> int:
+        """把 index.log 中的条目合并进排序后的 index.bin，返回案例数"""
+        if not self.writable:
+            raise RuntimeError("结果存储以只读方式打开")
+        entries = dict(self._iter_index())
+        entries.update(self._recent)
+        tmp_path = os.path.join(self.root, self.INDEX_FILE + ".tmp")
+        with open(tmp_path, 'wb') as f:
+            for key in sorted(entries):
+                f.write(_INDEX_ENTRY.pack(key, *entries[key]))
+        self._close_index()
+        os.replace(tmp_path, os.path.join(self.root, self.INDEX_FILE))
+        self._journal.truncate(0)
+        self._recent = {}
+        self._open_index()
+        return len(entries)
+
+    def close(self) -> None:
+        """关闭写入时合并索引并释放写入锁"""
+        if self.writable:
+            self._shard.close()
+            self.compact_index()
+            self._journal.close()
+            self._lock.close()
+            self.writable = False
+        for handle, view in self._shard_maps.values():
+            view.close()
+            handle.close()
+        self._shard_maps = {}
+        self._close_index()
+
+    def __enter__(self) -> "ResultStore":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    # ---- 读取 ----
+
+    def _iter_index(self) -> Iterator[Tuple[bytes, Tuple[int, int, int]]]:
+        if self._index_map is None:
+            return
+        for start in range(0, len(self._index_map), _INDEX_ENTRY.size):
+            key, shard_id, offset, length = _INDEX_ENTRY.unpack_from(self._index_map, start)
+            yield key, (shard_id, offset, length)
+
+    def _lookup(self, key: bytes) -> Optional[Tuple[int, int, int]]:
+        """先查最近写入的条目，再在 mmap 的 index.bin 中二分查找"""
+        if key in self._recent:
+            return self._recent[key]
+        if self._index_map is None:
+            return None
+        low, high = 0, len(self._index_map) // _INDEX_ENTRY.size
+        while low < high:
+            mid = (low + high) // 2
+            start = mid * _INDEX_ENTRY.size
+            mid_key = self._index_map[start:start + 8]
+            if mid_key < key:
+                low = mid + 1
+            elif mid_key > key:
+                high = mid
+            else:
+                return _INDEX_ENTRY.unpack_from(self._index_map, start)[1:]
+        return None
+
+    def _read_frame(self, shard_id: int, offset: int, length: int) -> Any:
+        handle, view = self._shard_maps.get(shard_id, (None, None))
+        if view is None or len(view) < offset + length:
+            # 分片在打开后又被追加，重新映射
+            if view is not None:
+                view.close()
+                handle.close()
+            handle = open(self._shard_path(shard_id), 'rb')
+            view = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            self._shard_maps[shard_id] = (handle, view)
+        return _decode(view[offset:offset + length])
+
+    def _resolve(self, shard_id: int, result: Dict[str, Any], blob_cache: Optional[Dict] = None) -> Dict[str, Any]:
+        """把模板中的内容块引用还原为原值"""
+        for template in result.get('templates', []):
+            for field in _BLOB_FIELDS:
+                value = template.get(field)
+                if isinstance(value, dict) and '$blob' in value:
+                    ref = (shard_id, *value['$blob'])
+                    if blob_cache is not None and ref in blob_cache:
+                        template[field] = json.loads(blob_cache[ref])
+                        continue
+                    resolved = self._read_frame(*ref)
+                    if blob_cache is not None:
+                        blob_cache[ref] = json.dumps(resolved, ensure_ascii=False)
+                    template[field] = resolved
+        return result
+
+    def get(self, case_name: str) -> Optional[Dict[str, Any]]:
+        """按案例名读取结果，不存在时返回 None"""
+        entry = self._lookup(_case_key(case_name))
+        if entry is None:
+            return None
+        record = self._read_frame(*entry)
+        if record.get('case') != case_name:
+            # 哈希前缀冲突
+            return None
+        return self._resolve(entry[0], record['result'])
+
+    def __contains__(self, case_name: str) -> bool:
+        return self.get(case_name) is not None
+
+    def __len__(self) -> int:
+        return len(dict(self._iter_index()).keys() | self._recent.keys())
+
+    def scan(self, resolve_blobs: bool = True) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """按分片内的存储顺序顺序读取每个案例的最新结果
+
+        只做统计时可以传 resolve_blobs=False，跳过模板正文和分析结果的解压。
+        """
+        entries = dict(self._iter_index())
+        entries.update(self._recent)
+        blob_cache: Dict[Tuple[int, int, int], str] = {}
+        current_shard = None
+        for shard_id, offset, length in sorted(entries.values()):
+            if shard_id != current_shard:
+                blob_cache.clear()
+                current_shard = shard_id
+            record = self._read_frame(shard_id, offset, length)
+            result = record['result']
+            if resolve_blobs:
+                result = self._resolve(shard_id, result, blob_cache)
+            yield record['case'], result
+
+    def export(self, out_dir: str, case_names: Optional[List[str]] = None) -> int:
+        """导出为每个案例一个 results.json 的目录结构（out_dir/<案例名>/results.json），返回导出数量"""
+        if case_names:
+            items = ((name, self.get(name)) for name in case_names)
+        else:
+            items = self.scan()
+        count = 0
+        for case_name, result in items:
+            if result is None:
+                print(f"  未找到案例: {case_name}")
+                continue
+            case_dir = os.path.join(out_dir, case_name)
+            os.makedirs(case_dir, exist_ok=True)
+            write_json_file(result, os.path.join(case_dir, "results.json"))
+            count += 1
+        return count
+
+    def stats(self) -> Dict[str, Any]:
+        shards = self._shard_ids()
+        return {
+            'cases': len(self),
+            'shards': len(shards),
+            'bytes': sum(os.path.getsize(self._shard_path(s)) for s in shards),
+            'written': self.written,
+            'raw_bytes': self.raw_bytes,
+            'stored_bytes': self.stored_bytes,
+            'compression_ratio': round(self.raw_bytes / self.stored_bytes, 2) if self.stored_bytes else 0.0,
+            'blob_hits': self.blob_hits
+        }
+
+
+def main() -> None:
+    """命令行入口：从已有 results.json 导入、导出回每个案例一个 results.json、查询和查看统计"""
+    parser = argparse.ArgumentParser(description="分片压缩结果存储")
+    parser.add_argument("--store", default=RESULT_STORE_DIR, help="结果存储目录")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="把案例目录中已有的 results.json 导入存储")
+    import_parser.add_argument("source_dir", help="案例源目录")
+
+    export_parser = subparsers.add_parser("export", help="导出为 <目录>/<案例名>/results.json")
+    export_parser.add_argument("out_dir", help="导出目录")
+    export_parser.add_argument("--case", action="append", dest="cases", help="只导出指定案例（可重复）")
+
+    get_parser = subparsers.add_parser("get", help="打印一个案例的结果")
+    get_parser.add_argument("case_name", help="案例名（案例目录名）")
+
+    subparsers.add_parser("stats", help="查看存储统计")
+    subparsers.add_parser("compact", help="把 index.log 合并进 index.bin")
+
+    args = parser.parse_args()
+
+    if args.command in ("import", "compact"):
+        with ResultStore(args.store, writable=True) as store:
+            if args.command == "import":
+                for case_dir in get_case_dirs(args.source_dir):
+                    result_file = os.path.join(case_dir, "results.json")
+                    if os.path.exists(result_file):
+                        store.put(os.path.basename(case_dir), read_json_file(result_file))
+                stats = store.stats()
+                print(f"导入 {stats['written']} 个案例：原始 {stats['raw_bytes']} 字节，存储 {stats['stored_bytes']} 字节"
+                      f"（压缩比 {stats['compression_ratio']}），去重 {stats['blob_hits']} 个内容块")
+            else:
+                print(f"索引已合并，共 {store.compact_index()} 个案例")
+        return
+
+    with ResultStore(args.store) as store:
+        if args.command == "export":
+            print(f"已导出 {store.export(args.out_dir, args.cases)} 个案例到 {args.out_dir}")
+        elif args.command == "get":
+            result = store.get(args.case_name)
+            if result is None:
+                print(f"未找到案例: {args.case_name}")
+            else:
+                print(json.dumps(result, indent=2, ensure_ascii=False))
+        else:
+            stats = store.stats()
+            print(f"共 {stats['cases']} 个案例，{stats['shards']} 个分片，{stats['bytes']} 字节")
+
+
+if __name__ == "__main__":
+    main()
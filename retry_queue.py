@@ -0,0 +1,191 @@
+# retry_queue.py
+
+import os
+import json
+import time
+import argparse
+from typing import List, Dict, Any, Optional
+
+from config import RETRY_QUEUE_PATH, RESULT_STORE_DIR
+from utils import read_json_file, write_json_file
+from result_processor import ResultProcessor
+from result_store import ResultStore
+
+
+class RetryQueue:
+    """熔断期间受影响案例的重试队列（JSONL，每个案例一条，后写入的记录覆盖先前的）
+
+    记录包括用本地分析器代替的模板序号，以及被推迟的生成任务（提示、max_tokens、是否高权重）。
+    只有推迟生成的案例可以只补跑生成并就地更新 results.json；用了本地分析的案例需要整案重跑。
+    """
+
+    def __init__(self, path: str = RETRY_QUEUE_PATH):
+        self.path = path
+
+    def add(self, case_dir: str, local_analysis: List[int], deferred_generation: List[Dict[str, Any]]) -> None:
+        """记录一个受影响的案例"""
+        if not local_analysis and not deferred_generation:
+            return
+        entry = {
+            'case_dir': os.path.abspath(case_dir),
+            'local_analysis': local_analysis,
+            'deferred_generation': deferred_generation,
+            'queued_at': time.time()
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def entries(self) -> Dict[str, Dict[str, Any]]:
+        """按案例目录返回最新的记录；已完成的记录（两项都为空）会被略去"""
+        result: Dict[str, Dict[str, Any]] = {}
+        if not os.path.exists(self.path):
+            return result
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                result[entry['case_dir']] = entry
+        return {k: v for k, v in result.items() if v['local_analysis'] or v['deferred_generation']}
+
+    def rewrite(self, entries: List[Dict[str, Any]]) -> None:
+        """用仍未完成的记录替换队列文件"""
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+
+def apply_generations(case_dir: str, paragraphs: Dict[int, str], result_store: Optional[ResultStore] = None) -> bool:
+    """把补跑得到的段落写回 results.json（或结果存储），并重新计算相似度和统计"""
+    case_name = os.path.basename(case_dir)
+    result_file = os.path.join(case_dir, "results.json")
+    result_data = result_store.get(case_name) if result_store is not None else read_json_file(result_file)
+    if not result_data or 'templates' not in result_data:
+        return False
+
+    templates = result_data['templates']
+    generated = [t.get('generated_text', '') for t in templates]
+    provenance = [t.get('generation_provenance', {'source': 'api'}) for t in templates]
+    for index, paragraph in paragraphs.items():
+        generated[index] = paragraph
+        provenance[index] = {'source': 'api', 'retried': True}
+    high_weight_index = next((t['template_index'] for t in templates if t.get('is_high_weight')), -1)
+
+    processor = ResultProcessor([t.get('original_text', '') for t in templates],
+                                [t.get('analysis', {}) for t in templates],
+                                generated, high_weight_index, generation_provenance=provenance)
+    updated = processor.format_result_json()
+    for key in ('deduplication', 'degraded'):
+        if key in result_data:
+            updated[key] = result_data[key]
+
+    degraded = updated.get('degraded')
+    if degraded:
+        degraded['deferred_generation'] = [i for i in degraded.get('deferred_generation', []) if i not in paragraphs]
+        if not degraded['local_analysis'] and not degraded['deferred_generation']:
+            del updated['degraded']
+    if result_store is not None:
+        result_store.put(case_name, updated)
+    else:
+        write_json_file(updated, result_file)
+    return True
+
+
+def retry(queue: RetryQueue, client, limit: Optional[int] = None,
+          result_store: Optional[ResultStore] = None) -> Dict[str, int]:
+    """补跑重试队列：只推迟了生成的案例只补生成，用了本地分析的案例整案重跑；
+    案例结果保存在结果存储中时需传入以写方式打开的 result_store"""
+    from main import process_case
+    from circuit_breaker import CircuitOpenError
+
+    stats = {'cases': 0, 'rerun': 0, 'regenerated': 0, 'remaining': 0}
+    entries = list(queue.entries().values())
+    if limit is not None:
+        entries = entries[:limit]
+
+    # 案例目录 -> 处理后的记录（None 表示已完成）
+    updates: Dict[str, Optional[Dict[str, Any]]] = {}
+    for entry in entries:
+        stats['cases'] += 1
+        case_dir = entry['case_dir']
+
+        if entry['local_analysis']:
+            print(f"\n整案重跑: {case_dir}")
+            result_data = process_case(case_dir, client, retry_queue=queue, result_store=result_store)
+            stats['rerun'] += 1
+            # 重跑后仍受影响时 process_case 会写入新记录，覆盖这条旧记录
+            updates[case_dir] = entry if result_data is None else None
+            continue
+
+        print(f"\n补跑推迟的生成: {case_dir}")
+        paragraphs: Dict[int, str] = {}
+        pending: List[Dict[str, Any]] = []
+        for task in entry['deferred_generation']:
+            try:
+                paragraph = client.generate_paragraph(task['prompt'], max_tokens=task.get('max_tokens'),
+                                                      high_weight=task.get('high_weight', False))
+            except CircuitOpenError:
+                paragraph = ""
+            if paragraph:
+                paragraphs[task['template_index']] = paragraph
+            else:
+                pending.append(task)
+
+        if paragraphs and apply_generations(case_dir, paragraphs, result_store):
+            stats['regenerated'] += len(paragraphs)
+        updates[case_dir] = {**entry, 'deferred_generation': pending} if pending else None
+
+    # 只更新没有被补跑期间的新记录覆盖的条目
+    latest = queue.entries()
+    originals = {entry['case_dir']: entry['queued_at'] for entry in entries}
+    for case_dir, replacement in updates.items():
+        if case_dir not in latest or latest[case_dir]['queued_at'] != originals[case_dir]:
+            continue
+        if replacement is None:
+            del latest[case_dir]
+        else:
+            latest[case_dir] = replacement
+    if entries:
+        queue.rewrite(list(latest.values()))
+    stats['remaining'] = len(latest)
+    return stats
+
+
+def main() -> None:
+    """命令行入口：查看或补跑熔断期间受影响的案例"""
+    parser = argparse.ArgumentParser(description="熔断重试队列")
+    parser.add_argument("--path", default=RETRY_QUEUE_PATH, help="重试队列文件路径")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="列出受影响的案例")
+    retry_parser = subparsers.add_parser("retry", help="补跑受影响的案例")
+    retry_parser.add_argument("--limit", type=int, default=None, help="最多处理的案例数")
+    retry_parser.add_argument("--result-store", nargs="?", const=RESULT_STORE_DIR, default=None, metavar="DIR",
+                              help="案例结果保存在分片结果存储中（与 main.py --result-store 一致）")
+    args = parser.parse_args()
+
+    queue = RetryQueue(args.path)
+    if args.command == "list":
+        entries = queue.entries()
+        print(f"共 {len(entries)} 个受影响的案例")
+        for entry in entries.values():
+            print(f"  {entry['case_dir']}: 本地分析 {entry['local_analysis']}，"
+                  f"推迟生成 {[t['template_index'] for t in entry['deferred_generation']]}")
+        return
+
+    from api_client import OpenAIClient
+    result_store = ResultStore(args.result_store, writable=True) if args.result_store else None
+    try:
+        stats = retry(queue, OpenAIClient(), args.limit, result_store)
+    finally:
+        if result_store is not None:
+            result_store.close()
+    print(f"\n处理 {stats['cases']} 个案例：整案重跑 {stats['rerun']}，补生成 {stats['regenerated']} 段，"
+          f"剩余 {stats['remaining']} 个案例")
+
+
+if __name__ == "__main__":
+    main()
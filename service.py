@@ -0,0 +1,411 @@
+# service.py
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Callable, Tuple
+
+from config import (SERVICE_HOST, SERVICE_PORT, SERVICE_BATCH_WINDOW_MS, SERVICE_MAX_BATCH_SIZE,
+                    SERVICE_CACHE_SIZE, SERVICE_WORKERS, TEMPLATE_LIBRARY_DIR)
+from utils import extract_template_text
+from template_analyzer import EnglishTemplateAnalyzer
+from prompt_generator import PromptGenerator
+from template_library import TemplateLibrary
+from metrics import REGISTRY, CACHE_LOOKUPS
+
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                422: "Unprocessable Entity", 500: "Internal Server Error"}
+
+
+class LatencyRecorder:
+    """记录最近若干次耗时并计算分位数"""
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self.samples: Dict[str, deque] = {}
+        self.counts: Dict[str, int] = {}
+
+    def record(self, name: str, seconds: float) -> None:
+        self.samples.setdefault(name, deque(maxlen=self.window)).append(seconds)
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def percentiles(self, name: str) -> Dict[str, float]:
+        values = sorted(self.samples.get(name, []))
+        if not values:
+            return {'count': 0}
+
+        def pick(q: float) -> float:
+            return round(values[min(len(values) - 1, int(q * len(values)))] * 1000, 2)
+
+        return {
+            'count': self.counts[name],
+            'p50_ms': pick(0.50),
+            'p90_ms': pick(0.90),
+            'p99_ms': pick(0.99),
+            'max_ms': round(values[-1] * 1000, 2)
+        }
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        return {name: self.percentiles(name) for name in self.samples}
+
+
+class MicroBatcher:
+    """微批处理器：在时间窗口内收集并发请求，打包成一次上游调用"""
+
+    def __init__(self, name: str, batch_fn: Callable[[List[Any]], List[Any]], executor: ThreadPoolExecutor,
+                 latency: LatencyRecorder, max_batch_size: int = SERVICE_MAX_BATCH_SIZE,
+                 window_ms: float = SERVICE_BATCH_WINDOW_MS):
+        self.name = name
+        self.batch_fn = batch_fn
+        self.executor = executor
+        self.latency = latency
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000.0
+        self.queue: Optional[asyncio.Queue] = None
+        self.in_flight = 0
+        self.batches = 0
+        self.items = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self.queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._collect())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    @property
+    def queue_depth(self) -> int:
+        return self.queue.qsize() if self.queue else 0
+
+    async def submit(self, item: Any) -> Any:
+        """提交一个任务，等待其所在批次完成后返回结果"""
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((item, future))
+        return await future
+
+    async def _collect(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # 批次在后台执行，收集器立即开始收集下一批
+            loop.create_task(self._dispatch(batch))
+
+    async def _dispatch(self, batch: List[Tuple[Any, asyncio.Future]]) -> None:
+        items = [item for item, _ in batch]
+        self.in_flight += len(batch)
+        start = time.perf_counter()
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, self.batch_fn, items)
+            if len(results) != len(items):
+                raise ValueError(f"批次结果数量不匹配: {len(results)} != {len(items)}")
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.in_flight -= len(batch)
+            self.batches += 1
+            self.items += len(batch)
+            self.latency.record(f"upstream_{self.name}", time.perf_counter() - start)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queue_depth': self.queue_depth,
+            'in_flight': self.in_flight,
+            'batches': self.batches,
+            'items': self.items,
+            'avg_batch_size': round(self.items / self.batches, 2) if self.batches else 0.0
+        }
+
+
+class BatchingClient:
+    """同步客户端适配器：让 process_case 在工作线程中通过服务的微批处理器调用上游"""
+
+    def __init__(self, service: "TemplateCraftService", loop: asyncio.AbstractEventLoop):
+        self.service = service
+        self.loop = loop
+
+    # 打包调用的模型和输出上限由上游客户端按阶段和任务数确定，这里忽略单个请求的 max_tokens 和 high_weight
+    def analyze_template(self, prompt: str, max_tokens: Optional[int] = None) -> Dict:
+        return asyncio.run_coroutine_threadsafe(self.service.analyze(prompt), self.loop).result()
+
+    def generate_paragraph(self, prompt: str, max_tokens: Optional[int] = None, high_weight: bool = False) -> str:
+        return asyncio.run_coroutine_threadsafe(self.service.generate(prompt), self.loop).result()
+
+
+class TemplateCraftService:
+    """常驻本地服务：复用同一个客户端、分析器和缓存，并对并发请求做微批处理"""
+
+    def __init__(self, client, library=None, cache_size: int = SERVICE_CACHE_SIZE):
+        self.client = client
+        self.library = library
+        self.analyzer = EnglishTemplateAnalyzer()
+        self.prompt_gen = PromptGenerator()
+        self.cache_size = cache_size
+        self.analysis_cache: "OrderedDict[str, Dict]" = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.latency = LatencyRecorder()
+        self.executor = ThreadPoolExecutor(max_workers=SERVICE_WORKERS, thread_name_prefix="upstream")
+        self.case_executor = ThreadPoolExecutor(max_workers=SERVICE_WORKERS, thread_name_prefix="case")
+        self.analysis_batcher = MicroBatcher("analysis", client.analyze_templates_packed, self.executor,
+                                             self.latency)
+        self.generation_batcher = MicroBatcher("generation", client.generate_paragraphs_packed, self.executor,
+                                               self.latency)
+        self.started_at = time.time()
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self, host: str = SERVICE_HOST, port: int = SERVICE_PORT) -> asyncio.AbstractServer:
+        self.analysis_batcher.start()
+        self.generation_batcher.start()
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        return self._server
+
+    async def stop(self) -> None:
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        await self.analysis_batcher.stop()
+        await self.generation_batcher.stop()
+        self.executor.shutdown(wait=False)
+        self.case_executor.shutdown(wait=False)
+
+    # ---- 业务接口 ----
+
+    async def analyze(self, prompt: str) -> Dict:
+        """分析一个提示，命中缓存时不访问上游"""
+        key = hashlib.sha1(prompt.encode('utf-8')).hexdigest()
+        cached = self.analysis_cache.get(key)
+        if cached is not None:
+            self.analysis_cache.move_to_end(key)
+            self.cache_hits += 1
+            CACHE_LOOKUPS.inc(cache="service_analysis", result="hit")
+            return cached
+
+        self.cache_misses += 1
+        CACHE_LOOKUPS.inc(cache="service_analysis", result="miss")
+        result = await self.analysis_batcher.submit(prompt)
+        # 熔断期间的本地退化结果不进缓存
+        if isinstance(result, dict) and 'discourse_structure' in result and 'content_structure' in result \
+                and 'degraded' not in result:
+            self.analysis_cache[key] = result
+            if len(self.analysis_cache) > self.cache_size:
+                self.analysis_cache.popitem(last=False)
+        return result
+
+    async def generate(self, prompt: str) -> str:
+        """生成一个段落"""
+        return await self.generation_batcher.submit(prompt)
+
+    async def process_case_dir(self, case_dir: str) -> Optional[Dict]:
+        """在工作线程中完整处理一个案例目录，API 调用经由微批处理器；返回本次处理的结果，失败时返回 None"""
+        from main import process_case
+
+        batching_client = BatchingClient(self, asyncio.get_running_loop())
+        return await asyncio.get_running_loop().run_in_executor(
+            self.case_executor, process_case, case_dir, batching_client, self.library
+        )
+
+    def metrics(self) -> Dict[str, Any]:
+        lookups = self.cache_hits + self.cache_misses
+        return {
+            'uptime_seconds': round(time.time() - self.started_at, 1),
+            'queue_depth': self.analysis_batcher.queue_depth + self.generation_batcher.queue_depth,
+            'analysis': self.analysis_batcher.stats(),
+            'generation': self.generation_batcher.stats(),
+            'cache': {
+                'size': len(self.analysis_cache),
+                'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'hit_ratio': round(self.cache_hits / lookups, 3) if lookups else 0.0
+            },
+            'latency': self.latency.snapshot(),
+            'endpoints': self.client.get_endpoint_stats() if hasattr(self.client, 'get_endpoint_stats') else [],
+            'hedging': self.client.get_hedging_stats() if hasattr(self.client, 'get_hedging_stats') else {},
+            'breaker': self.client.get_breaker_stats() if hasattr(self.client, 'get_breaker_stats') else {},
+            'models': self.client.get_model_stats() if hasattr(self.client, 'get_model_stats') else []
+        }
+
+    # ---- HTTP 路由 ----
+
+    async def _dispatch(self, method: str, path: str, body: bytes) -> Tuple[int, Any]:
+        route = path.split('?', 1)[0]
+        if method == "GET":
+            if route == "/health":
+                return 200, {'status': 'ok'}
+            if route == "/metrics":
+                return 200, self.metrics()
+            if route == "/metrics/prometheus":
+                return 200, REGISTRY.expose()
+            return 404, {'error': f"未知路径: {route}"}
+        if method != "POST":
+            return 405, {'error': f"不支持的方法: {method}"}
+
+        try:
+            payload = json.loads(body.decode('utf-8') or "{}")
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            return 400, {'error': f"请求体不是有效的 JSON: {e}"}
+        if not isinstance(payload, dict):
+            return 400, {'error': "请求体必须是 JSON 对象"}
+
+        if route == "/analyze":
+            template = payload.get('template')
+            if not isinstance(template, str):
+                return 400, {'error': "缺少字段: template"}
+            if payload.get('local'):
+                text = extract_template_text(template)
+                return 200, {'analysis': {
+                    'discourse_structure': self.analyzer.analyze_discourse_structure(text),
+                    'content_structure': self.analyzer.analyze_content_structure(text)
+                }}
+            prompt = self.prompt_gen.generate_analysis_prompts([template])[0]
+            return 200, {'analysis': await self.analyze(prompt)}
+
+        if route == "/generate":
+            prompt = payload.get('prompt')
+            if not isinstance(prompt, str):
+                analysis = payload.get('analysis', {})
+                context = payload.get('context', '')
+                topic = payload.get('topic', '')
+                if not topic:
+                    return 400, {'error': "缺少字段: prompt 或 topic"}
+                high_weight_index = 0 if payload.get('high_weight') else -1
+                prompt = self.prompt_gen.generate_paraphrase_prompts([analysis], context, topic,
+                                                                     high_weight_index)[0]
+            return 200, {'paragraph': await self.generate(prompt)}
+
+        if route == "/process":
+            case_dir = payload.get('case_dir')
+            if not isinstance(case_dir, str) or not os.path.isdir(case_dir):
+                return 400, {'error': f"案例目录不存在: {case_dir}"}
+            result = await self.process_case_dir(case_dir)
+            if result is None:
+                return 422, {'error': f"案例处理失败，未生成结果: {case_dir}"}
+            return 200, {'result': result}
+
+        return 404, {'error': f"未知路径: {route}"}
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """最小化的 HTTP/1.1 实现，支持 keep-alive"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get('content-length', 0) or 0)
+                body = await reader.readexactly(length) if length else b''
+
+                start = time.perf_counter()
+                try:
+                    status, payload = await self._dispatch(method.upper(), path, body)
+                except Exception as e:
+                    status, payload = 500, {'error': str(e), 'type': type(e).__name__}
+                self.latency.record(f"http_{path.split('?', 1)[0].strip('/') or 'root'}",
+                                    time.perf_counter() - start)
+
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                if isinstance(payload, str):
+                    data = payload.encode('utf-8')
+                    content_type = "text/plain; version=0.0.4; charset=utf-8"
+                else:
+                    data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                    content_type = "application/json; charset=utf-8"
+                writer.write(
+                    f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'OK')}\r\n"
+                    f"Content-Type: {content_type}\r\n"
+                    f"Content-Length: {len(data)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + data
+                )
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+def build_client(upstream: str, latency_ms: float = 0.0):
+    """创建上游客户端：openai 为真实 API，local 为本地替身"""
+    if upstream == "local":
+        from local_upstream import LocalUpstreamClient
+        return LocalUpstreamClient(latency_ms=latency_ms)
+
+    from api_client import OpenAIClient
+    client = OpenAIClient()
+    if client.test_connection():
+        print("✓ API 连接测试成功")
+    else:
+        print("✗ API 连接测试失败，但继续启动服务...")
+    return client
+
+
+async def serve(host: str, port: int, upstream: str, latency_ms: float) -> None:
+    client = build_client(upstream, latency_ms)
+
+    library = None
+    if os.path.exists(os.path.join(TEMPLATE_LIBRARY_DIR, TemplateLibrary.INDEX_FILE)):
+        library = TemplateLibrary(TEMPLATE_LIBRARY_DIR)
+
+    service = TemplateCraftService(client, library)
+    server = await service.start(host, port)
+    print(f"服务已启动: http://{host}:{port} (上游: {upstream})")
+    print("接口: POST /analyze, POST /generate, POST /process, GET /metrics, GET /metrics/prometheus, GET /health")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="TemplateCraft 常驻服务")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--upstream", choices=["openai", "local"], default="openai",
+                        help="上游类型：openai 为真实 API，local 为本地替身")
+    parser.add_argument("--local-latency-ms", type=float, default=0.0, help="本地替身模拟的单次调用延迟")
+    args = parser.parse_args()
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.upstream, args.local_latency_ms))
+    except KeyboardInterrupt:
+        print("\n服务已停止")
+
+
+if __name__ == "__main__":
+    main()
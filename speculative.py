@@ -0,0 +1,153 @@
+# speculative.py
+
+import re
+import time
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import List, Dict, Any, Optional
+
+from config import (SPECULATIVE_MAX_WORKERS, SPECULATIVE_SENTENCE_TOLERANCE, SPECULATIVE_CONNECTIVE_OVERLAP)
+from template_analyzer import EnglishTemplateAnalyzer
+from prompt_generator import PromptGenerator
+from generation_cache import ApproximateGenerationCache
+from token_budget import generation_max_tokens
+from metrics import SPECULATIONS, SPECULATION_SECONDS_SAVED
+
+
+def local_prompt_analysis(analyzer: EnglishTemplateAnalyzer, text: str) -> Dict[str, Any]:
+    """用本地分析器分析段落，并整理成与上游分析相同的形式：
+    连接词取段落中实际出现的词（按出现次数排序），句子类型只保留出现过的类型，论证方向取方向标签"""
+    discourse = analyzer.analyze_discourse_structure(text)
+    content = analyzer.analyze_content_structure(text)
+
+    counts: Dict[str, int] = {}
+    for pattern in analyzer.connective_patterns.values():
+        for match in re.findall(rf'\b{pattern}\b', text, re.IGNORECASE):
+            word = match.lower()
+            counts[word] = counts.get(word, 0) + 1
+    discourse['connectives'] = sorted(counts, key=lambda w: -counts[w])
+    discourse['sentence_types'] = [t for t, n in discourse['sentence_types'].items() if n]
+
+    direction = content.get('argument_direction')
+    if isinstance(direction, dict):
+        content['argument_direction'] = direction.get('direction', 'balanced')
+    return {'discourse_structure': discourse, 'content_structure': content}
+
+
+class SpeculativeGenerator:
+    """推测生成：上游分析进行中时，先用本地分析构造仿写提示并在后台开始生成
+
+    上游分析返回后比较两份仿写提示用到的结构槽位：句子数相差不超过 sentence_tolerance、
+    连接词的 Jaccard 相似度不低于 connective_overlap、逻辑流向和论证方向一致时采用推测段落，
+    否则丢弃（尚未开始的请求直接取消）并按上游分析重新生成。高权重模板使用单独的模型和模板特征，不做推测。
+    后台线程沿用提交时的上下文，案例的截止时间对推测请求同样有效。
+    """
+
+    def __init__(self, client, max_workers: int = SPECULATIVE_MAX_WORKERS,
+                 sentence_tolerance: int = SPECULATIVE_SENTENCE_TOLERANCE,
+                 connective_overlap: float = SPECULATIVE_CONNECTIVE_OVERLAP):
+        self.client = client
+        self.sentence_tolerance = sentence_tolerance
+        self.connective_overlap = connective_overlap
+        self.analyzer = EnglishTemplateAnalyzer()
+        self.prompt_gen = PromptGenerator()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="speculative")
+        self._lock = threading.Lock()
+
+        self.started = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.failed = 0
+        self.seconds_saved = 0.0
+
+    def start_case(self, template_texts: List[str], context: str, topic: str,
+                   high_weight_index: int) -> Dict[int, Dict[str, Any]]:
+        """为案例中除高权重模板外的每个模板开始推测生成，返回 模板序号 -> 推测任务"""
+        analyses = [local_prompt_analysis(self.analyzer, text) for text in template_texts]
+        prompts = self.prompt_gen.generate_paraphrase_prompts(analyses, context, topic, high_weight_index)
+
+        speculations = {}
+        for index, (analysis, prompt) in enumerate(zip(analyses, prompts)):
+            if index == high_weight_index:
+                continue
+            # 每个任务复制一份当前上下文（含截止时间），在后台线程中执行
+            future = self._executor.submit(contextvars.copy_context().run, self._generate,
+                                           prompt, generation_max_tokens(analysis))
+            speculations[index] = {'prompt': prompt, 'future': future}
+        with self._lock:
+            self.started += len(speculations)
+        return speculations
+
+    def _generate(self, prompt: str, max_tokens: int) -> Dict[str, Any]:
+        start = time.perf_counter()
+        paragraph = self.client.generate_paragraph(prompt, max_tokens=max_tokens)
+        return {'paragraph': paragraph, 'latency': time.perf_counter() - start}
+
+    def agrees(self, speculative_prompt: str, final_prompt: str) -> bool:
+        """两份仿写提示的结构槽位是否在容差内一致；最终提示是备用提示（没有流向和方向）时视为不一致"""
+        speculative = ApproximateGenerationCache.extract_slots(speculative_prompt)
+        final = ApproximateGenerationCache.extract_slots(final_prompt)
+        if not final['logical_flow'] or not final['argument_direction']:
+            return False
+        if abs(speculative['sentence_count'] - final['sentence_count']) > self.sentence_tolerance:
+            return False
+        if speculative['logical_flow'].lower() != final['logical_flow'].lower():
+            return False
+        if speculative['argument_direction'].lower() != final['argument_direction'].lower():
+            return False
+
+        a, b = set(speculative['connectives']), set(final['connectives'])
+        overlap = len(a & b) / len(a | b) if a | b else 1.0
+        return overlap >= self.connective_overlap
+
+    def resolve(self, speculation: Dict[str, Any], final_prompt: str) -> Optional[str]:
+        """按最终提示验证推测段落：一致时等待并返回推测段落，否则丢弃并返回 None"""
+        if not self.agrees(speculation['prompt'], final_prompt):
+            self.discard(speculation)
+            return None
+
+        wait_start = time.perf_counter()
+        try:
+            result = speculation['future'].result()
+        except Exception as e:
+            print(f"    推测生成失败: {e}")
+            result = None
+        if not result or not result['paragraph']:
+            self._count('failed')
+            return None
+
+        # 节省的时间：推测请求的耗时中已与上游分析重叠、不必再等待的部分
+        saved = max(result['latency'] - (time.perf_counter() - wait_start), 0.0)
+        with self._lock:
+            self.seconds_saved += saved
+        SPECULATION_SECONDS_SAVED.inc(saved)
+        self._count('accepted')
+        return result['paragraph']
+
+    def discard(self, speculation: Dict[str, Any]) -> None:
+        """丢弃推测段落；请求尚未开始时直接取消"""
+        future: Future = speculation['future']
+        future.cancel()
+        self._count('rejected')
+
+    def _count(self, result: str) -> None:
+        with self._lock:
+            setattr(self, result, getattr(self, result) + 1)
+        SPECULATIONS.inc(result=result)
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            resolved = self.accepted + self.rejected + self.failed
+            return {
+                'started': self.started,
+                'accepted': self.accepted,
+                'rejected': self.rejected,
+                'failed': self.failed,
+                'acceptance_rate': round(self.accepted / resolved, 3) if resolved else 0.0,
+                'seconds_saved': round(self.seconds_saved, 3),
+                'avg_seconds_saved': round(self.seconds_saved / self.accepted, 3) if self.accepted else 0.0
+            }
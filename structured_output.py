@@ -0,0 +1,186 @@
+# structured_output.py
+
+import re
+import json
+from typing import List, Dict, Any, Tuple
+
+
+# 分析结果的期望结构：顶层键 -> 必需的子字段
+ANALYSIS_SCHEMA = {
+    'discourse_structure': ['sentence_count', 'sentence_types', 'connectives', 'rhetoric', 'sentence_length'],
+    'content_structure': ['core_concepts', 'related_concepts', 'argument_direction', 'logical_flow']
+}
+
+# 末尾不在字符串中的裸值（true/false/null/数字，截断时可能不完整）
+_BARE_TAIL = re.compile(r'[^\s,:\[\]{}"]+$')
+# 紧贴截断处的数字：即使本身是合法数字也可能少了后面的位数
+_NUMBER_TAIL = re.compile(r'-?\d[\d.eE+-]*$')
+
+
+def _is_complete_literal(token: str) -> bool:
+    """判断裸值是否为完整的 JSON 字面量"""
+    try:
+        json.loads(token)
+        return True
+    except (json.JSONDecodeError, TypeError):
+        return False
+
+
+def _strip_code_fence(text: str) -> str:
+    """去掉 ```json 代码块包装（允许缺少结尾的 ```）"""
+    match = re.search(r'```(?:json)?\s*\n?(.*?)(?:\n?```|$)', text, re.DOTALL)
+    return match.group(1) if match else text
+
+
+def _trim_dangling(text: str, closer: str) -> str:
+    """去掉截断处不完整的键、冒号、逗号和字面量"""
+    while True:
+        before = text
+        text = text.rstrip()
+        if text.endswith(','):
+            text = text[:-1]
+        elif text.endswith(':'):
+            # 只有键没有值：连同键一起去掉
+            text = re.sub(r'"(?:[^"\\]|\\.)*"\s*:$', '', text)
+        elif closer == '}' and re.search(r'[,{]\s*"(?:[^"\\]|\\.)*"$', text):
+            # 对象中只剩一个键名
+            text = re.sub(r'"(?:[^"\\]|\\.)*"$', '', text)
+        else:
+            tail = _BARE_TAIL.search(text)
+            if tail and not _is_complete_literal(tail.group(0)):
+                text = text[:tail.start()]
+        if text == before:
+            return text
+
+
+def repair_json(text: str) -> str:
+    """修复常见的 JSON 问题：代码块包装、尾随逗号、截断导致的未闭合括号；
+    截断处不完整的值（未闭合的字符串和数组、紧贴截断处的数字）连同键一起去掉"""
+    content = _strip_code_fence(text or '')
+    starts = [i for i in (content.find('{'), content.find('[')) if i >= 0]
+    if not starts:
+        return content.strip()
+    content = content[min(starts):]
+
+    out: List[str] = []
+    # 未闭合的容器：(对应的右括号, 在 out 中的起始位置)
+    stack: List[Tuple[str, int]] = []
+    in_string = False
+    escaped = False
+    string_start = 0
+
+    for ch in content:
+        if in_string:
+            if ch == '\n':
+                # 字符串中的裸换行是非法的
+                out.append('\\n')
+                continue
+            out.append(ch)
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+
+        if ch == '"':
+            in_string = True
+            string_start = len(out)
+        elif ch in '{[':
+            stack.append(('}' if ch == '{' else ']', len(out)))
+        elif ch in '}]':
+            if not stack or stack[-1][0] != ch:
+                # 多余的右括号直接丢弃
+                continue
+            # 去掉尾随逗号
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ',':
+                out.pop()
+            stack.pop()
+            out.append(ch)
+            if not stack:
+                break
+            continue
+        out.append(ch)
+
+    if in_string:
+        # 截断在字符串中：值不完整，连同它的键一起丢弃，由缺失字段补问
+        out = out[:string_start]
+    elif stack:
+        # 截断在数字上（如 12 被截成 1）：同样连同键一起丢弃
+        tail = _NUMBER_TAIL.search(''.join(out))
+        if tail:
+            out = out[:len(out) - len(tail.group(0))]
+    # 未闭合的数组（根容器除外）是被截断的值，同样整体丢弃；对象只补全括号，保留其中完整的字段
+    for depth, (closer, start) in enumerate(stack[1:], 1):
+        if closer == ']':
+            out = out[:start]
+            del stack[depth:]
+            break
+
+    repaired = ''.join(out)
+    while stack:
+        repaired = _trim_dangling(repaired, stack[-1][0]) + stack.pop()[0]
+    return repaired
+
+
+def parse_json_tolerant(text: str) -> Tuple[Any, bool]:
+    """解析 JSON，失败时尝试修复；返回 (数据, 是否经过修复)，无法修复时抛出 ValueError"""
+    content = (text or '').strip()
+    match = re.search(r'```json\s*\n(.*?)\n```', content, re.DOTALL)
+    candidate = match.group(1) if match else content
+    try:
+        return json.loads(candidate), False
+    except (json.JSONDecodeError, TypeError):
+        pass
+
+    repaired = repair_json(content)
+    try:
+        return json.loads(repaired), True
+    except (json.JSONDecodeError, TypeError) as e:
+        raise ValueError(f"无法修复的 JSON: {e}")
+
+
+def validate_analysis(data: Any) -> Tuple[Dict[str, Any], List[str]]:
+    """按 ANALYSIS_SCHEMA 校验分析结果，返回 (只保留期望顶层键的结果, 缺失字段列表)
+
+    缺失字段以 "顶层键.子字段" 表示；顶层键整体缺失时列出其全部子字段。
+    """
+    if not isinstance(data, dict):
+        data = {}
+
+    normalized: Dict[str, Any] = {}
+    missing: List[str] = []
+    for section, fields in ANALYSIS_SCHEMA.items():
+        value = data.get(section)
+        if not isinstance(value, dict):
+            missing.extend(f"{section}.{field}" for field in fields)
+            continue
+        normalized[section] = dict(value)
+        value = normalized[section]
+        for field in fields:
+            if value.get(field) in (None, ''):
+                missing.append(f"{section}.{field}")
+
+    discourse = normalized.get('discourse_structure', {})
+    count = discourse.get('sentence_count')
+    if isinstance(count, str) and count.strip().isdigit():
+        discourse['sentence_count'] = int(count.strip())
+
+    return normalized, missing
+
+
+def merge_analysis(base: Dict[str, Any], patch: Dict[str, Any], fields: List[str]) -> Dict[str, Any]:
+    """把补问得到的字段合并进已有分析结果，只合并 fields 中列出的字段"""
+    merged = {section: dict(value) for section, value in base.items() if isinstance(value, dict)}
+    for path in fields:
+        section, field = path.split('.', 1)
+        source = patch.get(section) if isinstance(patch, dict) else None
+        if isinstance(source, dict) and source.get(field) not in (None, ''):
+            merged.setdefault(section, {})[field] = source[field]
+        elif isinstance(patch, dict) and patch.get(field) not in (None, ''):
+            # 模型有时会省略父级键
+            merged.setdefault(section, {})[field] = patch[field]
+    return merged
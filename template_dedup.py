@@ -0,0 +1,272 @@
+# template_dedup.py
+
+import re
+import sys
+import copy
+import random
+import hashlib
+import threading
+from collections import defaultdict
+from typing import List, Dict, Any, Tuple, Optional
+
+from config import SOURCE_DIR, DEDUP_THRESHOLD, MINHASH_NUM_PERM
+from utils import read_text_file, get_case_dirs, extract_template_text
+
+
+# 梅森素数，用于 MinHash 的通用哈希 (a * x + b) mod p
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+def shingles(text: str, size: int = 3) -> set:
+    """将文本规范化后切分为词级 shingle 集合"""
+    words = re.findall(r"[a-z0-9']+", (text or '').lower())
+    if len(words) < size:
+        return {' '.join(words)} if words else set()
+    return {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def _optimal_bands(num_perm: int, threshold: float) -> Tuple[int, int]:
+    """选择 LSH 的 (bands, rows)，使 S 曲线的拐点略低于阈值（宁多召回，再精确校验）"""
+    best = (num_perm, 1)
+    best_error = float('inf')
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        knee = (1.0 / bands) ** (1.0 / rows)
+        error = abs(knee - (threshold - 0.1))
+        if error < best_error:
+            best, best_error = (bands, rows), error
+    return best
+
+
+class MinHasher:
+    """MinHash 签名计算器"""
+
+    def __init__(self, num_perm: int = MINHASH_NUM_PERM, seed: int = 1):
+        rng = random.Random(seed)
+        self.num_perm = num_perm
+        self.params = [(rng.randint(1, _MERSENNE_PRIME - 1), rng.randint(0, _MERSENNE_PRIME - 1))
+                       for _ in range(num_perm)]
+
+    def signature(self, text: str) -> Tuple[int, ...]:
+        """计算文本的 MinHash 签名"""
+        values = [int.from_bytes(hashlib.blake2b(s.encode('utf-8'), digest_size=4).digest(), 'little')
+                  for s in shingles(text)]
+        if not values:
+            return tuple([_MAX_HASH] * self.num_perm)
+        return tuple(
+            min(((a * v + b) % _MERSENNE_PRIME) & _MAX_HASH for v in values)
+            for a, b in self.params
+        )
+
+    @staticmethod
+    def jaccard(sig1: Tuple[int, ...], sig2: Tuple[int, ...]) -> float:
+        """由签名估计 Jaccard 相似度"""
+        if not sig1:
+            return 0.0
+        return sum(1 for x, y in zip(sig1, sig2) if x == y) / len(sig1)
+
+
+class TemplateDeduplicator:
+    """近重复模板聚类：MinHash 签名 + LSH 分桶，只对候选对做校验，整体近似线性"""
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, num_perm: int = MINHASH_NUM_PERM):
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm)
+        self.bands, self.rows = _optimal_bands(num_perm, threshold)
+
+    def band_keys(self, signature: Tuple[int, ...]) -> List[Tuple[int, ...]]:
+        """签名在各个 LSH 分带中的桶键"""
+        return [signature[band * self.rows:(band + 1) * self.rows] for band in range(self.bands)]
+
+    def cluster(self, texts: List[str], signatures: Optional[List[Tuple[int, ...]]] = None) -> List[List[int]]:
+        """对文本聚类，返回簇列表（每个簇是下标列表，首元素为代表）；可传入已计算的签名
+
+        簇中每个成员与代表的估计 Jaccard 相似度都不低于 threshold。
+        """
+        if signatures is None:
+            signatures = [self.hasher.signature(t) for t in texts]
+        # 按下标顺序逐个归簇：每个分带的桶只登记第一个落入的簇代表，模板在每个分带至多与一个代表比较，
+        # 整体近似线性；只并入与代表足够相似的簇，不会出现 A~B~C 式的链式聚类
+        rep_of = list(range(len(texts)))
+        bucket_reps: List[Dict[Tuple[int, ...], int]] = [{} for _ in range(self.bands)]
+        for i, sig in enumerate(signatures):
+            keys = self.band_keys(sig)
+            best, best_score = None, self.threshold
+            compared = set()
+            for band, key in enumerate(keys):
+                rep = bucket_reps[band].get(key)
+                if rep is None or rep in compared:
+                    continue
+                compared.add(rep)
+                score = MinHasher.jaccard(sig, signatures[rep])
+                if score >= best_score:
+                    best, best_score = rep, score
+            if best is not None:
+                rep_of[i] = best
+                continue
+            for band, key in enumerate(keys):
+                bucket_reps[band].setdefault(key, i)
+
+        clusters = defaultdict(list)
+        for i, rep in enumerate(rep_of):
+            clusters[rep].append(i)
+        return sorted(clusters.values(), key=lambda members: members[0])
+
+    def representative_map(self, texts: List[str]) -> Tuple[List[int], Dict[str, Any]]:
+        """返回每个文本对应的代表下标，以及节省情况报告"""
+        clusters = self.cluster(texts)
+        rep_of = list(range(len(texts)))
+        for members in clusters:
+            for i in members:
+                rep_of[i] = members[0]
+
+        duplicates = len(texts) - len(clusters)
+        report = {
+            'total_templates': len(texts),
+            'clusters': len(clusters),
+            'analyses_saved': duplicates,
+            'saving_ratio': round(duplicates / len(texts), 3) if texts else 0.0,
+            'threshold': self.threshold,
+            'duplicate_groups': [members for members in clusters if len(members) > 1]
+        }
+        return rep_of, report
+
+
+def text_key(text: str) -> str:
+    """模板正文的稳定键：忽略空白和大小写差异"""
+    normalized = ' '.join((text or '').split()).lower()
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+
+class SharedAnalysisPool:
+    """跨案例共享近重复模板的分析结果：按簇代表缓存分析，每个簇只调用一次上游分析
+
+    运行前用 build() 对整个模板池聚类；不在预聚类中的模板（模板库检索结果、队列模式下的案例）
+    按同样的 LSH 分带与已知的簇代表比较，与代表的估计 Jaccard 达到阈值时并入该簇，否则自成一簇。
+    只缓存完整的上游分析结果，熔断退化的本地分析和失败结果不会共享。
+    """
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, num_perm: int = MINHASH_NUM_PERM):
+        self.dedup = TemplateDeduplicator(threshold, num_perm)
+        self.signatures: Dict[str, Tuple[int, ...]] = {}
+        # 正文键 -> 簇代表的正文键
+        self.rep_of: Dict[str, str] = {}
+        # 每个分带一个桶表：桶键 -> [正文键, ...]
+        self._buckets: List[Dict[Tuple[int, ...], List[str]]] = [defaultdict(list) for _ in range(self.dedup.bands)]
+        # 簇代表的正文键 -> 分析结果
+        self.analyses: Dict[str, Dict] = {}
+        self.reused = 0
+        self.stored = 0
+        self._lock = threading.Lock()
+
+    def _register(self, key: str, signature: Tuple[int, ...], rep: str) -> None:
+        self.signatures[key] = signature
+        self.rep_of[key] = rep
+        # 分带桶中只登记簇代表，新模板只与代表比较
+        if rep == key:
+            for band, band_key in enumerate(self.dedup.band_keys(signature)):
+                self._buckets[band][band_key].append(key)
+
+    def build(self, texts: List[str]) -> Dict[str, Any]:
+        """对模板池预聚类，返回聚类报告"""
+        unique: Dict[str, str] = {}
+        for text in texts:
+            unique.setdefault(text_key(text), text)
+        keys = [key for key in unique if key not in self.rep_of]
+        signatures = [self.dedup.hasher.signature(unique[key]) for key in keys]
+        clusters = self.dedup.cluster([unique[key] for key in keys], signatures)
+        with self._lock:
+            for members in clusters:
+                rep = keys[members[0]]
+                for i in members:
+                    self._register(keys[i], signatures[i], rep)
+        return {
+            'total_templates': len(texts),
+            'unique_templates': len(keys),
+            'clusters': len(clusters),
+            'analyses_saved': len(texts) - len(clusters),
+            'threshold': self.dedup.threshold
+        }
+
+    def representative(self, text: str) -> str:
+        """模板所属簇的代表键；未见过的模板与已知模板比较后归簇"""
+        key = text_key(text)
+        with self._lock:
+            if key in self.rep_of:
+                return self.rep_of[key]
+        signature = self.dedup.hasher.signature(text)
+        with self._lock:
+            if key in self.rep_of:
+                return self.rep_of[key]
+            best, best_score = None, self.dedup.threshold
+            compared = set()
+            for band, band_key in enumerate(self.dedup.band_keys(signature)):
+                for candidate in self._buckets[band].get(band_key, ()):
+                    if candidate in compared:
+                        continue
+                    compared.add(candidate)
+                    score = MinHasher.jaccard(signature, self.signatures[candidate])
+                    if score >= best_score:
+                        best, best_score = candidate, score
+            rep = best if best is not None else key
+            self._register(key, signature, rep)
+            return rep
+
+    def get(self, text: str) -> Optional[Dict]:
+        """返回同簇模板已有的分析结果（副本），没有时返回 None"""
+        rep = self.representative(text)
+        with self._lock:
+            analysis = self.analyses.get(rep)
+            if analysis is None:
+                return None
+            self.reused += 1
+            return copy.deepcopy(analysis)
+
+    def put(self, text: str, analysis: Dict) -> None:
+        """缓存完整的上游分析结果，供同簇的其他模板复用"""
+        if not isinstance(analysis, dict) or analysis.get('degraded') or 'raw_response' in analysis:
+            return
+        if not all(isinstance(analysis.get(k), dict) for k in ('discourse_structure', 'content_structure')):
+            return
+        rep = self.representative(text)
+        with self._lock:
+            if rep not in self.analyses:
+                self.analyses[rep] = copy.deepcopy(analysis)
+                self.stored += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'templates': len(self.rep_of),
+                'clusters': len(set(self.rep_of.values())),
+                'analyses_cached': self.stored,
+                'analyses_reused': self.reused
+            }
+
+
+def main() -> None:
+    """命令行入口：统计源目录模板池中的近重复情况"""
+    source_dir = sys.argv[1] if len(sys.argv) > 1 else SOURCE_DIR
+    paths, texts = [], []
+    for case_dir in get_case_dirs(source_dir):
+        for i in range(1, 5):
+            path = f"{case_dir}/template{i}.json"
+            content = read_text_file(path)
+            if content:
+                paths.append(path)
+                texts.append(extract_template_text(content))
+
+    _, report = TemplateDeduplicator().representative_map(texts)
+    print(f"模板总数: {report['total_templates']}, 簇数: {report['clusters']}, "
+          f"可节省分析: {report['analyses_saved']} ({report['saving_ratio']:.1%})")
+    for members in report['duplicate_groups']:
+        print("  近重复组:")
+        for i in members:
+            print(f"    {paths[i]}")
+
+
+if __name__ == "__main__":
+    main()
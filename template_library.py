@@ -0,0 +1,446 @@
+# template_library.py
+
+import os
+import re
+import sys
+import json
+import math
+import mmap
+import time
+import array
+import bisect
+import heapq
+import struct
+import hashlib
+import argparse
+from collections import defaultdict, Counter
+from typing import List, Dict, Any, Optional, Tuple, Iterator
+
+from config import SOURCE_DIR, TEMPLATE_LIBRARY_DIR, TEMPLATE_LIBRARY_TOP_K, TEMPLATE_LIBRARY_MAX_QUERY_TERMS
+from utils import read_text_file, get_case_dirs, extract_template_text
+from template_analyzer import EnglishTemplateAnalyzer
+
+
+# 检索时忽略的高频功能词
+STOP_WORDS = {
+    'the', 'and', 'for', 'are', 'but', 'not', 'you', 'all', 'any', 'can', 'had', 'her', 'was', 'one',
+    'our', 'out', 'has', 'his', 'how', 'its', 'may', 'new', 'now', 'who', 'did', 'get', 'him', 'she',
+    'too', 'use', 'this', 'that', 'with', 'have', 'from', 'they', 'will', 'would', 'there', 'their',
+    'what', 'about', 'which', 'when', 'were', 'been', 'into', 'than', 'then', 'them', 'these', 'those',
+    'such', 'also', 'more', 'most', 'some', 'only', 'other', 'while', 'both', 'must', 'much', 'very',
+    'each', 'just', 'like', 'being', 'between', 'through', 'often'
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """分词：与分析器一致只保留3个字母以上的英文单词，并去掉停用词"""
+    words = re.findall(r'\b[A-Za-z]{3,}\b', text or '')
+    return [w.lower() for w in words if w.lower() not in STOP_WORDS]
+
+
+# 倒排链文件中按得分排序的一项：(文档序号, 词频)
+_POSTING = struct.Struct("<II")
+# 顺序读取倒排链时每次读入的项数
+_POSTING_CHUNK = 256
+# 不超过该长度的倒排链查词频时建字典，更长的在文档序号数组上二分查找
+_POSTING_DICT_MAX = 8192
+
+
+def _read_uint32(view: mmap.mmap, offset: int, count: int) -> array.array:
+    """读取小端序的 uint32 数组"""
+    values = array.array('I', view[offset:offset + count * 4])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+class _PostingList:
+    """倒排链文件中的一条倒排链，接口与内存中的 {template_id: 词频} 字典一致（len / items / get）
+
+    文件中依次存放：按词项得分降序的 (文档序号, 词频)，供检索分块顺序读取；
+    按文档序号升序的文档序号数组和词频数组，首次查词频时读入（较短的链建成字典，较长的二分查找）。
+    """
+
+    def __init__(self, view: mmap.mmap, offset: int, df: int, doc_ids: List[str], ordinals: Dict[str, int]):
+        self.view = view
+        self.offset = offset
+        self.df = df
+        self.doc_ids = doc_ids
+        self.ordinals = ordinals
+        self._docs: Optional[array.array] = None
+        self._freqs: Optional[array.array] = None
+        self._lookup: Optional[Dict[int, int]] = None
+
+    def __len__(self) -> int:
+        return self.df
+
+    def items(self) -> Iterator[Tuple[str, int]]:
+        end = self.offset + self.df * _POSTING.size
+        for start in range(self.offset, end, _POSTING_CHUNK * _POSTING.size):
+            block = self.view[start:min(start + _POSTING_CHUNK * _POSTING.size, end)]
+            for ordinal, freq in _POSTING.iter_unpack(block):
+                yield self.doc_ids[ordinal], freq
+
+    def get(self, template_id: str, default: Optional[int] = None) -> Optional[int]:
+        ordinal = self.ordinals.get(template_id)
+        if ordinal is None:
+            return default
+        if self._docs is None:
+            base = self.offset + self.df * _POSTING.size
+            self._docs = _read_uint32(self.view, base, self.df)
+            self._freqs = _read_uint32(self.view, base + self.df * 4, self.df)
+            if self.df <= _POSTING_DICT_MAX:
+                self._lookup = dict(zip(self._docs, self._freqs))
+        if self._lookup is not None:
+            return self._lookup.get(ordinal, default)
+        i = bisect.bisect_left(self._docs, ordinal)
+        if i < self.df and self._docs[i] == ordinal:
+            return self._freqs[i]
+        return default
+
+
+class TemplateLibrary:
+    """模板库：一次性存储模板及其本地分析特征，并通过倒排索引检索相关模板
+
+    磁盘布局（library_dir 下）：
+    - templates.jsonl: 每行一条模板记录（原始内容、正文、本地分析特征）
+    - index.json: 词表（每个词的倒排链位置和文档频率）、文档长度以及记录在 templates.jsonl 中的字节偏移
+    - postings.<版本>.bin: 倒排链，每条按词项得分（BM25 的词频部分）降序保存，加载时 mmap 映射而不读入内存
+    查询只访问查询词的倒排链，不会逐条扫描模板：查询词按 查询权重 × IDF 截取，
+    再用阈值算法沿排好序的倒排链提前终止，通常只读取每条链的开头一小段。
+    添加模板时先把已加载的倒排链读入内存，保存时重写倒排链文件。
+    """
+
+    RECORDS_FILE = "templates.jsonl"
+    INDEX_FILE = "index.json"
+
+    # BM25 参数
+    K1 = 1.2
+    B = 0.75
+
+    # 核心概念在索引中的额外权重（相当于多出现几次）
+    CONCEPT_BOOST = 2
+
+    def __init__(self, library_dir: str = TEMPLATE_LIBRARY_DIR):
+        self.library_dir = library_dir
+        self.records_path = os.path.join(library_dir, self.RECORDS_FILE)
+        self.index_path = os.path.join(library_dir, self.INDEX_FILE)
+        self.analyzer = EnglishTemplateAnalyzer()
+
+        # term -> {template_id: 词频}，保存和检索前按词项得分降序排列
+        self.postings: Dict[str, Dict[str, int]] = defaultdict(dict)
+        # template_id -> 文档长度（加权词数）
+        self.doc_lengths: Dict[str, int] = {}
+        # template_id -> templates.jsonl 中的字节偏移
+        self.offsets: Dict[str, int] = {}
+        self.total_length = 0
+        # 倒排链是否已按当前平均文档长度下的词项得分排序
+        self._impact_ordered = True
+        # 从倒排链文件加载时：term -> (偏移, 文档频率)，以及文档序号与模板 ID 的对应关系
+        self._terms: Dict[str, Tuple[int, int]] = {}
+        self._doc_ids: List[str] = []
+        self._ordinals: Dict[str, int] = {}
+        self._postings_file = None
+        self._postings_map: Optional[mmap.mmap] = None
+
+        if os.path.exists(self.index_path):
+            self.load()
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __contains__(self, template_id: str) -> bool:
+        return template_id in self.offsets
+
+    @staticmethod
+    def make_template_id(text: str) -> str:
+        """根据正文内容生成稳定的模板 ID，相同正文只存储一次"""
+        normalized = ' '.join(text.split()).lower()
+        return hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+
+    def add_template(self, template_content: str, source: str = "",
+                     features: Optional[Dict[str, Any]] = None) -> str:
+        """添加一个模板（原始 JSON 字符串），返回模板 ID；已存在时直接返回"""
+        text = extract_template_text(template_content)
+        template_id = self.make_template_id(text)
+        if template_id in self.offsets:
+            return template_id
+
+        if features is None:
+            features = {
+                'discourse_structure': self.analyzer.analyze_discourse_structure(text),
+                'content_structure': self.analyzer.analyze_content_structure(text)
+            }
+
+        record = {
+            'id': template_id,
+            'source': source,
+            'content': template_content,
+            'text': text,
+            'features': features
+        }
+
+        os.makedirs(self.library_dir, exist_ok=True)
+        with open(self.records_path, 'ab') as f:
+            offset = f.tell()
+            f.write((json.dumps(record, ensure_ascii=False) + "\n").encode('utf-8'))
+        self.offsets[template_id] = offset
+
+        self._index_record(template_id, text, features)
+        return template_id
+
+    def _index_record(self, template_id: str, text: str, features: Dict[str, Any]) -> None:
+        """将模板正文和核心概念写入倒排索引"""
+        self._materialize()
+        term_freq = Counter(tokenize(text))
+        core_concepts = features.get('content_structure', {}).get('core_concepts', [])
+        for concept in core_concepts:
+            for term in tokenize(concept):
+                term_freq[term] += self.CONCEPT_BOOST
+
+        length = sum(term_freq.values())
+        for term, freq in term_freq.items():
+            self.postings[term][template_id] = freq
+        self.doc_lengths[template_id] = length
+        self.total_length += length
+        # 平均文档长度变化后需要重新排序倒排链
+        self._impact_ordered = False
+
+    def add_from_case_dirs(self, case_dirs: List[str]) -> int:
+        """从案例目录中导入 template*.json，返回新增模板数量"""
+        added = 0
+        for case_dir in case_dirs:
+            for name in sorted(os.listdir(case_dir)):
+                if not (name.startswith("template") and name.endswith(".json")):
+                    continue
+                path = os.path.join(case_dir, name)
+                content = read_text_file(path)
+                if not content:
+                    continue
+                before = len(self)
+                self.add_template(content, source=path)
+                added += len(self) - before
+        return added
+
+    def _term_impact(self, freq: int, template_id: str, avg_length: float) -> float:
+        """BM25 中与查询无关的词频部分"""
+        norm = self.K1 * (1 - self.B + self.B * self.doc_lengths[template_id] / avg_length)
+        return freq * (self.K1 + 1) / (freq + norm)
+
+    def _posting(self, term: str):
+        """词的倒排链：内存中的字典或倒排链文件中的 _PostingList，没有时返回 None"""
+        if self._postings_map is not None:
+            location = self._terms.get(term)
+            if location is None:
+                return None
+            return _PostingList(self._postings_map, location[0], location[1], self._doc_ids, self._ordinals)
+        return self.postings.get(term)
+
+    def _materialize(self) -> None:
+        """把倒排链文件读入内存（添加模板前调用），之后按内存中的字典维护"""
+        if self._postings_map is None:
+            return
+        for term in self._terms:
+            self.postings[term] = dict(self._posting(term).items())
+        self.close()
+
+    def close(self) -> None:
+        """释放倒排链文件的映射"""
+        if self._postings_map is not None:
+            self._postings_map.close()
+            self._postings_file.close()
+        self._postings_map = None
+        self._postings_file = None
+        self._terms, self._doc_ids, self._ordinals = {}, [], {}
+
+    def _order_postings(self) -> None:
+        """把每条倒排链按词项得分降序重排（字典保持插入顺序，保存后顺序随 index.json 一起保留）"""
+        avg_length = self.total_length / len(self.doc_lengths) if self.doc_lengths else 1.0
+        for term, posting in self.postings.items():
+            self.postings[term] = dict(sorted(
+                posting.items(), key=lambda item: self._term_impact(item[1], item[0], avg_length), reverse=True
+            ))
+        self._impact_ordered = True
+
+    def search(self, query: str, k: int = TEMPLATE_LIBRARY_TOP_K,
+               query_weights: Optional[Dict[str, float]] = None,
+               max_terms: int = TEMPLATE_LIBRARY_MAX_QUERY_TERMS) -> List[Tuple[str, float]]:
+        """BM25 检索，返回 [(template_id, score), ...]，按得分从高到低排序
+
+        只使用 查询权重 × IDF 最高的 max_terms 个查询词。按阈值算法（Fagin TA）逐层读取各词按得分排序的倒排链，
+        新见到的模板直接查出完整得分；当前第 k 名的得分不低于各链当前位置得分之和时，未读到的模板不可能进入前 k，提前结束。
+        """
+        if not self.doc_lengths or k <= 0:
+            return []
+        if not self._impact_ordered:
+            self._order_postings()
+
+        weights = query_weights
+        if weights is None:
+            weights = {term: float(freq) for term, freq in Counter(tokenize(query)).items()}
+
+        doc_count = len(self.doc_lengths)
+        avg_length = self.total_length / doc_count if doc_count else 1.0
+
+        # (查询权重 × IDF, 词)，只保留区分度最高的若干个查询词
+        terms = []
+        for term, query_weight in weights.items():
+            posting = self._posting(term)
+            if not posting or query_weight <= 0:
+                continue
+            df = len(posting)
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            terms.append((query_weight * idf, term, posting))
+        terms = heapq.nlargest(max_terms, terms, key=lambda item: item[0])
+        # (查询词权重, 倒排链, 按得分顺序读取的游标)
+        lists = [(weight, posting, iter(posting.items())) for weight, _, posting in terms]
+
+        top: List[Tuple[float, str]] = []  # 小顶堆，保存当前前 k 名
+        seen = set()
+        while lists:
+            threshold = 0.0
+            active = []
+            for weight, posting, cursor in lists:
+                item = next(cursor, None)
+                if item is None:
+                    continue
+                active.append((weight, posting, cursor))
+                template_id, freq = item
+                threshold += weight * self._term_impact(freq, template_id, avg_length)
+                if template_id in seen:
+                    continue
+                seen.add(template_id)
+                score = 0.0
+                for w, p, _ in lists:
+                    f = p.get(template_id)
+                    if f:
+                        score += w * self._term_impact(f, template_id, avg_length)
+                if len(top) < k:
+                    heapq.heappush(top, (score, template_id))
+                elif score > top[0][0]:
+                    heapq.heapreplace(top, (score, template_id))
+            lists = active
+            if len(top) == k and top[0][0] >= threshold:
+                break
+
+        return [(template_id, score) for score, template_id in sorted(top, reverse=True)]
+
+    def retrieve_for_case(self, topic: str, context: str,
+                          k: int = TEMPLATE_LIBRARY_TOP_K) -> List[Dict[str, Any]]:
+        """根据案例的主题和上下文检索最相关的 k 个模板记录（主题词权重更高）"""
+        weights: Dict[str, float] = defaultdict(float)
+        for term, freq in Counter(tokenize(context)).items():
+            weights[term] += float(freq)
+        for term, freq in Counter(tokenize(topic)).items():
+            weights[term] += 3.0 * freq
+
+        results = []
+        for template_id, score in self.search("", k=k, query_weights=weights):
+            record = self.get_template(template_id)
+            if record:
+                record['score'] = round(score, 4)
+                results.append(record)
+        return results
+
+    def get_template(self, template_id: str) -> Optional[Dict[str, Any]]:
+        """按 ID 随机读取模板记录"""
+        offset = self.offsets.get(template_id)
+        if offset is None:
+            return None
+        with open(self.records_path, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.readline().decode('utf-8'))
+
+    def save(self) -> None:
+        """保存倒排索引：倒排链按词项得分排好序后写入新版本的倒排链文件，再替换 index.json"""
+        self._materialize()
+        if not self._impact_ordered:
+            self._order_postings()
+        os.makedirs(self.library_dir, exist_ok=True)
+
+        doc_ids = list(self.doc_lengths)
+        ordinals = {template_id: i for i, template_id in enumerate(doc_ids)}
+        postings_name = f"postings.{time.time_ns():x}.bin"
+        terms = {}
+        with open(os.path.join(self.library_dir, postings_name), 'wb') as f:
+            for term, posting in self.postings.items():
+                entries = [(ordinals[template_id], freq) for template_id, freq in posting.items()]
+                terms[term] = [f.tell(), len(entries)]
+                by_doc = sorted(entries)
+                docs = array.array('I', (ordinal for ordinal, _ in by_doc))
+                freqs = array.array('I', (freq for _, freq in by_doc))
+                if sys.byteorder == 'big':
+                    docs.byteswap()
+                    freqs.byteswap()
+                f.write(b''.join(_POSTING.pack(*entry) for entry in entries))
+                f.write(docs.tobytes())
+                f.write(freqs.tobytes())
+
+        index = {
+            'postings_file': postings_name,
+            'terms': terms,
+            'doc_ids': doc_ids,
+            'doc_lengths': self.doc_lengths,
+            'offsets': self.offsets,
+            'total_length': self.total_length,
+            'impact_ordered': True
+        }
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, self.index_path)
+
+        # 新索引生效后删除旧版本的倒排链文件
+        for name in os.listdir(self.library_dir):
+            if name.startswith("postings.") and name.endswith(".bin") and name != postings_name:
+                os.remove(os.path.join(self.library_dir, name))
+
+    def load(self) -> None:
+        """加载倒排索引；倒排链文件通过 mmap 映射，检索时只读取用到的部分"""
+        self.close()
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        self.postings = defaultdict(dict, index.get('postings', {}))
+        self.doc_lengths = index.get('doc_lengths', {})
+        self.offsets = index.get('offsets', {})
+        self.total_length = index.get('total_length', sum(self.doc_lengths.values()))
+        # 旧版索引的倒排链没有排序，首次检索时排序一次
+        self._impact_ordered = index.get('impact_ordered', False)
+
+        postings_path = os.path.join(self.library_dir, index.get('postings_file') or '')
+        if index.get('postings_file') and os.path.getsize(postings_path) > 0:
+            self._postings_file = open(postings_path, 'rb')
+            self._postings_map = mmap.mmap(self._postings_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._terms = {term: tuple(location) for term, location in index.get('terms', {}).items()}
+            self._doc_ids = index.get('doc_ids', [])
+            self._ordinals = {template_id: i for i, template_id in enumerate(self._doc_ids)}
+
+
+def main() -> None:
+    """命令行入口：构建模板库或检索模板"""
+    parser = argparse.ArgumentParser(description="模板库构建与检索")
+    parser.add_argument("--library-dir", default=TEMPLATE_LIBRARY_DIR, help="模板库目录")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="从案例目录导入模板")
+    build_parser.add_argument("--source-dir", default=SOURCE_DIR, help="案例源目录")
+
+    search_parser = subparsers.add_parser("search", help="检索模板")
+    search_parser.add_argument("query", help="查询文本（如主题）")
+    search_parser.add_argument("-k", type=int, default=TEMPLATE_LIBRARY_TOP_K, help="返回数量")
+
+    args = parser.parse_args()
+    library = TemplateLibrary(args.library_dir)
+
+    if args.command == "build":
+        added = library.add_from_case_dirs(get_case_dirs(args.source_dir))
+        library.save()
+        print(f"新增 {added} 个模板，模板库共 {len(library)} 个模板")
+    elif args.command == "search":
+        for template_id, score in library.search(args.query, k=args.k):
+            record = library.get_template(template_id)
+            print(f"{score:.4f}  {template_id}  {record['text'][:80]}...")
+
+
+if __name__ == "__main__":
+    main()
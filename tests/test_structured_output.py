@@ -0,0 +1,29 @@
+# tests/test_structured_output.py
+
+import unittest
+
+from structured_output import repair_json, parse_json_tolerant, validate_analysis
+
+
+class RepairJsonTest(unittest.TestCase):
+
+    def test_truncated_number_is_dropped_and_reported_missing(self):
+        data, repaired = parse_json_tolerant('{"discourse_structure": {"rhetoric": "contrast", "sentence_count": 1')
+        self.assertTrue(repaired)
+        self.assertEqual(data, {'discourse_structure': {'rhetoric': 'contrast'}})
+        _, missing = validate_analysis(data)
+        self.assertIn('discourse_structure.sentence_count', missing)
+
+    def test_number_followed_by_delimiter_is_kept(self):
+        self.assertEqual(repair_json('{"a": {"sentence_count": 12, "b": "x'), '{"a": {"sentence_count": 12}}')
+        self.assertEqual(repair_json('{"a": [1, 2], "b": 3 '), '{"a": [1, 2], "b": 3}')
+
+    def test_truncated_string_is_dropped(self):
+        self.assertEqual(repair_json('{"a": 1, "b": "partial val'), '{"a": 1}')
+
+    def test_complete_json_is_unchanged(self):
+        self.assertEqual(repair_json('```json\n{"a": 1, "b": [1, 2],}\n```'), '{"a": 1, "b": [1, 2]}')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+# tests/test_template_dedup.py
+
+import random
+import unittest
+from unittest import mock
+
+from template_dedup import MinHasher, TemplateDeduplicator
+
+
+def _near_duplicates(count: int, seed: int = 1) -> list:
+    """同一底稿的 count 个近重复版本：每个版本替换一个词"""
+    rng = random.Random(seed)
+    words = [f"w{i}" for i in range(400)]
+    base = [rng.choice(words) for _ in range(120)]
+    texts = []
+    for i in range(count):
+        variant = list(base)
+        variant[rng.randrange(len(variant))] = f"edit{i}"
+        texts.append(" ".join(variant))
+    return texts
+
+
+def _chain(count: int, step: int = 6) -> list:
+    """链式文本：相邻文本共享大部分词，首尾文本几乎没有共同词"""
+    words = [f"c{i}" for i in range(step * count + 100)]
+    return [" ".join(words[i * step:i * step + 100]) for i in range(count)]
+
+
+class ClusterTest(unittest.TestCase):
+
+    def test_comparisons_grow_linearly(self):
+        dedup = TemplateDeduplicator(threshold=0.8)
+        calls = []
+        original = MinHasher.jaccard
+
+        def counting(sig1, sig2):
+            calls.append(1)
+            return original(sig1, sig2)
+
+        for count in (500, 2000):
+            texts = _near_duplicates(count)
+            signatures = [dedup.hasher.signature(t) for t in texts]
+            calls.clear()
+            with mock.patch.object(MinHasher, 'jaccard', staticmethod(counting)):
+                clusters = dedup.cluster(texts, signatures)
+            # LSH 偶尔漏掉候选对，近重复池应聚成极少数几个簇
+            self.assertLessEqual(len(clusters), 10)
+            # 每个分带中每个成员至多比较一次
+            self.assertLessEqual(len(calls), dedup.bands * count)
+
+    def test_members_are_similar_to_their_representative(self):
+        dedup = TemplateDeduplicator(threshold=0.8)
+        texts = _chain(40)
+        signatures = [dedup.hasher.signature(t) for t in texts]
+        clusters = dedup.cluster(texts, signatures)
+
+        # 单链接会把整条链并成一个簇
+        self.assertGreater(len(clusters), 1)
+        for members in clusters:
+            rep = members[0]
+            for member in members[1:]:
+                self.assertGreaterEqual(MinHasher.jaccard(signatures[member], signatures[rep]), dedup.threshold)
+
+
+if __name__ == "__main__":
+    unittest.main()
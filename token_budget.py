@@ -0,0 +1,120 @@
+# token_budget.py
+
+import re
+import math
+from typing import Dict, Any
+
+from config import (MAX_PROMPT_TOKENS, ANALYSIS_MIN_TOKENS, ANALYSIS_MAX_TOKENS,
+                    GENERATION_MIN_TOKENS, GENERATION_MAX_TOKENS)
+
+
+# 中文按字、英文按词、数字按串、其余符号逐个切分
+_TOKEN_PATTERN = re.compile(r"[一-鿿]|[A-Za-z]+|\d+|[^\sA-Za-z\d一-鿿]")
+
+# 英文单词平均每个 token 的字母数（长词会被拆成多个 token）
+_CHARS_PER_WORD_TOKEN = 8
+# 每句平均词数，分析结果中没有句长信息时使用
+_DEFAULT_WORDS_PER_SENTENCE = 22
+_MIN_WORDS_PER_SENTENCE = 15
+# 英文 token 与单词数的比例
+_TOKENS_PER_WORD = 1.35
+
+
+class PromptBudgetError(ValueError):
+    """提示超出 token 预算"""
+
+
+def count_tokens(text: str) -> int:
+    """离线估算 token 数（近似 cl100k 分词，不需要网络或额外依赖）"""
+    count = 0
+    for piece in _TOKEN_PATTERN.findall(text or ''):
+        if piece.isascii() and piece.isalpha():
+            count += math.ceil(len(piece) / _CHARS_PER_WORD_TOKEN)
+        elif piece.isdigit():
+            count += math.ceil(len(piece) / 3)
+        else:
+            count += 1
+    return count
+
+
+def compact_prompt(prompt: str) -> str:
+    """去掉每行的缩进和多余空行"""
+    lines = []
+    for line in (prompt or '').strip().splitlines():
+        line = line.strip()
+        if line or (lines and lines[-1]):
+            lines.append(line)
+    return '\n'.join(lines).strip()
+
+
+def trim_to_tokens(text: str, max_tokens: int) -> str:
+    """将文本截断到 token 预算内，优先在句子边界截断"""
+    if count_tokens(text) <= max_tokens:
+        return text
+
+    sentences = re.split(r'(?<=[.!?。！？])\s+', text.strip())
+    kept, used = [], 0
+    for sentence in sentences:
+        tokens = count_tokens(sentence)
+        if used + tokens > max_tokens:
+            break
+        kept.append(sentence)
+        used += tokens
+    if kept:
+        return ' '.join(kept)
+
+    # 第一句就超出预算时按词截断
+    words, used = [], 0
+    for word in text.split():
+        used += count_tokens(word)
+        if used > max_tokens:
+            break
+        words.append(word)
+    return ' '.join(words)
+
+
+def enforce_prompt_budget(prompt: str, max_tokens: int = MAX_PROMPT_TOKENS) -> str:
+    """压缩提示空白，超出预算时抛出 PromptBudgetError，避免把过长的请求发出去"""
+    compacted = compact_prompt(prompt)
+    tokens = count_tokens(compacted)
+    if tokens > max_tokens:
+        raise PromptBudgetError(f"提示约 {tokens} tokens，超出预算 {max_tokens}")
+    return compacted
+
+
+def _clamp(value: float, low: int, high: int) -> int:
+    return int(max(low, min(high, round(value))))
+
+
+def analysis_max_tokens(template_text: str) -> int:
+    """根据模板长度和句子数确定分析请求的 max_tokens"""
+    sentences = [s for s in re.split(r'[.!?]\s+', template_text.strip()) if s]
+    # JSON 框架固定开销 + 每句的类型/句长条目 + 与正文长度相关的概念列表
+    estimate = 220 + 40 * len(sentences) + 0.3 * count_tokens(template_text)
+    return _clamp(estimate, ANALYSIS_MIN_TOKENS, ANALYSIS_MAX_TOKENS)
+
+
+def generation_max_tokens(analysis: Dict[str, Any]) -> int:
+    """根据分析出的句子数和句长确定生成请求的 max_tokens"""
+    discourse = analysis.get('discourse_structure', {}) if isinstance(analysis, dict) else {}
+    if not isinstance(discourse, dict):
+        discourse = {}
+
+    try:
+        sentence_count = int(discourse.get('sentence_count', 0))
+    except (TypeError, ValueError):
+        sentence_count = 0
+    if sentence_count <= 0:
+        # 没有可用分析时沿用备用 prompt 的 3-5 句
+        sentence_count = 5
+
+    lengths = discourse.get('sentence_length', [])
+    if isinstance(lengths, list) and lengths and all(isinstance(n, (int, float)) for n in lengths):
+        words_per_sentence = sum(lengths) / len(lengths)
+    else:
+        words_per_sentence = _DEFAULT_WORDS_PER_SENTENCE
+
+    # 生成的句子通常比模板更长，句长取下限并留 50% 余量，避免段落被截断
+    words_per_sentence = max(words_per_sentence, _MIN_WORDS_PER_SENTENCE)
+    estimate = sentence_count * words_per_sentence * _TOKENS_PER_WORD * 1.5 + 30
+    return _clamp(estimate, GENERATION_MIN_TOKENS, GENERATION_MAX_TOKENS)
@@ -36,4 +36,16 @@ def get_case_dirs(source_dir: str) -> List[str]:
         item_path = os.path.join(source_dir, item)
         if os.path.isdir(item_path) and item.startswith("case"):
             case_dirs.append(item_path)
-    return sorted(case_dirs)
\ No newline at end of file
+    return sorted(case_dirs)
+
+def extract_template_text(template_content: str) -> str:
+    """从模板 JSON 字符串中提取正文，解析失败时原样返回"""
+    try:
+        data = json.loads(template_content)
+    except (json.JSONDecodeError, TypeError):
+        return template_content
+    if isinstance(data, dict):
+        return str(data.get('text', template_content))
+    if isinstance(data, str):
+        return data
+    return template_content